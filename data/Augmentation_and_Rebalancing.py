@@ -17,19 +17,31 @@
 # AIM 2022
 
 # Import libraries/dependencies
+import os
+import sys
+import multiprocessing
 import numpy as np
-from numpy import load
-from numpy import savez_compressed
+from pandas import DataFrame as DF
 from matplotlib import pyplot as plt
 from keras.preprocessing.image import ImageDataGenerator
 from time import sleep
 
+# make the modules shared by the training and testing scripts (under "src/utils") importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from utils.face_store import load_faces, create_face_store, finalize_face_store
+from utils.augmentation import plan_augmentation, augment_to_store
+
 # define IO paths
 rootpath = './'
 
-# define target number of samples per age category and batch size
+# define target number of samples per age category and number of augmentation worker processes
 Nval = 150 #int(6100/(105-18))
-batchsz = 20
+nworkers = multiprocessing.cpu_count()
+# augment the dataset offline (i.e., write the synthetic samples to the output file); if False,
+# only the rebalanced records are written, and the augmentation happens on the fly during the
+# training (see "augment_online" in "src/train/Facenet_Train_2GPU.py" - which must be set to False
+# when the dataset is augmented offline, so that the samples are not augmented twice)
+augment_offline = False
 # define age bounds
 upper_age = 105
 lower_age = 18
@@ -51,125 +63,89 @@ datagen = ImageDataGenerator(
         horizontal_flip=True,
         fill_mode='constant')
 
-# Augmentation subroutine with batch processing
-def augment(X, y, Nval, datagen, batchsz):
-    # fit the transformation statistics to the data
-    datagen.fit(X)
-    N0 = len(y)
-    N1 = []
-    i = 0
-    for batch in datagen.flow(X, y, batch_size=batchsz, shuffle=True):
-        if not i:
-            newX = batch[0]
-            newy = batch[1]
-        else:
-            newX = np.concatenate([newX, batch[0]])
-            newy = np.concatenate([newy, batch[1]])
-        print('Processing augmentation batch %d ' % i, ' of %d' % N0)
-        i += 1
-        N1 = len(newy)
-        if N1 > (Nval-N0):
-            break  # we have enough samples
-        # add originals
-        #newX = np.concatenate(X, newX)
-        #newy = np.concatenate(y, newy)
-    return newX, newy, (N1+N0)
-
-# initialize arrays
-data = np.asarray([])
-labels = np.asarray([])
-data_new = np.asarray([])
-labels_new = list()
-DATA = np.asarray([])
-
-cnt = 0
-for elem in datalist:
-    # load datasets for training and validation
-    rawdata = load(rootpath + stem + elem + '.npz')
-    data_i, labels_i = rawdata['arr_0'], rawdata['arr_1']
-    if not cnt:
-        data = data_i
-        labels = labels_i
-    else:
-        data = np.concatenate([data, data_i])
-        labels = np.concatenate([labels, labels_i])
-    cnt = cnt + 1
-
-# initialize age list based on age bounds
-agelist = np.unique(labels)
-agebounds = np.where((agelist >= lower_age) & (agelist < upper_age))
-agebounds = np.reshape(agebounds, np.shape(agebounds)[1])
-agelist = agelist[int(agebounds[0]):int(agebounds[-1])]
-agepool = [[] for i in range(agelist[-1])]
-
-# Randomly rebalance dataset
-for age in agelist:
-    indx = np.where(labels == age)
-    cnt = len(indx[0])
-    print('(%d, ' % age, '%d)' % cnt)
-    rindx = np.random.permutation(cnt)
-    temp = [indx[0][i] for i in rindx]
-    agepool[age - 1].append(temp)
-data_cnt = 0
-for i in range(Nval):
+# (the augmentation workers re-import this script - only run it from the main process)
+if __name__ == '__main__':
+    # initialize arrays
+    data = np.asarray([])
+    labels = np.asarray([])
+
     cnt = 0
-    for age in agelist:
-        if i > (len(agepool[age - 1][0]) - 1):
-            continue
-        indx_i = agepool[age - 1][0][i]
-        data_i = data[indx_i,:,:,:]
-        data_i = np.expand_dims(data_i, axis=0)
-        labels_i = labels[indx_i]
+    for elem in datalist:
+        # load datasets for training and validation
+        data_i, index_i = load_faces(rootpath + stem + elem)
+        labels_i = index_i['label'].values
         if not cnt:
-            data_new = data_i
+            data = data_i
+            labels = labels_i
         else:
-            data_new = np.concatenate([data_new, data_i])
-        labels_new.append(labels_i)
+            data = np.concatenate([data, data_i])
+            labels = np.concatenate([labels, labels_i])
         cnt = cnt + 1
-    if not data_cnt:
-        DATA = data_new
+
+    # initialize age list based on age bounds
+    agelist = np.unique(labels)
+    agebounds = np.where((agelist >= lower_age) & (agelist < upper_age))
+    agebounds = np.reshape(agebounds, np.shape(agebounds)[1])
+    agelist = agelist[int(agebounds[0]):int(agebounds[-1])]
+
+    # Randomly rebalance dataset: compute the sampling plan first, i.e., a random permutation of
+    # the records of each age, truncated to Nval records
+    rebalance_plan = np.full((Nval, len(agelist)), -1, dtype = np.int64)
+    for j, age in enumerate(agelist):
+        indx = np.where(labels == age)
+        cnt = len(indx[0])
+        print('(%d, ' % age, '%d)' % cnt)
+        rindx = np.random.permutation(cnt)
+        temp = indx[0][rindx][:Nval]
+        rebalance_plan[:len(temp), j] = temp
+    # records are interleaved by age (the i-th record of every age, then the (i+1)-th, and so on)
+    rebalance_plan = rebalance_plan[rebalance_plan >= 0]
+
+    # gather all the selected records at once into a preallocated array
+    DATA = np.empty((len(rebalance_plan), ) + data.shape[1:], dtype = data.dtype)
+    np.take(data, rebalance_plan, axis = 0, out = DATA)
+    labels_new = labels[rebalance_plan]
+    print('Rebalanced dataset: %d records' % len(rebalance_plan))
+
+    # compute the augmentation plan up front: number of synthetic samples needed for each age
+    # (so that every age reaches Nval samples) and record each of them is derived from
+    if augment_offline:
+        aug_src_indx, aug_labels = plan_augmentation(labels_new, agelist, Nval)
     else:
-        DATA = np.concatenate([DATA, data_new])
-    del data_new
-    data_cnt = data_cnt+1
-    data_new = np.asarray([])
-    print('Processing iteration %d' % (i + 1), 'of %d,' % Nval)
-
-print('Final dataset: ')
-total_cnt = 0
-newX = np.asarray([])
-newy = np.asarray([])
-labels_new = np.asarray(labels_new)
-data_cnt = 0
-new_cnt = 0
-
-# process batches for augmentation by age
-for age in agelist:
-    indx = np.where(labels_new == age)
-    cnt = len(indx[0])
-    newX, newy, new_cnt = augment(DATA[indx[0],:,:,:], labels_new[indx], Nval, datagen, batchsz)
-    new_cnt = len(newy)
-    DATA = np.concatenate([DATA, newX])
-    labels_new = np.concatenate([labels_new, newy])
-    total_cnt = total_cnt + new_cnt
-    data_cnt = data_cnt + 1
-    print('(Age: %d , ' % age, 'new N: %d)' % new_cnt)
-print('\n N: new dataset %d' % total_cnt)
-
-# randomly shuffle the dataset
-rindx = np.random.permutation(np.shape(DATA)[0])
-DATA = DATA[rindx,:,:,:]
-labels_new = labels_new[rindx]
-
-# write rebalanced and augmented dataset to file
-print('Saving data to file...')
-savez_compressed(rootpath + 'extracted_faces_R.npz', DATA, labels_new)
-print('Done.')
-
-# show distribution of starting dataset (old) vs. rebalanced and augmented dataset (new)
-plt.hist(labels, bins = len(agelist))
-plt.title('Old dataset age distribution')
-plt.figure()
-plt.hist(labels_new, bins = len(agelist))
-plt.title('New dataset age distribution')
-plt.show()
+        aug_src_indx, aug_labels = np.zeros((0, ), dtype = np.int64), labels_new[:0]
+    for age in agelist:
+        print('(Age: %d , ' % age, 'new N: %d)' % np.sum(aug_labels == age))
+    total_cnt = len(aug_src_indx)
+    print('\n N: new dataset %d' % total_cnt)
+
+    # randomly shuffle the dataset: the position of every sample (original or synthetic)
+    # in the final dataset is decided before the synthetic samples are generated
+    N_total = len(DATA) + total_cnt
+    labels_all = np.concatenate([labels_new, aug_labels])
+    rindx = np.random.permutation(N_total)
+    dst_indx = np.empty((N_total, ), dtype = np.int64)
+    dst_indx[rindx] = np.arange(N_total)
+    labels_new = labels_all[rindx]
+
+    # write rebalanced dataset to its shuffled positions in a preallocated face store, then
+    # generate the augmented samples in parallel, writing them straight to the store
+    print('Saving data to file...')
+    store_path = rootpath + 'extracted_faces_R'
+    store_faces = create_face_store(store_path, N_total, DF({'label': labels_new}), DATA.shape[1:], np.uint8)
+    store_faces[dst_indx[:len(DATA)]] = DATA
+    store_faces.flush()
+    del store_faces
+
+    augment_to_store(store_path, dst_indx[aug_src_indx], dst_indx[len(DATA):], datagen, workers = nworkers)
+
+    # all the samples have been written - the store can now be opened for training
+    finalize_face_store(store_path)
+    print('Done.')
+
+    # show distribution of starting dataset (old) vs. rebalanced and augmented dataset (new)
+    plt.hist(labels, bins = len(agelist))
+    plt.title('Old dataset age distribution')
+    plt.figure()
+    plt.hist(labels_new, bins = len(agelist))
+    plt.title('New dataset age distribution')
+    plt.show()
@@ -18,13 +18,8 @@
 
 # import libraries/dependencies
 import numpy as np
-from numpy import load
-from numpy import isnan
 from pandas import read_csv
-from pandas import DataFrame as DF
 from pandas import merge
-from keras.models import load_model
-from keras.backend import clear_session
 import sys
 
 
@@ -35,36 +30,27 @@ datapath = 'data/'
 # load associated log file with record identifier information
 csv_log = read_csv(rootpath + datapath + 'logfile.csv')
 
-# get record numbers
-pmrn = csv_log['pmrn']
-pmrn = np.asarray(pmrn)
-
 # load raw clinical database
 csv_data = read_csv(rootpath + datapath + 'database.csv')
 
-# find relevant indices with associated face images
-keep_indx = []
-flag = []
-proc_df = DF()
-yhat_df = DF()
-
-for elem in pmrn:
-    #locate records in dataset matching logfile and indicate if found:
-    flag = not not csv_data['pmrn'][csv_data['pmrn'] == elem].tolist()
-    if flag:
-        #if face image pertaining to data entry exists, append data to output dataframe
-        proc_df = proc_df.append(csv_data[csv_data['pmrn'] == elem].iloc[0])[csv_data.columns.tolist()]
-        yhat_df = yhat_df.append(csv_log[csv_log['pmrn'] == elem].iloc[0])[csv_log.columns.tolist()]
-
-#sort results by record number
-proc_df = proc_df.sort_values(by = 'pmrn')
-yhat_df = yhat_df.sort_values(by = 'pmrn')
+# keep only the first record for each record number (pmrn), both in the clinical database
+# and in the logfile (records with no record number can not be matched)
+proc_df = csv_data[csv_data['pmrn'].notnull()].drop_duplicates(subset = 'pmrn', keep = 'first')
+yhat_df = csv_log[csv_log['pmrn'].notnull()].drop_duplicates(subset = 'pmrn', keep = 'first')
 
 # drop redundant columns
 yhat_df = yhat_df.drop('face flag', axis = 1)
 
-# concatenate dataframes
-csv_data = merge(proc_df, yhat_df, on = 'pmrn')
+# report the records with an associated face image that are missing from the clinical database
+match_indx = yhat_df['pmrn'].isin(proc_df['pmrn']).values
+unmatched_df = yhat_df[~match_indx]
+print('Matched %d of %d records in the logfile (%d unmatched, %d without record number).' % (np.sum(match_indx),
+        len(csv_log), len(unmatched_df), csv_log['pmrn'].isnull().sum()))
+unmatched_df.to_csv(rootpath + datapath + 'database_unmatched.csv', index = False)
+
+# join the clinical database with the records that have an associated face image (hash join on
+# the record number), and sort the results by record number
+csv_data = merge(proc_df, yhat_df[match_indx], on = 'pmrn').sort_values(by = 'pmrn', kind = 'mergesort')
 
 # save output dataframe as csv
 csv_data.to_csv(rootpath + datapath + 'database_processed.csv', index = False)
@@ -21,21 +21,25 @@ import matplotlib
 matplotlib.use('TkAgg')
 
 import numpy as np
-from pandas import DataFrame as DF
+from pandas import Series
 from pandas import read_csv
-from PIL import Image
 from matplotlib import pyplot as plt
 import cv2
+import os
 import sys
 
+# make the modules shared by the training and testing scripts (under "src/utils") importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from utils.face_store import load_faces
+from utils.review_session import FacePrefetcher, ReviewJournal
+
 # define IO paths
 inputpath = './'
 outputpath = './'
 facepath = './'
 
-# load faces
-data = np.load(facepath + 'extracted_faces.npz')
-X = data['arr_0']
+# load faces (memory-mapped - each face is read from disk only when it is reviewed)
+X, face_index_df = load_faces(facepath + 'extracted_faces')
 
 # read logfile pertaining to dataset and load image reference information for tracking
 df_log = read_csv(inputpath + 'logfile.csv')
@@ -47,12 +51,32 @@ pmrn_data = df_data['pmrn'] #record number
 yhat = df_data['face age'].values
 testy = df_data['chronologic age'].values
 
-# match the data to the information in the logfile by record number
+# locate the face of each logfile record in the face array (the face store only holds the photos
+# where a face was detected; legacy face arrays hold one face per logfile record)
+if 'photo_id' in face_index_df.columns:
+    face_row_log = photo_log.map(Series(face_index_df['face_idx'].values, index = face_index_df['photo_id'].values))
+else:
+    face_row_log = Series(np.arange(len(df_log)))
+
+# match the data to the information in the logfile by record number (first logfile record
+# for each record number), using a precomputed record number -> face array row index
+first_log = ~pmrn_log.duplicated(keep = 'first').values
+pmrn_to_row = Series(face_row_log.values[first_log], index = pmrn_log.values[first_log])
+row_data = pmrn_to_row.reindex(pmrn_data.values).values
+
+# the curated dataset may hold records whose photo has no extracted face ("face flag" 0) -
+# these cannot be reviewed, and are left out of the session
+has_face = ~np.isnan(row_data.astype(float))
+if not np.all(has_face):
+    print('Skipping %d record(s) without an extracted face: %s' % (np.sum(~has_face),
+          ', '.join([str(pmrn) for pmrn in pmrn_data.values[~has_face]])))
+    df_data = df_data[has_face].reset_index(drop = True)
+    pmrn_data = df_data['pmrn']
+    yhat = df_data['face age'].values
+    testy = df_data['chronologic age'].values
+
 N_data = len(pmrn_data)
-indx = []
-for i in range(N_data):
-    indx.append(np.where(pmrn_log == pmrn_data.iloc[i])[0][0])
-testX = X[indx,:,:,:]
+indx = row_data[has_face].astype(int)
 
 # set image/text display parameters
 font = cv2.FONT_HERSHEY_SIMPLEX
@@ -64,27 +88,47 @@ fontColor = (255,255,255)
 lineType = 2
 scale_percent = 250 # percent of original size
 
-fig = plt.figure()
+# review session parameters: number of faces rendered ahead of (and behind) the current one,
+# and whether to resume the previous session from its journal (if any)
+prefetch_window = 8
+resume_session = True
+journal_path = outputpath + 'database_culled_journal.jsonl'
 
+fig = plt.figure()
 
-# initialize index for determining which images to cull or keep
-cnt = 0
-cullindx = np.ones((N_data,))
+# render a face for display (run in the background by the prefetcher)
+def render_face(i):
+    face_pixels = np.asarray(X[indx[i],:,:,:])
+    width = int(face_pixels.shape[0] * scale_percent / 100)
+    height = int(face_pixels.shape[1] * scale_percent / 100)
+    resized_face = cv2.resize(face_pixels, (width, height), interpolation = cv2.INTER_AREA)
+    return np.ascontiguousarray(resized_face[:,:,[2,1,0]]) #BGR (not RGB) ordering of channels
+
+
+# initialize index for determining which images to cull or keep (every decision is journaled
+# to disk as it happens, and replayed when the session is resumed)
+journal = ReviewJournal(journal_path, pmrn_data.values, resume = resume_session)
+if journal.n_replayed:
+    print('Resuming session at record %d of %d (%d culled).' % (journal.position + 1, N_data,
+                                                               N_data - np.sum(journal.cullindx)))
+if journal.n_ignored:
+    print('WARNING: %d journal entries do not match the current dataset and were ignored.' % journal.n_ignored)
+cnt = journal.position
+cullindx = journal.cullindx
 continuing_to_review = True
 
+prefetcher = FacePrefetcher(render_face, N_data, window = prefetch_window)
+
 # Main Loop for reviewing/QA of images
 while continuing_to_review:
     #id_i = 'Visualizing file: %s' % sbrt_id[cnt]
-    face_pixels = testX[cnt,:,:,:]
-    face_image = Image.fromarray(face_pixels.astype(np.uint8))
-    width = int(face_pixels.shape[0] * scale_percent / 100)
-    height = int(face_pixels.shape[1] * scale_percent / 100)
-    resized_face = cv2.resize(face_pixels, (width, height), interpolation = cv2.INTER_AREA)
+    resized_face = prefetcher.get(cnt)
+    journal.view(cnt)
 
     fig.canvas.flush_events()
     #display the image
-    #cv2.imshow(id_i, resized_face[:, :, [2, 1, 0]])  # BGR (not RGB) ordering of channels
-    cv2.imshow('Visualizing Results', resized_face[:,:,[2,1,0]]) #BGR (not RGB) ordering of channels
+    #cv2.imshow(id_i, resized_face)
+    cv2.imshow('Visualizing Results', resized_face)
     #cv2.imshow('plot', img)
     cnt += 1
     if cnt > N_data-1:
@@ -97,14 +141,13 @@ while continuing_to_review:
         #Escape key (ascii value = 27) to terminate program and write selected images
         if np.sum(cullindx) < N_data:
             print('Writing culled dataset to file...')
-            culled_df = DF()
-            for i in range(N_data):
-                # if image not removed from dataset, add it to output file
-                if cullindx[i]:
-                    culled_df = culled_df.append(df_data.iloc[i])[df_data.columns.tolist()]
+            # only the images not removed from dataset are added to output file
+            culled_df = df_data[cullindx == 1]
             culled_df.to_csv(outputpath + 'database_culled.csv')
             print('Done.')
         continuing_to_review = False
+        prefetcher.close()
+        journal.close()
     # Arrow keys 'x1b[K' where '[A' = up '[B' = down '[C' = right '[D' = left
     #elif key == '\x1b[B' or key == '\x1b[D':
     #elif key == 81 or key == 84:  # up/down keys
@@ -115,12 +158,12 @@ while continuing_to_review:
     elif key == ord('c') or key == ord('C'):
         # cull image (i.e. remove from dataset)
         cnt = cnt - 1
-        cullindx[cnt] = 0
+        journal.cull(cnt)
         print('Culled record %d' % pmrn_data.iloc[cnt])
     elif key == 8:
         # undo cull
         cnt = cnt - 1
-        cullindx[cnt] = 1
+        journal.restore(cnt)
         print('Restored record %d' % pmrn_data.iloc[cnt])
     else:
         continue
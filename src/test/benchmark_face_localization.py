@@ -0,0 +1,307 @@
+# -----------------
+# Benchmark the face localization step of the FaceAge pipeline
+# (this script will parse the configuration file "config_predict_folder_demo.yaml")
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import gc
+import sys
+import time
+import yaml
+import argparse
+
+import mtcnn
+import tensorflow as tf
+
+# suppress warnings/errors due to migration from TensorFlow 1.x to 2.x
+tf.compat.v1.disable_eager_execution()
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+from skimage.io import imread
+
+# make the modules shared by the training and testing scripts (under "src/utils") importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.face_detection import FaceDetector, localize_face_list, read_image_bytes, detect_faces_in_bytes
+
+## ----------------------------------------
+
+def run_legacy_localization(path_list):
+
+  """
+  Localize the faces the way the pipeline used to, i.e., building a new MTCNN detector for
+  every image and tearing down the Keras session every 5 images.
+  Returns the list of the per-image latencies (in seconds).
+
+  @params:
+    path_list - required: list of absolute paths to the image files to be processed.
+
+  """
+
+  latency_list = list()
+
+  for idx, path_to_image in enumerate(path_list):
+
+    t = time.time()
+
+    pat_img = imread(path_to_image)
+
+    try:
+      mtcnn.mtcnn.MTCNN().detect_faces(pat_img)
+    except:
+      print('ERROR: Processing error for file "%s"'%(path_to_image))
+
+    if not idx % 5:
+      tf.keras.backend.clear_session()
+      gc.collect()
+
+    latency_list.append(time.time() - t)
+
+  return latency_list
+
+## ----------------------------------------
+
+def run_engine_localization(path_list):
+
+  """
+  Localize the faces using a single "FaceDetector" object shared across all the images.
+  Returns the list of the per-image latencies (in seconds), including the time needed
+  to load the MTCNN weights in the latency of the first image.
+
+  @params:
+    path_list - required: list of absolute paths to the image files to be processed.
+
+  """
+
+  latency_list = list()
+
+  t = time.time()
+  detector = FaceDetector()
+
+  for path_to_image in path_list:
+
+    pat_img = imread(path_to_image)
+
+    try:
+      detector.detect_faces(pat_img)
+    except:
+      print('ERROR: Processing error for file "%s"'%(path_to_image))
+
+    latency_list.append(time.time() - t)
+    t = time.time()
+
+  print(detector.get_latency_summary())
+
+  return latency_list
+
+## ----------------------------------------
+
+def run_reduced_decode_localization(path_list, decode_max_side):
+
+  """
+  Localize the faces using a single "FaceDetector" object, decoding the images at reduced
+  resolution before running the detector (see "detect_faces_in_bytes").
+  Returns the list of the per-image latencies (in seconds, decoding included), including the
+  time needed to load the MTCNN weights in the latency of the first image.
+
+  @params:
+    path_list - required: list of absolute paths to the image files to be processed.
+    decode_max_side - required: target size of the largest side of the decoded images.
+
+  """
+
+  latency_list = list()
+
+  t = time.time()
+  detector = FaceDetector(decode_max_side = decode_max_side)
+
+  for path_to_image in path_list:
+
+    try:
+      detect_faces_in_bytes(detector, read_image_bytes(path_to_image))
+    except:
+      print('ERROR: Processing error for file "%s"'%(path_to_image))
+
+    latency_list.append(time.time() - t)
+    t = time.time()
+
+  print(detector.get_latency_summary())
+
+  return latency_list
+
+## ----------------------------------------
+
+def run_sharded_localization(path_list, workers):
+
+  """
+  Localize the faces sharding the image list across the given number of worker processes
+  (see "localize_face_list"). Returns the total time (in seconds), including the time needed
+  to start the workers and load the MTCNN weights, and the time elapsed after the first result
+  was received (i.e., the steady state).
+
+  @params:
+    path_list - required: list of absolute paths to the image files to be processed.
+    workers - required: number of worker processes.
+
+  """
+
+  t = time.time()
+  t_first = None
+
+  for _ in localize_face_list(path_list, workers = workers):
+    if t_first is None:
+      t_first = time.time()
+
+  t_end = time.time()
+
+  return t_end - t, t_end - t_first
+
+## ----------------------------------------
+
+def print_latency_report(name, latency_list):
+
+  """
+  Print the total time, the mean per-image latency and the mean per-image latency
+  excluding the first image (i.e., the steady state).
+
+  @params:
+    name - required: name of the benchmarked configuration.
+    latency_list - required: list of the per-image latencies (in seconds).
+
+  """
+
+  total = sum(latency_list)
+  steady = latency_list[1:] if len(latency_list) > 1 else latency_list
+
+  print("%-24s total: %8.2f s | per image: %6.3f s | per image (steady state): %6.3f s"%(name,
+                                                                                        total,
+                                                                                        total / len(latency_list),
+                                                                                        sum(steady) / len(steady)))
+
+## ----------------------------------------
+## ----------------------------------------
+
+def main(config):
+
+  input_folder_path = config["input_folder_path"]
+  n_images = config["n_images"]
+  workers_list = config["workers_list"]
+  decode_max_side = config["decode_max_side"]
+
+  input_file_list = sorted([f for f in os.listdir(input_folder_path) if ".png" in f or ".jpg" in f])
+  input_file_list = input_file_list[:n_images]
+
+  path_list = [os.path.join(input_folder_path, f) for f in input_file_list]
+
+  print("Benchmarking the face localization step on %g images at: '%s'\n"%(len(path_list),
+                                                                          input_folder_path))
+
+  legacy_latency_list = run_legacy_localization(path_list)
+
+  tf.keras.backend.clear_session()
+  gc.collect()
+
+  engine_latency_list = run_engine_localization(path_list)
+
+  if decode_max_side:
+    reduced_latency_list = run_reduced_decode_localization(path_list, decode_max_side)
+
+  print("")
+  print_latency_report("Before (MTCNN per image)", legacy_latency_list)
+  print_latency_report("After (shared detector)", engine_latency_list)
+
+  if decode_max_side:
+    print_latency_report("After (reduced decode)", reduced_latency_list)
+
+  if not workers_list:
+    return
+
+  # ------------------------
+
+  print("\nBenchmarking the sharded face localization step (workers: %s)\n"%(workers_list))
+
+  time_dict = dict()
+
+  for workers in workers_list:
+    time_dict[workers] = run_sharded_localization(path_list, workers)
+
+  baseline_total, baseline_steady = time_dict[workers_list[0]]
+
+  for workers in workers_list:
+    total, steady = time_dict[workers]
+    print("%2g worker(s) - total: %8.2f s (speedup: %5.2fx) | steady state: %8.2f s (speedup: %5.2fx)"%(workers,
+                                                                                                        total,
+                                                                                                        baseline_total / total,
+                                                                                                        steady,
+                                                                                                        baseline_steady / steady))
+
+## ----------------------------------------
+## ----------------------------------------
+
+if __name__ == '__main__':
+
+  base_conf_file_path = '.'
+
+  parser = argparse.ArgumentParser(description = 'FaceAge - face localization benchmark')
+
+  parser.add_argument('--conf',
+                      required = False,
+                      help = 'Specify the path to the YAML configuration file containing the run details.',
+                      default = "config_predict_folder_demo.yaml"
+                     )
+
+  parser.add_argument('--n_images',
+                      required = False,
+                      type = int,
+                      help = 'Number of images (from the input folder) to run the benchmark on.',
+                      default = 50
+                     )
+
+  parser.add_argument('--workers_list',
+                      required = False,
+                      help = 'Comma-separated list of numbers of worker processes to run the scaling benchmark with (e.g., "1,2,4,8").',
+                      default = ""
+                     )
+
+  parser.add_argument('--decode_max_side',
+                      required = False,
+                      type = int,
+                      help = 'Also benchmark the detection on images decoded at reduced resolution (largest side as close as possible to this value).',
+                      default = 0
+                     )
+
+  args = parser.parse_args()
+
+  conf_file_path = os.path.join(base_conf_file_path, args.conf)
+
+  with open(conf_file_path) as f:
+    yaml_conf = yaml.load(f, Loader = yaml.FullLoader)
+
+  base_path = yaml_conf["test"]["base_path"]
+  data_folder_name = yaml_conf["test"]["data_folder_name"]
+  input_folder_name = yaml_conf["test"]["input_folder_name"]
+
+  config = dict()
+
+  config["input_folder_path"] = os.path.join(base_path, data_folder_name, input_folder_name)
+  config["n_images"] = args.n_images
+  config["workers_list"] = [int(w) for w in args.workers_list.split(",") if w.strip()]
+  config["decode_max_side"] = args.decode_max_side
+
+  main(config)
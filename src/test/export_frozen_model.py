@@ -0,0 +1,205 @@
+# -----------------
+# Export the FaceAge model to a frozen inference artifact, and check its numerical parity with the
+# Keras model on a sample of the UTK dataset
+# (this script will parse the configuration file "config_predict_folder_demo.yaml")
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import sys
+import time
+import yaml
+import argparse
+
+import keras
+import numpy as np
+import tensorflow as tf
+
+# the export requires eager execution (unlike "predict_folder_demo.py")
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+# make the modules shared by the training and testing scripts (under "src/utils") importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.face_detection import FaceDetector, localize_face_list
+from utils.preprocessing import standardize
+from utils.inference_model import export_frozen_model, FrozenModel
+
+## ----------------------------------------
+
+def get_sample_faces(input_folder_path, n_images):
+
+  """
+  Localise and crop the faces of the first "n_images" images of the given folder.
+  Returns the array storing the standardized faces (images without a face are skipped).
+
+  @params:
+    input_folder_path - required: absolute path to the folder storing the images.
+    n_images - required: number of images to be processed.
+
+  """
+
+  input_file_list = sorted([f for f in os.listdir(input_folder_path) if ".png" in f or ".jpg" in f])
+  path_list = [os.path.join(input_folder_path, f) for f in input_file_list[:n_images]]
+
+  face_list = [pat_face for _, _, pat_face, _ in localize_face_list(path_list, FaceDetector())
+               if pat_face is not None]
+
+  return standardize(np.stack(face_list), in_place = True)
+
+## ----------------------------------------
+
+def time_predict(model, faces, batch_size, n_runs):
+
+  """
+  Returns the median time (in seconds) needed to process a batch of faces.
+
+  @params:
+    model - required: the model to be benchmarked (any object exposing "predict").
+    faces - required: array storing the standardized faces.
+    batch_size - required: number of faces per batch.
+    n_runs - required: number of timed runs.
+
+  """
+
+  batch = faces[:batch_size]
+
+  # the first call builds (and optimizes) the graph - not timed
+  model.predict(batch, batch_size = len(batch))
+
+  time_list = list()
+
+  for _ in range(n_runs):
+    t = time.time()
+    model.predict(batch, batch_size = len(batch))
+    time_list.append(time.time() - t)
+
+  return float(np.median(time_list))
+
+## ----------------------------------------
+## ----------------------------------------
+
+def main(config):
+
+  model_path = config["model_path"]
+  input_folder_path = config["input_folder_path"]
+
+  n_images = config["n_images"]
+  batch_size = config["batch_size"]
+  atol = config["atol"]
+
+  print("Exporting the frozen model from: '%s'... "%(model_path), end = "")
+
+  t = time.time()
+  graph_path, meta_path = export_frozen_model(model_path)
+
+  print("Done in %g seconds ('%s')."%(time.time() - t, graph_path))
+
+  if not n_images:
+    return
+
+  print("\nChecking the parity with the Keras model on %g images at: '%s'\n"%(n_images, input_folder_path))
+
+  faces = get_sample_faces(input_folder_path, n_images)
+
+  t = time.time()
+  keras_model = keras.models.load_model(model_path)
+  keras_load_time = time.time() - t
+
+  t = time.time()
+  frozen_model = FrozenModel(graph_path, meta_path)
+  frozen_load_time = time.time() - t
+
+  keras_pred = np.reshape(keras_model.predict(faces, batch_size = batch_size), (-1, ))
+  frozen_pred = np.reshape(frozen_model.predict(faces, batch_size = batch_size), (-1, ))
+
+  max_diff = float(np.max(np.abs(keras_pred - frozen_pred)))
+
+  keras_batch_time = time_predict(keras_model, faces, batch_size, config["n_runs"])
+  frozen_batch_time = time_predict(frozen_model, faces, batch_size, config["n_runs"])
+
+  print("%-8s load: %7.3f s | batch of %g faces: %7.4f s"%("Keras", keras_load_time, batch_size, keras_batch_time))
+  print("%-8s load: %7.3f s | batch of %g faces: %7.4f s"%("Frozen", frozen_load_time, batch_size, frozen_batch_time))
+
+  print("\nMaximum absolute difference over %g faces: %g years (tolerance: %g)."%(len(faces), max_diff, atol))
+
+  if max_diff > atol:
+    sys.exit("ERROR: the frozen model does not match the Keras model.")
+
+## ----------------------------------------
+## ----------------------------------------
+
+if __name__ == '__main__':
+
+  base_conf_file_path = '.'
+
+  parser = argparse.ArgumentParser(description = 'FaceAge - frozen model export')
+
+  parser.add_argument('--conf',
+                      required = False,
+                      help = 'Specify the path to the YAML configuration file containing the run details.',
+                      default = "config_predict_folder_demo.yaml"
+                     )
+
+  parser.add_argument('--n_images',
+                      required = False,
+                      type = int,
+                      help = 'Number of images (from the input folder) to check the parity on (0 to skip the check).',
+                      default = 64
+                     )
+
+  parser.add_argument('--n_runs',
+                      required = False,
+                      type = int,
+                      help = 'Number of timed runs of the per-batch latency benchmark.',
+                      default = 10
+                     )
+
+  parser.add_argument('--atol',
+                      required = False,
+                      type = float,
+                      help = 'Maximum absolute difference (in years) allowed between the Keras and the frozen model.',
+                      default = 1e-3
+                     )
+
+  args = parser.parse_args()
+
+  conf_file_path = os.path.join(base_conf_file_path, args.conf)
+
+  with open(conf_file_path) as f:
+    yaml_conf = yaml.load(f, Loader = yaml.FullLoader)
+
+  base_path = yaml_conf["test"]["base_path"]
+  data_folder_name = yaml_conf["test"]["data_folder_name"]
+  input_folder_name = yaml_conf["test"]["input_folder_name"]
+
+  model_name = yaml_conf["test"]["model_name"]
+  models_folder_name = yaml_conf["test"]["models_folder_name"]
+
+  config = dict()
+
+  config["model_path"] = os.path.join(base_path, models_folder_name,
+                                      model_name + ".h5" if model_name.split(".")[-1] != "h5" else model_name)
+  config["input_folder_path"] = os.path.join(base_path, data_folder_name, input_folder_name)
+
+  config["n_images"] = args.n_images
+  config["n_runs"] = args.n_runs
+  config["batch_size"] = yaml_conf["test"].get("batch_size", 32)
+  config["atol"] = args.atol
+
+  main(config)
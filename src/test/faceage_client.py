@@ -0,0 +1,550 @@
+# -----------------
+# Asynchronous bulk client of the FaceAge inference service (see "faceage_server.py"): stream all
+# the images of a folder to the service, with bounded concurrency, and write the results incrementally
+# (this script will parse the configuration file "config_predict_folder_demo.yaml")
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+# The images are read by a pool of threads (so that the event loop is never blocked by the disk),
+# grouped into "/predict_batch" requests, and sent over a few persistent (keep-alive) connections.
+# The queue between the readers and the connections is bounded: the client never reads more images
+# than the service can absorb. Failed requests are retried with exponential backoff; the images
+# still failing afterwards are listed in "<output>_failed.txt".
+
+import os
+import sys
+import json
+import time
+import yaml
+import base64
+import asyncio
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor
+
+## ----------------------------------------
+
+class ServiceError(Exception):
+
+  """
+  Error returned by the service. Retrying the request is pointless unless "retryable" is True.
+
+  """
+
+  def __init__(self, message, retryable = True):
+
+    Exception.__init__(self, message)
+    self.retryable = retryable
+
+## ----------------------------------------
+
+class ServiceConnection(object):
+
+  """
+  Persistent (keep-alive) HTTP/1.1 connection to the FaceAge service, over TCP or Unix socket.
+  The connection is (re-)opened lazily, e.g., after the service closed it.
+
+  @params:
+    host - required: address of the service (ignored if "unix_socket" is set).
+    port - required: port of the service (ignored if "unix_socket" is set).
+    unix_socket - optional: path to the Unix socket the service listens on.
+    timeout - optional: maximum time (in seconds) to wait for a response.
+
+  """
+
+  def __init__(self, host, port, unix_socket = "", timeout = 300.):
+
+    self.host = host
+    self.port = port
+    self.unix_socket = unix_socket
+    self.timeout = timeout
+
+    self.reader = None
+    self.writer = None
+
+  ## ----------------------------------------
+
+  async def _open(self):
+
+    if self.unix_socket:
+      self.reader, self.writer = await asyncio.open_unix_connection(self.unix_socket)
+    else:
+      self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+  def close(self):
+
+    if self.writer is not None:
+      self.writer.close()
+
+    self.reader, self.writer = None, None
+
+  ## ----------------------------------------
+
+  async def _read_response(self):
+
+    status_line = await self.reader.readline()
+
+    if not status_line:
+      raise ConnectionError("connection closed by the service")
+
+    status = int(status_line.split()[1])
+
+    header_dict = dict()
+
+    while True:
+      line = await self.reader.readline()
+
+      if line in (b"\r\n", b"\n", b""):
+        break
+
+      name, _, value = line.decode("latin-1").partition(":")
+      header_dict[name.strip().lower()] = value.strip()
+
+    body = await self.reader.readexactly(int(header_dict.get("content-length", 0)))
+
+    if header_dict.get("connection", "").lower() == "close":
+      self.close()
+
+    return status, body
+
+  ## ----------------------------------------
+
+  async def post(self, path, body):
+
+    """
+    Send a POST request (JSON body) and return the decoded JSON response.
+
+    @params:
+      path - required: the endpoint (e.g., "/predict_batch").
+      body - required: the (encoded) JSON body of the request.
+
+    """
+
+    if self.writer is None:
+      await self._open()
+
+    request = ("POST %s HTTP/1.1\r\n"
+               "Host: %s\r\n"
+               "Content-Type: application/json\r\n"
+               "Content-Length: %d\r\n"
+               "\r\n"%(path, self.host, len(body))).encode("latin-1")
+
+    try:
+      self.writer.write(request)
+      self.writer.write(body)
+      await self.writer.drain()
+
+      status, response = await asyncio.wait_for(self._read_response(), self.timeout)
+    except:
+      # the state of the connection is unknown - start from a fresh one
+      self.close()
+      raise
+
+    if status != 200:
+      # malformed or oversized requests fail again if retried
+      raise ServiceError("HTTP %d: %s"%(status, response[:200]), retryable = status >= 500)
+
+    return json.loads(response.decode("utf-8"))
+
+## ----------------------------------------
+
+class ResultWriter(object):
+
+  """
+  Write the results to a ".csv" file (same "subj_id,faceage" schema as "predict_folder_demo.py")
+  as they arrive, flushing after every batch - so that the results survive an interrupted run.
+
+  @params:
+    outfile_path - required: path to the output ".csv" file.
+    append - optional: if True, the results are appended to an existing file.
+
+  """
+
+  def __init__(self, outfile_path, append = False):
+
+    append = append and os.path.exists(outfile_path)
+
+    self.f = open(outfile_path, 'a' if append else 'w')
+
+    if not append:
+      self.f.write("subj_id,faceage\n")
+
+  def write(self, row_list):
+
+    for subj_id, faceage in row_list:
+      self.f.write("%s,%r\n"%(subj_id, faceage))
+
+    self.f.flush()
+
+  def close(self):
+
+    self.f.close()
+
+## ----------------------------------------
+
+def read_scored_subjects(outfile_path):
+
+  """
+  Returns the set of the subjects already listed in the given output ".csv" file (if any).
+
+  @params:
+    outfile_path - required: path to the output ".csv" file.
+
+  """
+
+  if not os.path.exists(outfile_path):
+    return set()
+
+  with open(outfile_path) as f:
+    next(f, None)
+
+    return set(line.split(",")[0] for line in f if "," in line)
+
+## ----------------------------------------
+
+def read_file(path_to_file):
+
+  with open(path_to_file, 'rb') as f:
+    return f.read()
+
+## ----------------------------------------
+## ----------------------------------------
+
+class BulkScorer(object):
+
+  """
+  Score all the given images against the FaceAge service.
+
+  @params:
+    config - required: dictionary storing the run configuration (see "main").
+    path_list - required: list of absolute paths to the image files to be processed.
+    writer - required: the "ResultWriter" object the results are written to.
+    loop - required: the asyncio event loop.
+
+  """
+
+  def __init__(self, config, path_list, writer, loop):
+
+    self.config = config
+    self.path_list = path_list
+    self.writer = writer
+    self.loop = loop
+
+    # the images read ahead of the connections are bounded by the size of the queue
+    self.request_queue = asyncio.Queue(maxsize = config["queue_size"])
+
+    # bounds the number of files being read at once
+    self.read_semaphore = asyncio.Semaphore(config["read_threads"])
+    self.executor = ThreadPoolExecutor(max_workers = config["read_threads"])
+
+    self.n_scored = 0
+    self.n_no_face = 0
+    self.failed_list = list()
+
+    self.t_start = None
+
+  ## ----------------------------------------
+
+  async def _read_image(self, path_to_image):
+
+    async with self.read_semaphore:
+      try:
+        return await self.loop.run_in_executor(self.executor, read_file, path_to_image)
+      except (IOError, OSError) as e:
+        self.failed_list.append((path_to_image, "could not read the file (%s)"%(e)))
+        return None
+
+  async def _produce(self):
+
+    images_per_request = self.config["images_per_request"]
+
+    for start in range(0, len(self.path_list), images_per_request):
+      group = self.path_list[start:start + images_per_request]
+      data_list = await asyncio.gather(*[self._read_image(p) for p in group])
+
+      item = [(p, data) for p, data in zip(group, data_list) if data is not None]
+
+      # blocks while the connections are lagging behind (backpressure)
+      if item:
+        await self.request_queue.put(item)
+
+    for _ in range(self.config["connections"]):
+      await self.request_queue.put(None)
+
+  ## ----------------------------------------
+
+  async def _score(self, connection, item):
+
+    body = json.dumps({"images": [{"id": os.path.basename(p).split(".")[0],
+                                   "data": base64.b64encode(data).decode("ascii")} for p, data in item]}).encode("utf-8")
+
+    n_retries = self.config["retries"]
+
+    for attempt in range(n_retries + 1):
+      try:
+        response = await connection.post("/predict_batch", body)
+        result_list = response.get("results") if isinstance(response, dict) else None
+
+        # one result (storing the image ID and the FaceAge estimate) per image is expected
+        if (not isinstance(result_list, list) or len(result_list) != len(item)
+            or not all(isinstance(result, dict) and "id" in result and "faceage" in result for result in result_list)):
+          raise ServiceError("malformed response: %s"%(json.dumps(response)[:200]), retryable = False)
+
+        return result_list
+      except (ServiceError, ConnectionError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+        if attempt == n_retries or not getattr(e, "retryable", True):
+          for p, _ in item:
+            self.failed_list.append((p, str(e)))
+          return None
+
+        await asyncio.sleep(self.config["retry_backoff"] * 2**attempt)
+
+  async def _consume(self):
+
+    connection = ServiceConnection(self.config["host"], self.config["port"], self.config["unix_socket"],
+                                   self.config["timeout"])
+
+    try:
+      while True:
+        item = await self.request_queue.get()
+
+        if item is None:
+          return
+
+        result_list = await self._score(connection, item)
+
+        if result_list is None:
+          continue
+
+        # images in which no face could be localised are excluded from the output
+        row_list = [(result["id"], result["faceage"]) for result in result_list if result["faceage"] is not None]
+
+        self.writer.write(row_list)
+
+        self.n_scored += len(row_list)
+        self.n_no_face += len(result_list) - len(row_list)
+
+        elapsed = time.time() - self.t_start
+        n_done = self.n_scored + self.n_no_face + len(self.failed_list)
+
+        print('(%g/%g) Images scored (%.1f images per second)'%(n_done, len(self.path_list), n_done / elapsed), end = "\r")
+    finally:
+      connection.close()
+
+  ## ----------------------------------------
+
+  async def run(self):
+
+    """
+    Run the readers and the connections until all the images are processed.
+
+    """
+
+    self.t_start = time.time()
+
+    try:
+      await asyncio.gather(self._produce(),
+                           *[self._consume() for _ in range(self.config["connections"])])
+    finally:
+      self.executor.shutdown()
+
+## ----------------------------------------
+## ----------------------------------------
+
+def main(config):
+
+  input_folder_path = config["input_folder_path"]
+  outfile_path = config["outfile_path"]
+
+  # the results of a previous run are never discarded silently
+  if os.path.exists(outfile_path) and not config["resume"] and not config["overwrite"]:
+    sys.exit("ERROR: '%s' exists already - pass '--resume' to append to it, or '--overwrite' to replace it."%(outfile_path))
+
+  input_file_list = sorted([f for f in os.listdir(input_folder_path) if ".png" in f or ".jpg" in f])
+
+  # when resuming, the subjects already in the output file are not scored again
+  scored_subj_set = read_scored_subjects(outfile_path) if config["resume"] else set()
+  input_file_list = [f for f in input_file_list if f.split(".")[0] not in scored_subj_set]
+
+  print("Scoring %g images at: '%s' (%g already scored)\n"%(len(input_file_list), input_folder_path, len(scored_subj_set)))
+
+  path_list = [os.path.join(input_folder_path, f) for f in input_file_list]
+
+  writer = ResultWriter(outfile_path, append = config["resume"])
+
+  # no "asyncio.run" (Python 3.7+)
+  loop = asyncio.get_event_loop()
+
+  scorer = BulkScorer(config, path_list, writer, loop)
+
+  try:
+    loop.run_until_complete(scorer.run())
+  finally:
+    writer.close()
+
+  elapsed = time.time() - scorer.t_start
+
+  print("\n... Done in %g seconds: %g images scored, %g without a face, %g failed."%(elapsed,
+                                                                                   scorer.n_scored,
+                                                                                   scorer.n_no_face,
+                                                                                   len(scorer.failed_list)))
+
+  print("Results saved at: '%s'."%(outfile_path))
+
+  if scorer.failed_list:
+    failed_path = os.path.splitext(outfile_path)[0] + "_failed.txt"
+
+    with open(failed_path, 'w') as f:
+      for path_to_image, error in scorer.failed_list:
+        f.write("%s\t%s\n"%(path_to_image, error))
+
+    print("Failed images listed at: '%s'."%(failed_path))
+
+## ----------------------------------------
+## ----------------------------------------
+
+if __name__ == '__main__':
+
+  base_conf_file_path = '.'
+
+  parser = argparse.ArgumentParser(description = 'FaceAge - inference service bulk client')
+
+  parser.add_argument('--conf',
+                      required = False,
+                      help = 'Specify the path to the YAML configuration file containing the run details.',
+                      default = "config_predict_folder_demo.yaml"
+                     )
+
+  parser.add_argument('--input_folder',
+                      required = False,
+                      help = 'Path to the folder storing the images to be scored (by default, the input folder of the YAML configuration).',
+                      default = ""
+                     )
+
+  parser.add_argument('--output',
+                      required = False,
+                      help = 'Path to the output .csv file (by default, "${input_folder_name}_service_res.csv" in the outputs folder).',
+                      default = ""
+                     )
+
+  parser.add_argument('--host',
+                      required = False,
+                      help = 'Address of the service.',
+                      default = "127.0.0.1"
+                     )
+
+  parser.add_argument('--port',
+                      required = False,
+                      type = int,
+                      help = 'Port of the service.',
+                      default = 8080
+                     )
+
+  parser.add_argument('--unix_socket',
+                      required = False,
+                      help = 'Path to the Unix socket the service listens on (instead of a TCP port).',
+                      default = ""
+                     )
+
+  parser.add_argument('--connections',
+                      required = False,
+                      type = int,
+                      help = 'Number of requests in flight at once (one keep-alive connection each).',
+                      default = 4
+                     )
+
+  parser.add_argument('--images_per_request',
+                      required = False,
+                      type = int,
+                      help = 'Number of images sent in each request.',
+                      default = 8
+                     )
+
+  parser.add_argument('--queue_size',
+                      required = False,
+                      type = int,
+                      help = 'Maximum number of requests read ahead of the connections.',
+                      default = 16
+                     )
+
+  parser.add_argument('--read_threads',
+                      required = False,
+                      type = int,
+                      help = 'Number of threads reading the image files.',
+                      default = 8
+                     )
+
+  parser.add_argument('--retries',
+                      required = False,
+                      type = int,
+                      help = 'Number of times a failed request is retried.',
+                      default = 3
+                     )
+
+  parser.add_argument('--timeout',
+                      required = False,
+                      type = float,
+                      help = 'Maximum time (in seconds) to wait for a response.',
+                      default = 300.
+                     )
+
+  parser.add_argument('--resume',
+                      required = False,
+                      action = 'store_true',
+                      help = 'Append to the output file, skipping the subjects already listed in it.'
+                     )
+
+  parser.add_argument('--overwrite',
+                      required = False,
+                      action = 'store_true',
+                      help = 'Replace the output file, if it exists already.'
+                     )
+
+  args = parser.parse_args()
+
+  conf_file_path = os.path.join(base_conf_file_path, args.conf)
+
+  with open(conf_file_path) as f:
+    yaml_conf = yaml.load(f, Loader = yaml.FullLoader)
+
+  base_path = yaml_conf["test"]["base_path"]
+  data_folder_name = yaml_conf["test"]["data_folder_name"]
+  input_folder_name = yaml_conf["test"]["input_folder_name"]
+  outputs_folder_name = yaml_conf["test"]["outputs_folder_name"]
+
+  config = dict()
+
+  config["input_folder_path"] = args.input_folder if args.input_folder else os.path.join(base_path, data_folder_name, input_folder_name)
+
+  # not the output file of "predict_folder_demo.py" (used, e.g., as reference by "quantize_model.py")
+  output_name = '%s_service_res.csv'%(os.path.basename(os.path.normpath(config["input_folder_path"])))
+  config["outfile_path"] = args.output if args.output else os.path.join(base_path, outputs_folder_name, output_name)
+
+  config["host"] = args.host
+  config["port"] = args.port
+  config["unix_socket"] = args.unix_socket
+
+  config["connections"] = args.connections
+  config["images_per_request"] = args.images_per_request
+  config["queue_size"] = args.queue_size
+  config["read_threads"] = args.read_threads
+  config["retries"] = args.retries
+  config["retry_backoff"] = 0.5
+  config["timeout"] = args.timeout
+  config["resume"] = args.resume
+  config["overwrite"] = args.overwrite
+
+  main(config)
@@ -0,0 +1,407 @@
+# -----------------
+# Long-running FaceAge inference service (local HTTP server, over TCP or Unix socket), keeping the
+# MTCNN detector and the FaceAge model resident and coalescing concurrent requests into micro-batches
+# (this script will parse the configuration file "config_predict_folder_demo.yaml")
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+# Endpoints (all the responses are JSON documents):
+#   - "GET /health": status of the service, and number of requests and batches processed;
+#   - "POST /predict": the body is the raw content of an image file (.jpg or .png); returns
+#     {"faceage": ..., "box": [x, y, width, height], "confidence": ...};
+#   - "POST /predict_batch": the body is a JSON document {"images": [{"id": ..., "data": ...}, ...]},
+#     where "data" is the base64-encoded content of the image file; returns {"results": [...]},
+#     one result (as above, plus the "id") per image.
+# Images in which no face could be localised get a null "faceage" and an "error" message.
+
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import sys
+import json
+import yaml
+import base64
+import argparse
+import threading
+import socketserver
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import tensorflow as tf
+
+# suppress warnings/errors due to migration from TensorFlow 1.x to 2.x
+tf.compat.v1.disable_eager_execution()
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+# make the modules shared by the training and testing scripts (under "src/utils") importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.face_detection import FaceDetector, detect_faces_in_bytes, get_face_crop, get_face_crop_from_bytes
+from utils.preprocessing import standardize
+from utils.inference_model import load_faceage_model
+from utils.micro_batcher import MicroBatcher
+
+## ----------------------------------------
+
+class FaceAgeService(object):
+
+  """
+  FaceAge pipeline shared by all the request handler threads: the MTCNN detector is not
+  thread-safe, and is run by one thread at a time; the crops are handed to a "MicroBatcher",
+  which runs the FaceAge model on batches of crops coming from concurrent requests.
+
+  @params:
+    model_path - required: absolute path to the FaceAge model file.
+    max_batch_size - optional: maximum number of faces processed by the FaceAge model at once.
+    max_batch_wait - optional: maximum time (in seconds) a face waits for more faces to be batched with.
+    prefer_frozen_model - optional: load the frozen inference artifact, if available (see "load_faceage_model").
+    decode_max_side - optional: reduced decoding resolution of the images processed by the detector (see "FaceDetector").
+
+  """
+
+  def __init__(self, model_path, max_batch_size = 32, max_batch_wait = 0.01, prefer_frozen_model = True,
+               decode_max_side = 0):
+
+    self.detector = FaceDetector(decode_max_side = decode_max_side)
+    self.model = load_faceage_model(model_path, prefer_frozen_model)
+
+    # the Keras session is thread-local: the detector and the model are always run
+    # in the session their weights were loaded into
+    self.graph = tf.compat.v1.get_default_graph()
+    self.session = tf.compat.v1.keras.backend.get_session()
+
+    self.detector_lock = threading.Lock()
+
+    self.batcher = MicroBatcher(self._predict_batch, max_batch_size, max_batch_wait)
+
+  ## ----------------------------------------
+
+  def _predict_batch(self, face_list):
+
+    with self.graph.as_default():
+      tf.compat.v1.keras.backend.set_session(self.session)
+
+      faces = standardize(np.stack(face_list), in_place = True)
+
+      return [float(faceage) for faceage in np.reshape(self.model.predict(faces, batch_size = len(faces)), (-1, ))]
+
+  ## ----------------------------------------
+
+  def _localize_face(self, image_bytes):
+
+    # only the detection is serialized - the image is decoded outside of the lock
+    # (at reduced resolution, if requested - see "detect_faces_in_bytes")
+    with self.graph.as_default():
+      tf.compat.v1.keras.backend.set_session(self.session)
+      detections, pat_img = detect_faces_in_bytes(self.detector, image_bytes, lock = self.detector_lock)
+
+    if not detections:
+      return None, None
+
+    if pat_img is not None:
+      return detections[0], get_face_crop(pat_img, detections[0])
+
+    # the face is cropped from a resolution at which it is at least as large as the crop
+    return detections[0], get_face_crop_from_bytes(image_bytes, detections[0])
+
+  ## ----------------------------------------
+
+  def predict(self, image_bytes_list):
+
+    """
+    Run the FaceAge pipeline on the given images. The faces are localised one image at a time,
+    and all the crops are submitted to the model before waiting for the results (so that they
+    can be processed in the same batch).
+    Returns a list storing a dictionary with the FaceAge estimate, the bounding box and the
+    detection confidence for each image.
+
+    @params:
+      image_bytes_list - required: list of the raw contents of the image files to be processed.
+
+    """
+
+    result_list = list()
+    future_list = list()
+
+    for image_bytes in image_bytes_list:
+      try:
+        mtcnn_output_dict, pat_face = self._localize_face(image_bytes)
+      except Exception as e:
+        result_list.append({"faceage": None, "box": None, "confidence": None,
+                            "error": "could not process the image (%s)"%(e)})
+        future_list.append(None)
+        continue
+
+      if pat_face is None:
+        result_list.append({"faceage": None, "box": None, "confidence": None, "error": "no face found"})
+        future_list.append(None)
+        continue
+
+      result_list.append({"faceage": None,
+                          "box": [int(v) for v in mtcnn_output_dict["box"]],
+                          "confidence": float(mtcnn_output_dict["confidence"])})
+      future_list.append(self.batcher.submit(pat_face))
+
+    for result, future in zip(result_list, future_list):
+      if future is not None:
+        result["faceage"] = future.result()
+
+    return result_list
+
+  ## ----------------------------------------
+
+  def close(self):
+
+    self.batcher.close()
+
+## ----------------------------------------
+
+class FaceAgeRequestHandler(BaseHTTPRequestHandler):
+
+  # keep the connections alive, so that clients can send several requests over the same connection
+  protocol_version = "HTTP/1.1"
+
+  def address_string(self):
+
+    # Unix socket clients have no address
+    return self.client_address[0] if self.client_address else "unix-socket"
+
+  def log_message(self, format, *args):
+
+    if not self.server.quiet:
+      BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  ## ----------------------------------------
+
+  def _send_json(self, status, obj):
+
+    body = json.dumps(obj).encode("utf-8")
+
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _read_body(self):
+
+    content_length = int(self.headers.get("Content-Length", 0))
+
+    if content_length > self.server.max_body_size:
+      # the body is not read - the connection can not be reused
+      self.close_connection = True
+      return None
+
+    return self.rfile.read(content_length)
+
+  ## ----------------------------------------
+
+  def do_GET(self):
+
+    if self.path != "/health":
+      self._send_json(404, {"error": "unknown endpoint: %s"%(self.path)})
+      return
+
+    self._send_json(200, dict(status = "ok", **self.server.service.batcher.get_stats()))
+
+  ## ----------------------------------------
+
+  def do_POST(self):
+
+    if self.path not in ("/predict", "/predict_batch"):
+      self._send_json(404, {"error": "unknown endpoint: %s"%(self.path)})
+      return
+
+    body = self._read_body()
+
+    if body is None:
+      self._send_json(413, {"error": "request body larger than %g bytes"%(self.server.max_body_size)})
+      return
+
+    if self.path == "/predict":
+      image_list = [dict()]
+      image_bytes_list = [body]
+    else:
+      try:
+        image_list = json.loads(body.decode("utf-8"))["images"]
+        image_bytes_list = [base64.b64decode(image["data"]) for image in image_list]
+      except (ValueError, KeyError, TypeError) as e:
+        self._send_json(400, {"error": "malformed request (%s)"%(e)})
+        return
+
+    try:
+      result_list = self.server.service.predict(image_bytes_list)
+    except Exception as e:
+      self._send_json(500, {"error": "the FaceAge model failed (%s)"%(e)})
+      return
+
+    if self.path == "/predict":
+      self._send_json(200, result_list[0])
+      return
+
+    for image, result in zip(image_list, result_list):
+      result["id"] = image.get("id")
+
+    self._send_json(200, {"results": result_list})
+
+## ----------------------------------------
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+
+  # every connection is served in its own thread
+  daemon_threads = True
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+  daemon_threads = True
+
+## ----------------------------------------
+## ----------------------------------------
+
+def main(config):
+
+  print("Loading the MTCNN detector and the FaceAge model from: '%s'... "%(config["model_path"]), end = "")
+
+  service = FaceAgeService(config["model_path"], config["max_batch_size"], config["max_batch_wait"],
+                           config["prefer_frozen_model"], config["decode_max_side"])
+
+  print("Done.")
+
+  unix_socket = config["unix_socket"]
+
+  if unix_socket:
+    # a stale socket file (e.g., left by a killed server) would make the bind fail
+    if os.path.exists(unix_socket):
+      os.remove(unix_socket)
+
+    server = ThreadingUnixHTTPServer(unix_socket, FaceAgeRequestHandler)
+    address = "unix:%s"%(unix_socket)
+  else:
+    server = ThreadingHTTPServer((config["host"], config["port"]), FaceAgeRequestHandler)
+    address = "http://%s:%g"%(config["host"], config["port"])
+
+  server.service = service
+  server.max_body_size = config["max_body_size"]
+  server.quiet = config["quiet"]
+
+  print("Serving FaceAge at: %s (batches of up to %g faces, waiting at most %g seconds)"%(address,
+                                                                                        config["max_batch_size"],
+                                                                                        config["max_batch_wait"]))
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    service.close()
+
+    if unix_socket and os.path.exists(unix_socket):
+      os.remove(unix_socket)
+
+    print("\nService stopped (%s)."%(service.batcher.get_stats()))
+
+## ----------------------------------------
+## ----------------------------------------
+
+if __name__ == '__main__':
+
+  base_conf_file_path = '.'
+
+  parser = argparse.ArgumentParser(description = 'FaceAge - inference service')
+
+  parser.add_argument('--conf',
+                      required = False,
+                      help = 'Specify the path to the YAML configuration file containing the run details.',
+                      default = "config_predict_folder_demo.yaml"
+                     )
+
+  parser.add_argument('--host',
+                      required = False,
+                      help = 'Address the service listens on (only local clients by default).',
+                      default = "127.0.0.1"
+                     )
+
+  parser.add_argument('--port',
+                      required = False,
+                      type = int,
+                      help = 'Port the service listens on.',
+                      default = 8080
+                     )
+
+  parser.add_argument('--unix_socket',
+                      required = False,
+                      help = 'Path to a Unix socket to listen on (instead of a TCP port).',
+                      default = ""
+                     )
+
+  parser.add_argument('--max_batch_size',
+                      required = False,
+                      type = int,
+                      help = 'Maximum number of faces processed by the FaceAge model at once (by default, "batch_size" from the YAML configuration).',
+                      default = None
+                     )
+
+  parser.add_argument('--max_batch_wait',
+                      required = False,
+                      type = float,
+                      help = 'Maximum time (in seconds) a face waits for more faces to be batched with.',
+                      default = 0.01
+                     )
+
+  parser.add_argument('--max_body_size',
+                      required = False,
+                      type = int,
+                      help = 'Maximum size (in bytes) of a request body.',
+                      default = 64 << 20
+                     )
+
+  parser.add_argument('--quiet',
+                      required = False,
+                      action = 'store_true',
+                      help = 'Do not log every request.'
+                     )
+
+  args = parser.parse_args()
+
+  conf_file_path = os.path.join(base_conf_file_path, args.conf)
+
+  with open(conf_file_path) as f:
+    yaml_conf = yaml.load(f, Loader = yaml.FullLoader)
+
+  base_path = yaml_conf["test"]["base_path"]
+
+  model_name = yaml_conf["test"]["model_name"]
+  models_folder_name = yaml_conf["test"]["models_folder_name"]
+
+  config = dict()
+
+  config["model_path"] = os.path.join(base_path, models_folder_name,
+                                      model_name + ".h5" if model_name.split(".")[-1] != "h5" else model_name)
+  config["prefer_frozen_model"] = yaml_conf["test"].get("prefer_frozen_model", True)
+  config["decode_max_side"] = yaml_conf["test"].get("decode_max_side", 0)
+
+  config["host"] = args.host
+  config["port"] = args.port
+  config["unix_socket"] = args.unix_socket
+
+  config["max_batch_size"] = args.max_batch_size if args.max_batch_size is not None else yaml_conf["test"].get("batch_size", 32)
+  config["max_batch_wait"] = args.max_batch_wait
+  config["max_body_size"] = args.max_body_size
+  config["quiet"] = args.quiet
+
+  main(config)
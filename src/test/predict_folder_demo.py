@@ -20,14 +20,13 @@
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
-import gc
 import sys
 import time
 import yaml
+import queue
 import argparse
+import threading
 
-import PIL
-import mtcnn
 import keras
 import numpy as np
 import pandas as pd
@@ -37,175 +36,366 @@ import tensorflow as tf
 tf.compat.v1.disable_eager_execution()
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
-from skimage.io import imsave, imread
+# make the modules shared by the training and testing scripts (under "src/utils") importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
-print("Python version     : ", sys.version.split('\n')[0])
-print("TensorFlow version : ", tf.__version__)
-print("Keras version      : ", keras.__version__)
-print("Numpy version      : ", np.__version__)
-print("")
+from utils.face_detection import FaceDetector, localize_face_list
+from utils.detection_cache import DetectionCache
+from utils.checkpoint import RunCheckpoint
+from utils.preprocessing import standardize
+from utils.run_manifest import get_model_id, load_manifest, select_modified_files, update_manifest, merge_results
+from utils.inference_model import load_faceage_model
 
 ## ----------------------------------------
 
-def get_face_bbox_from_image(path_to_image):
+def get_model_predictions(model, pat_face_list):
   
   """
-  Use the MTCNN face detector to localise the subject's face withing the image.
-  Returns the coordinates to draw bounding box enclosing the face,
-  the keypoints coordinates, and the confidence associated with the prediction.
-  
-  Make sure the image contains only one subject for the pipeline to work as intended.
+  Get the FaceAge estimation for a batch of faces, running the model only once
+  over the whole batch (instead of once per subject).
 
   @params:
-    path_to_image - required: absolute path to the image file to be processed.
+    model - required: the object storing the pre-trained (TF) FaceAge model
+    pat_face_list - required: list of the faces to be processed, cropped and resized
+      to the model input size (e.g., obtained by running "get_face_crop")
      
    """
 
-  # sanity check
-  assert os.path.exists(path_to_image)
-
-  pat_img = imread(path_to_image)
+  # prep images for TF processing (standardization of the whole batch at once)
+  pat_face_input = standardize(np.stack(pat_face_list), in_place = True)
   
-  try:
-    # return the MTCNN output associated with the first face found in the image
-    # make sure the image contains only one subject for the pipeline to work as intended
-    return mtcnn.mtcnn.MTCNN().detect_faces(pat_img)[0]
-  except:
-    print('ERROR: Processing error for file "%s"'%(path_to_image))
-    return dict()
+  return np.reshape(model.predict(pat_face_input, batch_size = len(pat_face_list)), (-1, ))
 
 ## ----------------------------------------
 
-def get_model_prediction(model, path_to_image, mtcnn_output_dict):
+def localize_faces(detector, path_list, mtcnn_output_list, face_queue, graph, session, workers, cache, cache_stats,
+                   decode_max_side = 0):
   
   """
-  Get the FaceAge estimation for the given image.
-  Requires a bounding box (around the face) to be computed prior to this step.
+  Producer stage of the pipeline (meant to be run in a separate thread).
+  Decode each image once, localise the face using the MTCNN detector, crop it and
+  hand the result to the (bounded) queue feeding the age estimation stage.
+
+  Every item put in the queue is a tuple "(subj_id, mtcnn_output_dict, pat_face)",
+  where "pat_face" is None if the face localization failed. A None item marks the end
+  of the stream - or the exception raised by the face localization, if the stream ended
+  because of an error.
 
   @params:
-    model - required: the object storing the pre-trained (TF) FaceAge model
-    path_to_image - required: absolute path to the image file to be processed.
-    mtcnn_output_dict - required: dictionary storing the aforementioned bounding box
-      (e.g., obtained from the MTCNN face detector, by running "get_face_bbox_from_image")
+    detector - required: the "FaceDetector" object (shared across all the images to be processed);
+      ignored if more than one worker is used, as each worker process holds its own detector.
+    path_list - required: list of absolute paths to the image files to be processed.
+    mtcnn_output_list - required: list of the MTCNN outputs already known for the images in
+      "path_list" (None for the images whose face is still to be localised).
+    face_queue - required: the "queue.Queue" object feeding the age estimation stage.
+    graph - required: the TF graph both the MTCNN detector and the FaceAge model live in.
+    session - required: the TF session both the MTCNN detector and the FaceAge model live in.
+    workers - required: number of face localization worker processes (see "localize_face_list").
+    cache - required: the "DetectionCache" object storing the detections from previous runs (or None).
+    cache_stats - required: dictionary counting the detection cache "hits" and "misses".
+    decode_max_side - optional: reduced decoding resolution of the worker processes' detectors (see "FaceDetector").
      
    """
 
-  # sanity check
-  assert os.path.exists(path_to_image)
+  # the Keras session is thread-local: make sure the detector runs in the same session
+  # the weights were loaded into
+  with graph.as_default():
 
-  pat_img = imread(path_to_image)
+    tf.compat.v1.keras.backend.set_session(session)
 
-  # extract the bounding box from the first face
-  x1, y1, width, height = mtcnn_output_dict['box']
-  x1, y1 = abs(x1), abs(y1)
-  x2, y2 = x1 + width, y1 + height
+    try:
+      for path_to_image, mtcnn_output_dict, pat_face, cache_hit in localize_face_list(path_list,
+                                                                                      detector,
+                                                                                      workers,
+                                                                                      cache = cache,
+                                                                                      mtcnn_output_list = mtcnn_output_list,
+                                                                                      decode_max_side = decode_max_side):
 
-  # crop the face
-  pat_face = pat_img[y1:y2, x1:x2]
+        subj_id = os.path.basename(path_to_image).split(".")[0]
 
-  # resize cropped image to the model input size
-  pat_face_pil = PIL.Image.fromarray(np.uint8(pat_face)).convert('RGB')
-  pat_face = np.asarray(pat_face_pil.resize((160, 160)))
-  
-  # prep image for TF processing
-  mean, std = pat_face.mean(), pat_face.std()
-  pat_face = (pat_face - mean) / std
-  pat_face_input = pat_face.reshape(1, 160, 160, 3)
-  
-  return np.squeeze(model.predict(pat_face_input))
+        if cache_hit is not None:
+          cache_stats["hits" if cache_hit else "misses"] += 1
+
+        # blocks if the age estimation stage is lagging behind (bounding the memory footprint)
+        face_queue.put((subj_id, mtcnn_output_dict, pat_face))
+
+    except BaseException as e:
+      # hand the error to the age estimation stage, which re-raises it once the faces
+      # already localised have been processed (and checkpointed)
+      face_queue.put(e)
+
+    else:
+      # signal the end of the stream to the age estimation stage
+      face_queue.put(None)
 
 ## ----------------------------------------
 ## ----------------------------------------
 
-def main(config):
+def run_pipeline(config, path_list):
+
+  """
+  Run the FaceAge pipeline (face localization and age estimation) on the given images.
+  Returns two dictionaries, storing the MTCNN output and the FaceAge estimate for each subject.
+
+  @params:
+    config - required: dictionary storing the run configuration (see "main").
+    path_list - required: list of absolute paths to the image files to be processed.
+
+  """
 
   model_name = config["model_name"]
   base_model_path = config["base_model_path"]
 
-  base_output_path = config["base_output_path"]
+  batch_size = config["batch_size"]
+  queue_size = config["queue_size"]
+  max_batch_wait = config["max_batch_wait"]
+  workers = config["workers"]
+  decode_max_side = config["decode_max_side"]
 
-  input_folder_name = config["input_folder_name"]
-  input_folder_path = config["input_folder_path"]
+  detection_cache_path = config["detection_cache_path"]
+  detection_cache_max_entries = config["detection_cache_max_entries"]
 
-  input_file_list = [f for f in os.listdir(input_folder_path) if ".png" in f or ".jpg" in f]
+  checkpoint_path = config["checkpoint_path"]
+  resume = config["resume"]
 
-  print("Predicting FaceAge for %g subjects at: '%s'\n"%(len(input_file_list),
-                                                         input_folder_path))
+  # the results are checkpointed after every batch, so that an interrupted run can be resumed
+  checkpoint = RunCheckpoint(checkpoint_path, resume)
 
+  subj_id_list = [os.path.basename(path_to_image).split(".")[0] for path_to_image in path_list]
 
+  # subjects completed by a previous (interrupted) run are not processed again, and the faces
+  # localised (but not processed by the model) by such run are not localised again
   face_bbox_dict = dict()
+  age_pred_dict = dict()
 
-  # FIXME: DEBUG
-  # limit the number of subjects for a faster execution
-  # if set to -1, run on all the hi-res UTK data (provided)
-  N_SUBJECTS = -1
+  for subj_id in subj_id_list:
+    if subj_id in checkpoint.faceage_dict:
+      face_bbox_dict[subj_id] = {"mtcnn_output_dict": checkpoint.mtcnn_output_dict.get(subj_id, dict())}
 
-  # subset the file list to speed up the execution of the whole notebook
-  input_file_list = input_file_list[:N_SUBJECTS] if N_SUBJECTS > 0 else input_file_list
+      if checkpoint.faceage_dict[subj_id] is not None:
+        age_pred_dict[subj_id] = {"faceage": checkpoint.faceage_dict[subj_id]}
+
+  if resume:
+    print("Resuming from: '%s' (%g subjects already processed).\n"%(checkpoint_path, len(face_bbox_dict)))
+
+  path_list = [p for p, s in zip(path_list, subj_id_list) if s not in face_bbox_dict]
+  mtcnn_output_list = [checkpoint.mtcnn_output_dict.get(os.path.basename(p).split(".")[0]) for p in path_list]
+
+  # load the MTCNN weights and the FaceAge model only once, and reuse them for every image
+  # (when running with multiple workers, each worker process loads its own detector)
+  detector = FaceDetector(decode_max_side = decode_max_side) if workers <= 1 else None
+
+  # the frozen inference artifact (see "export_frozen_model.py") is preferred, if available
+  model_path = os.path.join(base_model_path, model_name)
+  model = load_faceage_model(model_path, config["prefer_frozen_model"])
+
+  # detections from previous runs (if any) are reused, skipping the face localization step
+  cache = DetectionCache(detection_cache_path, detection_cache_max_entries) if detection_cache_path else None
+  cache_stats = {"hits": 0, "misses": 0}
+
+  graph = tf.compat.v1.get_default_graph()
+  session = tf.compat.v1.keras.backend.get_session()
+
+  # ------------------------
+
+  # the face localization (producer) and the age estimation (consumer) stages run concurrently,
+  # and communicate through a bounded queue - so that only a handful of faces is kept in memory
+  face_queue = queue.Queue(maxsize = queue_size)
+
+  localization_thread = threading.Thread(target = localize_faces,
+                                         args = (detector, path_list, mtcnn_output_list, face_queue, graph,
+                                                 session, workers, cache, cache_stats, decode_max_side))
+  localization_thread.daemon = True
+
+  # subjects (and respective faces) waiting to be processed by the model
+  batch_subj_list = list()
+  batch_face_list = list()
 
   t = time.time()
+  regression_time = 0.
+  n_processed = 0
 
-  for idx, input_image in enumerate(input_file_list):
+  localization_thread.start()
 
-    subj_id = input_image.split(".")[0]
+  end_of_stream = False
+  batch_deadline = None
+  localization_error = None
 
-    print('(%g/%g) Running the face localization step for "%s"'%(idx + 1,
-                                                                len(input_file_list),
-                                                                input_image),
-    end = "\r")
+  while not end_of_stream:
 
-    path_to_image = os.path.join(input_folder_path, input_image)
-    
-    face_bbox_dict[subj_id] = dict()
-    
-    face_bbox_dict[subj_id]["path_to_image"] = path_to_image
+    # wait for the next face - but run the model on an incomplete batch if the batch has been
+    # waiting for more than "max_batch_wait" seconds (so that predictions flow continuously)
+    try:
+      timeout = max(0., batch_deadline - time.time()) if batch_face_list else None
+      item = face_queue.get(timeout = timeout)
+    except queue.Empty:
+      item = False
 
-    face_bbox_dict[subj_id]["mtcnn_output_dict"] = get_face_bbox_from_image(path_to_image)
+    if item is None:
+      end_of_stream = True
 
-    # solves known TF memory leaks for the MTCNN pipeline
-    # (should work with all the recent versions of tensorflow)
-    if not idx % 5:
-      tf.keras.backend.clear_session()
-      gc.collect()
+    elif isinstance(item, BaseException):
+      end_of_stream = True
+      localization_error = item
 
+    elif item:
+      subj_id, mtcnn_output_dict, pat_face = item
 
-  elapsed = time.time() - t
-  print("\n... Done in %g seconds."%(elapsed))
+      n_processed += 1
 
-  # ------------------------
+      print('(%g/%g) Running the face localization and age estimation steps for "%s"'%(n_processed,
+                                                                                      len(path_list),
+                                                                                      subj_id),
+      end = "\r")
 
-  model_path = os.path.join(base_model_path, model_name)
-  model = keras.models.load_model(model_path)
+      face_bbox_dict[subj_id] = dict()
+      face_bbox_dict[subj_id]["mtcnn_output_dict"] = mtcnn_output_dict
 
-  print("")
+      # subjects whose face could not be localised are excluded from the predictions
+      if pat_face is None:
+        checkpoint.add_prediction(subj_id, None)
+      else:
+        checkpoint.add_detection(subj_id, mtcnn_output_dict)
 
-  age_pred_dict = dict()
+        if not batch_face_list:
+          batch_deadline = time.time() + max_batch_wait
 
-  t = time.time()
+        batch_subj_list.append(subj_id)
+        batch_face_list.append(pat_face)
 
-  for idx, subj_id in enumerate(face_bbox_dict.keys()):
-    
-    print('(%g/%g) Running the age estimation step for "%s"'%(idx + 1,
-                                                              len(face_bbox_dict),
-                                                              subj_id),
-    end = "\r")
+    # run the model once the batch is full, the batch has been waiting for too long,
+    # or there are no subjects left to process
+    if batch_face_list and (len(batch_face_list) == batch_size or end_of_stream or time.time() >= batch_deadline):
 
-    path_to_image = face_bbox_dict[subj_id]["path_to_image"]
-    mtcnn_output_dict = face_bbox_dict[subj_id]["mtcnn_output_dict"]
+      t_batch = time.time()
 
-    age_pred_dict[subj_id] = dict()
+      faceage_list = get_model_predictions(model, batch_face_list)
 
-    age_pred_dict[subj_id]["faceage"] = get_model_prediction(model, path_to_image, mtcnn_output_dict)
+      regression_time += time.time() - t_batch
+
+      for batch_subj_id, faceage in zip(batch_subj_list, faceage_list):
+        age_pred_dict[batch_subj_id] = dict()
+        age_pred_dict[batch_subj_id]["faceage"] = faceage
+
+        checkpoint.add_prediction(batch_subj_id, faceage)
+
+      checkpoint.flush()
+
+      batch_subj_list = list()
+      batch_face_list = list()
+
+  localization_thread.join()
+
+  # the run did not complete - the checkpoint is kept, so that the run can be resumed
+  if localization_error is not None:
+    checkpoint.close()
+
+    if cache is not None:
+      cache.close()
+
+    print("\nERROR: The face localization stage failed - run with '--resume' to resume from: '%s'."%(checkpoint_path))
+
+    raise localization_error
 
   elapsed = time.time() - t
-  print("\n... Done in %g seconds."%(elapsed))
+  print("\n... Done in %g seconds (%g seconds spent in the age estimation step)."%(elapsed,
+                                                                                  regression_time))
+
+  if detector is not None:
+    print(detector.get_latency_summary())
+  else:
+    print("Face localization run on %g worker processes (%g images per second)."%(workers,
+                                                                                len(path_list) / elapsed))
+
+  if cache is not None:
+    n_evicted = cache.evict()
+
+    print("Detection cache: %g hits, %g misses; %g entries stored, %g evicted ('%s')."%(cache_stats["hits"],
+                                                                                      cache_stats["misses"],
+                                                                                      cache.get_size(),
+                                                                                      n_evicted,
+                                                                                      detection_cache_path))
+    cache.close()
+
+  checkpoint.close()
+
+  # make sure the subjects are listed in input order (regardless of whether they were
+  # processed by this run or by the interrupted run)
+  face_bbox_dict = {s: face_bbox_dict[s] for s in subj_id_list if s in face_bbox_dict}
+  age_pred_dict = {s: age_pred_dict[s] for s in subj_id_list if s in age_pred_dict}
+
+  return face_bbox_dict, age_pred_dict
+
+## ----------------------------------------
+## ----------------------------------------
+
+def main(config):
+
+  model_name = config["model_name"]
+  base_model_path = config["base_model_path"]
+
+  base_output_path = config["base_output_path"]
+
+  input_folder_name = config["input_folder_name"]
+  input_folder_path = config["input_folder_path"]
+
+  incremental = config["incremental"]
+
+  input_file_list = [f for f in os.listdir(input_folder_path) if ".png" in f or ".jpg" in f]
+
+  print("Predicting FaceAge for %g subjects at: '%s'\n"%(len(input_file_list),
+                                                         input_folder_path))
+
+  # FIXME: DEBUG
+  # limit the number of subjects for a faster execution
+  # if set to -1, run on all the hi-res UTK data (provided)
+  N_SUBJECTS = -1
+
+  # subset the file list to speed up the execution of the whole notebook
+  input_file_list = input_file_list[:N_SUBJECTS] if N_SUBJECTS > 0 else input_file_list
+
+  outfile_name = '%s_res.csv'%(input_folder_name)
+  outfile_path = os.path.join(base_output_path, outfile_name) 
+
+  manifest_name = '%s_res_manifest.csv'%(input_folder_name)
+  manifest_path = os.path.join(base_output_path, manifest_name)
+
+  # sidecar file storing the results of the current run, until the output file is written
+  checkpoint_name = '%s_res_checkpoint.jsonl'%(input_folder_name)
+  config["checkpoint_path"] = os.path.join(base_output_path, checkpoint_name)
+
+  # in incremental mode, only the files added or modified since the last run are processed
+  if incremental:
+    model_id = get_model_id(os.path.join(base_model_path, model_name))
+
+    all_file_list = input_file_list
+    input_file_list, manifest_df = select_modified_files(input_folder_path,
+                                                         all_file_list,
+                                                         load_manifest(manifest_path),
+                                                         model_id)
+
+    print("Incremental mode: %g new or modified files (%g files already scored).\n"%(len(input_file_list),
+                                                                                     len(manifest_df)))
+
+  path_list = [os.path.join(input_folder_path, f) for f in input_file_list]
+
+  if path_list:
+    face_bbox_dict, age_pred_dict = run_pipeline(config, path_list)
+  else:
+    face_bbox_dict, age_pred_dict = dict(), dict()
 
   age_pred_df = pd.DataFrame.from_dict(age_pred_dict, orient = 'index')
   age_pred_df.reset_index(level = 0, inplace = True)
   age_pred_df.rename(columns = {"index": "subj_id"}, inplace = True)
 
-  outfile_name = '%s_res.csv'%(input_folder_name)
-  outfile_path = os.path.join(base_output_path, outfile_name) 
+  if not len(age_pred_df):
+    age_pred_df = pd.DataFrame(columns = ["subj_id", "faceage"])
+
+  if incremental:
+    processed_subj_list = [f.split(".")[0] for f in input_file_list]
+    kept_subj_list = [f.split(".")[0] for f in manifest_df["file_name"]]
+
+    age_pred_df = merge_results(outfile_path, age_pred_df, processed_subj_list, kept_subj_list)
 
   print("\nSaving predictions at: '%s'... "%(outfile_path), end = "")
 
@@ -213,12 +403,28 @@ def main(config):
 
   print("Done.")
 
+  # the run completed successfully - the checkpoint is no longer needed
+  if os.path.exists(config["checkpoint_path"]):
+    os.remove(config["checkpoint_path"])
+
+  if incremental:
+    manifest_df = update_manifest(manifest_df, input_folder_path, input_file_list, model_id)
+    manifest_df.to_csv(manifest_path, index = False)
+
+    print("Manifest of the scored files saved at: '%s'."%(manifest_path))
+
 
 ## ----------------------------------------
 ## ----------------------------------------
       
 if __name__ == '__main__':
 
+  print("Python version     : ", sys.version.split('\n')[0])
+  print("TensorFlow version : ", tf.__version__)
+  print("Keras version      : ", keras.__version__)
+  print("Numpy version      : ", np.__version__)
+  print("")
+
   base_conf_file_path = '.'
   
   parser = argparse.ArgumentParser(description = 'FaceAge - predict folder demo')
@@ -229,6 +435,32 @@ if __name__ == '__main__':
                       default = "config_predict_folder_demo.yaml"
                      )
 
+  parser.add_argument('--batch_size',
+                      required = False,
+                      type = int,
+                      help = 'Number of faces processed by the FaceAge model at once (overrides the YAML configuration).',
+                      default = None
+                     )
+
+  parser.add_argument('--workers',
+                      required = False,
+                      type = int,
+                      help = 'Number of processes the face localization step is sharded across (overrides the YAML configuration).',
+                      default = None
+                     )
+
+  parser.add_argument('--incremental',
+                      required = False,
+                      action = 'store_true',
+                      help = 'Process only the files added or modified since the last run, and merge the results.'
+                     )
+
+  parser.add_argument('--resume',
+                      required = False,
+                      action = 'store_true',
+                      help = 'Resume an interrupted run, skipping the subjects stored in its checkpoint.'
+                     )
+
   args = parser.parse_args()
 
   conf_file_path = os.path.join(base_conf_file_path, args.conf)
@@ -247,6 +479,16 @@ if __name__ == '__main__':
   input_folder_name = yaml_conf["test"]["input_folder_name"]
   outputs_folder_name = yaml_conf["test"]["outputs_folder_name"]
 
+  # number of faces processed by the FaceAge model at once
+  batch_size = args.batch_size if args.batch_size is not None else yaml_conf["test"].get("batch_size", 32)
+
+  # number of face localization worker processes
+  workers = args.workers if args.workers is not None else yaml_conf["test"].get("workers", 1)
+
+  # on-disk cache of the MTCNN detections (relative paths are resolved with respect to "base_path")
+  detection_cache_name = yaml_conf["test"].get("detection_cache_name", "")
+  detection_cache_path = os.path.join(base_path, detection_cache_name) if detection_cache_name else ""
+
   base_data_path = os.path.join(base_path, data_folder_name)
   base_model_path = os.path.join(base_path, models_folder_name)
   base_output_path = os.path.join(base_path, outputs_folder_name)
@@ -265,5 +507,19 @@ if __name__ == '__main__':
   
   config["input_folder_name"] = input_folder_name
   config["input_folder_path"] = input_folder_path
+
+  config["batch_size"] = batch_size
+  config["queue_size"] = yaml_conf["test"].get("queue_size", 64)
+  config["max_batch_wait"] = yaml_conf["test"].get("max_batch_wait", 5.)
+  config["workers"] = workers
+  config["decode_max_side"] = yaml_conf["test"].get("decode_max_side", 0)
+
+  config["detection_cache_path"] = detection_cache_path
+  config["detection_cache_max_entries"] = yaml_conf["test"].get("detection_cache_max_entries", 1000000)
+
+  config["incremental"] = args.incremental or yaml_conf["test"].get("incremental", False)
+  config["resume"] = args.resume or yaml_conf["test"].get("resume", False)
+
+  config["prefer_frozen_model"] = yaml_conf["test"].get("prefer_frozen_model", True)
   
   main(config)
@@ -0,0 +1,289 @@
+# -----------------
+# Post-training quantization of the FaceAge model: export of the TFLite variants, and report of
+# their deviation from the reference predictions, throughput and size
+# (this script will parse the configuration file "config_predict_folder_demo.yaml")
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import sys
+import time
+import yaml
+import argparse
+
+import keras
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+# the conversion requires eager execution (unlike "predict_folder_demo.py")
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+# make the modules shared by the training and testing scripts (under "src/utils") importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.face_detection import FaceDetector, localize_face_list
+from utils.face_store import load_faces
+from utils.preprocessing import standardize
+from utils.quantization import QUANTIZATION_MODES, export_quantized_model, TFLiteModel
+
+## ----------------------------------------
+
+def get_faces(path_list, detector):
+
+  """
+  Localise and crop the faces of the given images.
+  Returns the list of the subject IDs and the array storing the standardized faces
+  (images without a face are skipped).
+
+  @params:
+    path_list - required: list of absolute paths to the image files to be processed.
+    detector - required: the "FaceDetector" object.
+
+  """
+
+  subj_id_list = list()
+  face_list = list()
+
+  for path_to_image, _, pat_face, _ in localize_face_list(path_list, detector):
+    if pat_face is None:
+      continue
+
+    subj_id_list.append(os.path.basename(path_to_image).split(".")[0])
+    face_list.append(pat_face)
+
+  return subj_id_list, standardize(np.stack(face_list), in_place = True)
+
+## ----------------------------------------
+
+def get_throughput(model, faces, batch_size, n_runs):
+
+  """
+  Returns the number of faces processed per second (median over "n_runs" batches).
+
+  @params:
+    model - required: the model to be benchmarked (any object exposing "predict").
+    faces - required: array storing the standardized faces.
+    batch_size - required: number of faces per batch.
+    n_runs - required: number of timed runs.
+
+  """
+
+  batch = faces[:batch_size]
+
+  # the first call allocates the buffers (or builds the graph) - not timed
+  model.predict(batch, batch_size = len(batch))
+
+  time_list = list()
+
+  for _ in range(n_runs):
+    t = time.time()
+    model.predict(batch, batch_size = len(batch))
+    time_list.append(time.time() - t)
+
+  return len(batch) / float(np.median(time_list))
+
+## ----------------------------------------
+## ----------------------------------------
+
+def main(config):
+
+  model_path = config["model_path"]
+  input_folder_path = config["input_folder_path"]
+  reference_path = config["reference_path"]
+  calibration_store_path = config["calibration_store_path"]
+
+  mode_list = config["mode_list"]
+  batch_size = config["batch_size"]
+
+  # the calibration and evaluation images are drawn (without overlap) from the input folder
+  input_file_list = sorted([f for f in os.listdir(input_folder_path) if ".png" in f or ".jpg" in f])
+  input_file_list = [input_file_list[idx] for idx in np.random.RandomState(config["seed"]).permutation(len(input_file_list))]
+
+  n_calibration = 0 if calibration_store_path else config["n_calibration"]
+
+  calibration_path_list = [os.path.join(input_folder_path, f) for f in input_file_list[:n_calibration]]
+  eval_path_list = [os.path.join(input_folder_path, f) for f in input_file_list[n_calibration:n_calibration + config["n_images"]]]
+
+  reference_df = pd.read_csv(reference_path, dtype = {"subj_id": str})
+  reference_dict = dict(zip(reference_df["subj_id"], reference_df["faceage"]))
+
+  detector = FaceDetector()
+
+  print("Localizing the faces of %g evaluation images at: '%s'"%(len(eval_path_list), input_folder_path))
+
+  subj_id_list, eval_faces = get_faces(eval_path_list, detector)
+
+  # only the subjects with a reference prediction are evaluated
+  keep_list = [idx for idx, subj_id in enumerate(subj_id_list) if subj_id in reference_dict]
+  eval_faces = eval_faces[keep_list]
+  reference = np.array([reference_dict[subj_id_list[idx]] for idx in keep_list], dtype = np.float32)
+
+  if not len(reference):
+    sys.exit("ERROR: none of the evaluation subjects is listed in '%s'."%(reference_path))
+
+  if "int8" in mode_list:
+    if calibration_store_path:
+      print("Loading %g calibration faces from: '%s'"%(config["n_calibration"], calibration_store_path))
+
+      store_faces, _ = load_faces(calibration_store_path)
+      calibration_indx = np.sort(np.random.RandomState(config["seed"]).permutation(len(store_faces))[:config["n_calibration"]])
+      calibration_faces = standardize(store_faces[calibration_indx])
+    else:
+      print("Localizing the faces of %g calibration images at: '%s'"%(len(calibration_path_list), input_folder_path))
+
+      _, calibration_faces = get_faces(calibration_path_list, detector)
+  else:
+    calibration_faces = None
+
+  print("\nEvaluating on %g faces (reference predictions: '%s')\n"%(len(eval_faces), reference_path))
+
+  # ------------------------
+
+  report_list = list()
+
+  def add_report(name, model, model_file_path):
+    pred = np.reshape(model.predict(eval_faces, batch_size = batch_size), (-1, ))
+    drift = np.abs(pred - reference)
+
+    report_list.append({"model": name,
+                        "mae_drift": float(np.mean(drift)),
+                        "max_drift": float(np.max(drift)),
+                        "faces_per_second": get_throughput(model, eval_faces, batch_size, config["n_runs"]),
+                        "size_mb": os.path.getsize(model_file_path) / float(1 << 20)})
+
+  # the Keras model is evaluated as well - its drift is due to the face localization only
+  add_report("keras", keras.models.load_model(model_path), model_path)
+
+  for mode in mode_list:
+    print("Exporting the %s model... "%(mode), end = "")
+
+    t = time.time()
+    tflite_path = export_quantized_model(model_path, mode, calibration_faces)
+
+    print("Done in %g seconds ('%s')."%(time.time() - t, tflite_path))
+
+    add_report(mode, TFLiteModel(tflite_path, config["num_threads"]), tflite_path)
+
+  report_df = pd.DataFrame(report_list, columns = ["model", "mae_drift", "max_drift", "faces_per_second", "size_mb"])
+
+  print("")
+
+  for _, row in report_df.iterrows():
+    print("%-8s MAE drift: %7.3f years (max: %7.3f) | %8.2f faces per second | %7.2f MB"%(row["model"],
+                                                                                         row["mae_drift"],
+                                                                                         row["max_drift"],
+                                                                                         row["faces_per_second"],
+                                                                                         row["size_mb"]))
+
+  report_df.to_csv(config["report_path"], index = False)
+
+  print("\nReport saved at: '%s'."%(config["report_path"]))
+
+## ----------------------------------------
+## ----------------------------------------
+
+if __name__ == '__main__':
+
+  base_conf_file_path = '.'
+
+  parser = argparse.ArgumentParser(description = 'FaceAge - post-training quantization')
+
+  parser.add_argument('--conf',
+                      required = False,
+                      help = 'Specify the path to the YAML configuration file containing the run details.',
+                      default = "config_predict_folder_demo.yaml"
+                     )
+
+  parser.add_argument('--modes',
+                      required = False,
+                      help = 'Comma-separated list of the quantization modes to export (among %s).'%(", ".join(QUANTIZATION_MODES)),
+                      default = "dynamic,float16,int8"
+                     )
+
+  parser.add_argument('--n_images',
+                      required = False,
+                      type = int,
+                      help = 'Number of images (from the input folder) the quantized models are evaluated on.',
+                      default = 500
+                     )
+
+  parser.add_argument('--n_calibration',
+                      required = False,
+                      type = int,
+                      help = 'Number of faces the int8 quantization is calibrated on.',
+                      default = 200
+                     )
+
+  parser.add_argument('--calibration_store',
+                      required = False,
+                      help = 'Path to a face store (e.g., the extracted training faces) to draw the calibration faces from, instead of the input folder.',
+                      default = ""
+                     )
+
+  parser.add_argument('--n_runs',
+                      required = False,
+                      type = int,
+                      help = 'Number of timed runs of the throughput benchmark.',
+                      default = 10
+                     )
+
+  parser.add_argument('--num_threads',
+                      required = False,
+                      type = int,
+                      help = 'Number of threads used by the TFLite interpreter.',
+                      default = None
+                     )
+
+  args = parser.parse_args()
+
+  conf_file_path = os.path.join(base_conf_file_path, args.conf)
+
+  with open(conf_file_path) as f:
+    yaml_conf = yaml.load(f, Loader = yaml.FullLoader)
+
+  base_path = yaml_conf["test"]["base_path"]
+  data_folder_name = yaml_conf["test"]["data_folder_name"]
+  input_folder_name = yaml_conf["test"]["input_folder_name"]
+  outputs_folder_name = yaml_conf["test"]["outputs_folder_name"]
+
+  model_name = yaml_conf["test"]["model_name"]
+  models_folder_name = yaml_conf["test"]["models_folder_name"]
+  model_name = model_name + ".h5" if model_name.split(".")[-1] != "h5" else model_name
+
+  config = dict()
+
+  config["model_path"] = os.path.join(base_path, models_folder_name, model_name)
+  config["input_folder_path"] = os.path.join(base_path, data_folder_name, input_folder_name)
+
+  # reference predictions, as written by "predict_folder_demo.py"
+  config["reference_path"] = os.path.join(base_path, outputs_folder_name, '%s_res.csv'%(input_folder_name))
+  config["report_path"] = os.path.join(base_path, outputs_folder_name,
+                                       '%s_quantization_report.csv'%(os.path.splitext(model_name)[0]))
+
+  config["calibration_store_path"] = args.calibration_store
+
+  config["mode_list"] = [m.strip() for m in args.modes.split(",") if m.strip()]
+  config["n_images"] = args.n_images
+  config["n_calibration"] = args.n_calibration
+  config["n_runs"] = args.n_runs
+  config["num_threads"] = args.num_threads
+  config["batch_size"] = yaml_conf["test"].get("batch_size", 32)
+  config["seed"] = 0
+
+  main(config)
@@ -18,21 +18,19 @@
 # AIM 2022
 
 # Import libraries/dependencies
+import os
+import sys
 import numpy as np
-from numpy import load
 from pandas import read_csv
+from pandas import Series
 from pandas import DataFrame as DF
-from keras.models import load_model
 from keras.backend import clear_session
 
-def standardize(face_pixels):
-	# set pixel precision
-	face_pixels = face_pixels.astype('float32')
-	# standardize pixel values across channels (global)
-	for i in range(np.shape(face_pixels)[0]):
-		mean, std = face_pixels[i,:,:,:].mean(), face_pixels[i,:,:,:].std()
-		face_pixels[i,:,:,:] = (face_pixels[i,:,:,:] - mean) / std
-	return face_pixels
+# make the modules shared by the training and testing scripts (under "src/utils") importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.preprocessing import standardize
+from utils.face_store import load_faces
+from utils.inference_model import load_faceage_model
 
 # specify the embedding version of inception-resnet v1 CNN
 version = 128;
@@ -43,29 +41,38 @@ workpath = 'work/'
 outputpath = inputpath
 if version == 128:
 	# use the 128-Dimensional face embedding version
-	model = load_model('./faceage128.h5')
+	# (the frozen inference artifact is loaded instead, if exported - see "export_frozen_model.py")
+	model = load_faceage_model('./faceage128.h5')
 elif version == 512:
 	# use the 512-Dimensional face embedding version
-	model = load_model('./faceage512.h5')
+	model = load_faceage_model('./faceage512.h5')
 
-# print model summary
-model.summary()
+# print model summary (not available for the frozen model)
+if hasattr(model, 'summary'):
+	model.summary()
 
-# load dataset of face images for evaluation
-data = load(rootpath + workpath + 'extracted_faces.npz')
-X = data['arr_0']
+# load dataset of face images for evaluation (memory-mapped, read one slice at a time)
+X, face_index_df = load_faces(rootpath + workpath + 'extracted_faces')
 
 # load associated log file with record information
 csv_log = read_csv(rootpath + inputpath + 'logfile.csv')
 
-# predict class probabilities
-yhat = model.predict(standardize(X))
+# predict class probabilities, one slice of the dataset at a time
+slice_size = 1024
+yhat = np.concatenate([model.predict(standardize(X[i:i + slice_size]))
+					   for i in range(0, len(X), slice_size)])
 
 # create dataframe of output predictions
 yhat_df = DF({'face age': yhat[:,0]})
 
-# add to existing dataframe
-csv_log['face age'] = yhat_df['face age']
+# add to existing dataframe, locating the face of each logfile record in the face array (the face
+# store only holds the photos where a face was detected - the other records get no prediction;
+# legacy face arrays hold one face per logfile record)
+if 'photo_id' in face_index_df.columns:
+	face_row_log = csv_log['photo_id'].map(Series(face_index_df['face_idx'].values, index = face_index_df['photo_id'].values))
+	csv_log['face age'] = face_row_log.map(yhat_df['face age'])
+else:
+	csv_log['face age'] = yhat_df['face age']
 
 # tidy up and close session
 #del model
@@ -19,17 +19,20 @@
 
 # Import libraries/dependencies
 import os
+import sys
 from datetime import datetime
 from pandas import read_csv
 from pandas import DataFrame as DF
 from PIL import Image
 from numpy import asarray
 from numpy import where
-from numpy import savez_compressed
-from mtcnn.mtcnn import MTCNN
-from imghdr import what
 from time import sleep
 
+# make the modules shared by the training and testing scripts (under "src/utils") importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.face_detection import FaceDetector
+from utils.face_store import FaceStoreWriter
+
 #disable annoying AVX warning due to GPU usage
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
@@ -49,17 +52,13 @@ def date_extract(datestr):
         dates.append(date_i)
     return dates
 
-# extract face array from each separate file
-def extract_face(filename, required_size=(160, 160)):
-	# load image from file
-	image = Image.open(filename)
-	# convert to RGB, if needed
+# extract face array from each separate (already opened) image file
+def extract_face(image, detector, required_size=(160, 160)):
+	# convert to RGB, if needed (the image is decoded here, only once)
 	image = image.convert('RGB')
 	# convert to array
 	pixels = asarray(image)
-	# initialize face detector
-	detector = MTCNN()
-	# detect faces in the image
+	# detect faces in the image (the detector is shared across all files)
 	results = detector.detect_faces(pixels)
 	face_flag = 0
 	if not results:
@@ -81,11 +80,9 @@ def extract_face(filename, required_size=(160, 160)):
 	return face_array, face_flag
 
 
-# load images and extract faces for all images in a directory separating by age
-def load_dataset(directory, filenames):
-    # initialize indices for faces to be extracted
-    faces = list()
-    face_flag_indx = list()
+# extract faces for all images in a directory, one file at a time (generator)
+# yields the file name, the extracted face array (None if no face was extracted) and the face flag
+def iter_dataset(directory, filenames, detector):
     # enumerate files
     cnt=0
     Nfiles = len(filenames)
@@ -93,26 +90,43 @@ def load_dataset(directory, filenames):
     for file in filenames:
         cnt+=1
         path = directory + file + '.jpg'
-        # check if valid stored Image
-        im = Image.open(path)
-        # get dimensions of image
-        width, height = im.size
-        # check correct format of image
-        imgfiletype = what(path)
-        if width < 2 | height < 2:
-        	continue
-        if imgfiletype != 'jpeg':
-        	continue
-        # extract face
-        face, face_flag = extract_face(path)
-        # only include if face was detected
-        if size(face):
-            # append extracted face and record
-            faces.append(face)
-            face_flag_indx.append(face_flag)
         # display file being processed
         print('Processing file %d' % cnt, 'of %d,' % Nfiles, ' FILE: %s' % file, '\n')
-    return asarray(faces), face_flag_indx
+        # open the file once - only the header is read until the image is converted
+        try:
+            im = Image.open(path)
+        except (IOError, OSError):
+            print('ERROR: could not open file %s' % path)
+            yield file, None, 0
+            continue
+        with im:
+            # get dimensions of image
+            width, height = im.size
+            # check valid stored image and correct format of image
+            if width < 2 or height < 2 or im.format != 'JPEG':
+                yield file, None, 0
+                continue
+            # extract face
+            face, face_flag = extract_face(im, detector)
+        # only include if face was detected
+        yield file, (face if face_flag else None), face_flag
+
+# load images and extract faces for all images in a directory
+# (the extracted faces are written to the face store as they are extracted, so that
+# memory usage does not grow with the number of files; one face flag is returned per file)
+def load_dataset(directory, filenames, writer):
+    # initialize indices for faces to be extracted
+    face_flag_indx = list()
+    # initialize face detector once (loads the MTCNN weights) and reuse it for every file
+    detector = FaceDetector()
+    for file, face, face_flag in iter_dataset(directory, filenames, detector):
+        # only include if face was detected
+        if face_flag:
+            # append extracted face and record
+            writer.append(face, photo_id=file)
+        face_flag_indx.append(face_flag)
+    print(detector.get_latency_summary())
+    return face_flag_indx
 # load a dataset that contains one subdir for each class that in turn contains images
 
 # Extract data and match patient id
@@ -124,8 +138,9 @@ start_date = csv_log['Start Date']
 indx = ((log_id.isnull().values) | (start_date.isnull().values))
 id = (log_pmrn[indx == False], log_id[indx == False])
 
-# load dataset
-faces, face_flag_indx = load_dataset(rootpath + inputpath, id[1])
+# load dataset, saving the extracted face arrays to a (memory-mappable) face store
+with FaceStoreWriter(rootpath + outputpath + 'extracted_faces') as writer:
+    face_flag_indx = load_dataset(rootpath + inputpath, id[1], writer)
 
 # create dataframe of processed clinical face records
 face_id = DF({'original_index' : where(indx == False)[0],
@@ -136,6 +151,3 @@ face_id = DF({'original_index' : where(indx == False)[0],
 		   'face flag': face_flag_indx})
 # Write record information to logfile
 face_id.to_csv(path_or_buf = (rootpath + datapath + 'logfile.csv'), index = False)
-
-# save extracted face array to one file in compressed format
-savez_compressed(rootpath + outputpath + 'extracted_faces.npz', faces)
@@ -19,24 +19,96 @@
 
 # Import libraries/dependencies
 import numpy as np
-from numpy import load
+import tensorflow as tf
 from keras import models
 from keras import layers
 from keras import optimizers
-from keras.utils import multi_gpu_model
 from keras.callbacks import EarlyStopping
 from keras.callbacks import ReduceLROnPlateau
 from keras.callbacks import History
 from keras.backend import clear_session
 from keras.models import load_model
 from matplotlib import pyplot as plt
+import os
 import sys
 
+# make the modules shared by the training and testing scripts (under "src/utils") importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.face_store import load_faces
+from utils.augmentation import plan_augmentation
+from utils.input_pipeline import make_dataset
+from utils.data_split import split_indices
+from utils.trunk_cache import find_cut_index, split_model, cache_features, copy_weights, get_dataset_fingerprint
+from utils.run_manifest import get_model_id
+
 
 # Define IO paths
 rootpath = './model/'
 inputpath = 'input/'
 
+# augment the training samples on the fly (fresh augmentations at every epoch); set to False
+# if the training dataset was already augmented offline (see "Augmentation_and_Rebalancing.py")
+augment_online = True
+# target number of training samples per age when augmenting on the fly (the rarer ages are oversampled)
+Nval_train = 135
+# cache the raw face crops in memory after the first epoch
+cache_faces = False
+
+# train/validation split: 'holdout' (the last "val_frac" of the pre-randomized development dataset
+# is used for validation), 'kfold' or 'stratified_kfold' (fold "fold_index" of "n_folds" is used for
+# validation; the stratified folds share the same age distribution)
+split_mode = 'holdout'
+n_folds = 10
+fold_index = 0
+
+# distribution strategy: 'default' (single device), 'mirrored' (all the devices of this host),
+# 'multiworker' (several hosts, described by the TF_CONFIG environment variable) or 'auto'
+# (multiworker if TF_CONFIG is set, mirrored if more than one GPU is available, default otherwise)
+distribution = 'auto'
+# global batch size (split across the replicas)
+global_batch_size = 256
+# seed of the oversampling plan and of the shuffling - must be the same on every worker when
+# training across hosts (the dataset is sharded by sample position)
+shuffle_seed = 1234
+
+# train from cached activations: the frozen layers of the CNN are run only once over the dataset
+# (activations stored in a memory-mapped file) and only the trainable layers and the head are trained.
+# The cached activations are computed from the stored face crops, so on-the-fly augmentation is not
+# possible in this mode - if "augment_online" is set, the rarer ages are still oversampled (the cached
+# activations are repeated, without augmentation); alternatively, train on an offline-augmented dataset
+train_from_cache = False
+# path to the cached activations (recomputed if the dataset or the cutoff layer changes)
+trunk_cache_path = rootpath + 'trunk_features.npy'
+# head configurations trained from the cached activations (learning rate, "ReduceLROnPlateau" factor
+# and patience, width of the dense layer) - the one with the lowest validation loss is saved
+head_sweep = [{'lr': 0.001, 'lr_factor': 0.2, 'lr_patience': 5, 'width': 128}]
+
+
+# Select the distribution strategy the model is trained under
+def get_strategy(distribution):
+    if distribution == 'auto':
+        if os.environ.get('TF_CONFIG'):
+            distribution = 'multiworker'
+        elif len(tf.config.list_physical_devices('GPU')) > 1:
+            distribution = 'mirrored'
+        else:
+            distribution = 'default'
+    if distribution == 'multiworker':
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    elif distribution == 'mirrored':
+        return tf.distribute.MirroredStrategy()
+    elif distribution == 'default':
+        return tf.distribute.get_strategy()
+    raise ValueError('Unknown distribution strategy: %s' % distribution)
+
+# Check whether this process is in charge of writing the results (the chief worker, when
+# training across several hosts)
+def is_chief(strategy):
+    cluster_resolver = getattr(strategy, 'cluster_resolver', None)
+    if cluster_resolver is None or cluster_resolver.task_type is None:
+        return True
+    return cluster_resolver.task_type == 'chief' or \
+           (cluster_resolver.task_type == 'worker' and cluster_resolver.task_id == 0)
 
 # CNN layer name generator
 def _generate_layer_name(name, branch_idx=None, prefix=None):
@@ -46,65 +118,68 @@ def _generate_layer_name(name, branch_idx=None, prefix=None):
         return '_'.join((prefix, name))
     return '_'.join((prefix, 'Branch', str(branch_idx), name))
 
-# Standard normalization of extracted face images
-def standardize(face_pixels):
-	# scale pixel values
-	face_pixels = face_pixels.astype('float32')
-	# standardize pixel values across channels (global)
-	for i in range(np.shape(face_pixels)[0]):
-		mean, std = face_pixels[i,:,:,:].mean(), face_pixels[i,:,:,:].std()
-		face_pixels[i,:,:,:] = (face_pixels[i,:,:,:] - mean) / std
-	# transform face into one sample
-	#face_image = expand_dims(face_pixels, axis=0)
-	return face_pixels
+# Add the regression head on top of the given (sequential) model
+def add_head(model, width):
+    # add dense (fully-connected) layer 1
+    model.add(layers.Dense(width, activation='relu'))
+
+    # batch normalization
+    bn_name = _generate_layer_name('BatchNorm', prefix='dense_1')
+    model.add(layers.BatchNormalization(momentum=0.995, epsilon=0.001, scale=False, name=bn_name))
+
+    # Add linear output regression layer
+    model.add(layers.Dense(1, activation='linear'))
+
+# compile the model and select optimizer ("Adam" stochastic backpropagation with momentum method)
+def compile_model(model, lr):
+    model.compile(loss='mean_absolute_error',
+        optimizer=optimizers.Adam(lr=lr, beta_1=0.9, beta_2=0.999, epsilon=None, decay=0.0, amsgrad=False),
+        metrics=['mae'])
 
 # specify the embedding version of inception-resnet v1 CNN
 version = 128;
 
-if version == 128:
-	# use the 128-Dimension face embedding version
-	inception_resnet_v1 = load_model(rootpath + 'inception_resnet_128.h5')
-elif version == 512:
-	# use the 512-Dimension face embedding version
-	inception_resnet_v1 = load_model(rootpath + 'inception_resnet_512.h5')
-
-# Choose which layers to train
-Cutoff_Layer =  145  # train layers further downstream of this cutoff
-for layer in inception_resnet_v1.layers[0:(Cutoff_Layer - 1)]:
-    layer.trainable = False
-for layer in inception_resnet_v1.layers[Cutoff_Layer:]:
-	layer.trainable = True
+# the strategy must be created before any other TF operation (required when training across hosts)
+strategy = get_strategy(distribution)
 
-# initialize new model
-model = models.Sequential()
+# batch size processed by each replica, derived from the global batch size
+n_replicas = strategy.num_replicas_in_sync
+batch_size_per_replica = max(1, global_batch_size // n_replicas)
+batch_size = batch_size_per_replica * n_replicas
+print('Training on %d replica(s): %d samples per replica, %d per batch' % (n_replicas, batch_size_per_replica, batch_size))
 
-# use inception-resnet v1 architecture as base CNN face feature extractor
-model.add(inception_resnet_v1)
+# build and compile the model under the distribution strategy (variables are mirrored across replicas)
+with strategy.scope():
+    # use the 128-Dimension (or 512-Dimension) face embedding version
+    base_model_path = rootpath + 'inception_resnet_%d.h5' % version
+    inception_resnet_v1 = load_model(base_model_path)
 
-# add dense (fully-connected) layer 1
-model.add(layers.Dense(version, activation='relu'))
+    # Choose which layers to train
+    Cutoff_Layer =  145  # train layers further downstream of this cutoff
+    for layer in inception_resnet_v1.layers[0:(Cutoff_Layer - 1)]:
+        layer.trainable = False
+    for layer in inception_resnet_v1.layers[Cutoff_Layer:]:
+        layer.trainable = True
 
-# batch normalization
-bn_name = _generate_layer_name('BatchNorm', prefix='dense_1')
-model.add(layers.BatchNormalization(momentum=0.995, epsilon=0.001, scale=False, name=bn_name))
+    # initialize new model
+    model = models.Sequential()
 
-# Add linear output regression layer
-model.add(layers.Dense(1, activation='linear'))
+    # use inception-resnet v1 architecture as base CNN face feature extractor
+    model.add(inception_resnet_v1)
 
-# run on 2 GPUs
-parallel_model = multi_gpu_model(model, gpus=2)
+    # add the regression head (dense layer, batch normalization and linear output)
+    add_head(model, version)
 
-# model reporting
-parallel_model.summary()
+    # model reporting
+    model.summary()
 
-# compile the model and select optimizer ("Adam" stochastic backpropagation with momentum method)
-parallel_model.compile(loss='mean_absolute_error',
-	optimizer=optimizers.Adam(lr=0.001, beta_1=0.9, beta_2=0.999, epsilon=None, decay=0.0, amsgrad=False),
-	metrics=['mae'])
+    compile_model(model, 0.001)
 
-# load datasets for training and validation
-rawdata = load(rootpath + inputpath + 'extracted_faces_training.npz')
-data, labels = rawdata['arr_0'], rawdata['arr_1']
+# load datasets for training and validation (memory-mapped - the faces are read from disk
+# one batch at a time by the input pipeline)
+store_path = rootpath + inputpath + 'extracted_faces_training'
+data, index_df = load_faces(store_path)
+labels = index_df['label'].values
 
 Nval = data.shape[0]
 
@@ -112,40 +187,118 @@ Nval = data.shape[0]
 val_frac = 0.1
 
 # create training and test datasets from original pre-randomized, augmented and rebalanced development dataset
-trainX = data[:(int((1-val_frac)*Nval)),:]
-trainy = labels[:(int((1-val_frac)*Nval))]
-testX = data[(int((1-val_frac)*Nval)+1):Nval,:]
-testy = labels[(int((1-val_frac)*Nval)+1):Nval]
-
-print('Dataset: train=%d, test=%d' % (trainX.shape[0], testX.shape[0]))
+# (positions in the shared, memory-mapped face store - no copy of the data is made)
+train_indx, test_indx = split_indices(labels, mode=split_mode, val_frac=val_frac, n_folds=n_folds,
+                                      fold_index=fold_index)
 
 # Train the model, iterating on the data in batches of 32 samples
-np.random.seed()
+# (the oversampling plan is drawn from the shared seed, so that all the workers agree on it)
+np.random.seed(shuffle_seed)
+
+# when augmenting on the fly, oversample the training records of the rarer ages (each copy
+# is augmented differently at every epoch - or, when training from cached activations, repeated as it is)
+if augment_online:
+    oversample_indx, _ = plan_augmentation(labels[train_indx], np.unique(labels[train_indx]), Nval_train)
+    train_indx = np.concatenate([train_indx, train_indx[oversample_indx]])
+
+if train_from_cache and augment_online:
+    print('Training from cached activations: on-the-fly augmentation disabled (the rarer ages are oversampled without augmentation)')
+    augment_online = False
+
+print('Dataset: train=%d, test=%d' % (len(train_indx), len(test_indx)))
+
+if not train_from_cache:
+    # input pipelines (faces standardized in the graph)
+    train_dataset = make_dataset(data, labels, train_indx, batch_size=batch_size, augment=augment_online,
+                                 shuffle=True, cache=cache_faces, seed=shuffle_seed)
+    test_dataset = make_dataset(data, labels, test_indx, batch_size=batch_size, cache=cache_faces)
+
+    # Callbacks for monitoring and controlling training progress:
+    # early stopping if performance no longer improving
+    early = EarlyStopping(monitor='val_loss', min_delta=1e-08, patience=200, verbose=0, mode='min', baseline=None,
+                          restore_best_weights=True)
+
+    # reduce learning rate if loss function plateaus
+    lr_reduce = ReduceLROnPlateau(monitor='val_loss', factor=0.2, patience=5, verbose=0, mode='min', min_delta=0.0001, cooldown=2, min_lr=1e-15)
+
+    # record training events
+    history = History()
+
+    # Fit the deep learning model
+    model.fit(train_dataset, epochs=1000,
+              validation_data=test_dataset, callbacks = [early, lr_reduce, history])
+else:
+    # split the CNN where only the output of a single (frozen) layer flows into the trainable layers
+    cut_index = find_cut_index(inception_resnet_v1, Cutoff_Layer - 2)
+    print('Caching the activations of layer %d (%s)' % (cut_index, inception_resnet_v1.layers[cut_index].name))
+
+    # run the frozen trunk once over the whole dataset (activations of un-augmented, standardized faces)
+    trunk, _ = split_model(inception_resnet_v1, cut_index)
+    # the cache is rebuilt if the base model, the cutoff or the dataset (content or order) changed
+    fingerprint = {'model_id': get_model_id(base_model_path),
+                   'cutoff_layer': Cutoff_Layer,
+                   'dataset': get_dataset_fingerprint(store_path, labels)}
+    features = cache_features(trunk, data, trunk_cache_path, batch_size=batch_size, fingerprint=fingerprint)
+
+    # input pipelines (the cached activations are fed to the tail as they are)
+    train_dataset = make_dataset(features, labels, train_indx, batch_size=batch_size, shuffle=True,
+                                 cache=cache_faces, standardize=False, seed=shuffle_seed)
+    test_dataset = make_dataset(features, labels, test_indx, batch_size=batch_size, cache=cache_faces,
+                                standardize=False)
+
+    best_val_loss = np.inf
+
+    for head in head_sweep:
+        # trainable tail of the CNN (fresh copy of the pre-trained weights) and regression head
+        with strategy.scope():
+            _, tail = split_model(inception_resnet_v1, cut_index)
+
+            head_model = models.Sequential()
+            head_model.add(tail)
+            add_head(head_model, head['width'])
+
+            compile_model(head_model, head['lr'])
+
+        early = EarlyStopping(monitor='val_loss', min_delta=1e-08, patience=200, verbose=0, mode='min', baseline=None,
+                              restore_best_weights=True)
+        lr_reduce = ReduceLROnPlateau(monitor='val_loss', factor=head['lr_factor'], patience=head['lr_patience'], verbose=0,
+                                      mode='min', min_delta=0.0001, cooldown=2, min_lr=1e-15)
+        head_history = History()
+
+        head_model.fit(train_dataset, epochs=1000,
+                       validation_data=test_dataset, callbacks = [early, lr_reduce, head_history])
+
+        val_loss = min(head_history.history['val_loss'])
+        print('Head %s: best validation loss %g' % (head, val_loss))
+
+        if val_loss < best_val_loss:
+            best_val_loss, best_head, best_model, history = val_loss, head, head_model, head_history
+
+    print('Selected head: %s' % best_head)
 
-# Callbacks for monitoring and controlling training progress:
-# early stopping if performance no longer improving
-early = EarlyStopping(monitor='val_loss', min_delta=1e-08, patience=200, verbose=0, mode='min', baseline=None,
-						  restore_best_weights=True)
+    # copy the trained weights back into the full model (trainable tail by layer name, head by position)
+    with strategy.scope():
+        model = models.Sequential()
+        model.add(inception_resnet_v1)
+        add_head(model, best_head['width'])
 
-# reduce learning rate if loss function plateaus
-lr_reduce = ReduceLROnPlateau(monitor='val_loss', factor=0.2, patience=5, verbose=0, mode='min', min_delta=0.0001, cooldown=2, min_lr=1e-15)
+        compile_model(model, best_head['lr'])
 
-# record training events
-history = History()
+    copy_weights(best_model.layers[0], inception_resnet_v1)
 
-# Fit the deep learning model
-parallel_model.fit(standardize(trainX), trainy, epochs=1000, batch_size=256,
-					validation_data=(standardize(testX),testy), shuffle = True, callbacks = [early, lr_reduce, history])
+    for layer, trained_layer in zip(model.layers[1:], best_model.layers[1:]):
+        layer.set_weights(trained_layer.get_weights())
 
-#retrieve the core model from the 2-GPU concatenated parallel model
-model = parallel_model.get_layer('sequential_1')
+# only the chief writes the results (the model is the same on every replica)
+if not is_chief(strategy):
+    sys.exit(0)
 
 # write the trained deep learning model to file
 model.save(rootpath + 'facenet.h5', overwrite=True)
 
 # get training and validation results
-acc = history.history['mean_absolute_error']
-val_acc = history.history['val_mean_absolute_error']
+acc = history.history['mae']
+val_acc = history.history['val_mae']
 loss = history.history['loss']
 val_loss = history.history['val_loss']
 
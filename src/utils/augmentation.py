@@ -0,0 +1,165 @@
+# -----------------
+# Offline augmentation of the face crops (age rebalancing of the training dataset),
+# run in parallel and streamed to a face store
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import multiprocessing
+
+import numpy as np
+
+from utils.face_store import load_faces
+
+## ----------------------------------------
+
+def plan_augmentation(labels, agelist, target_count):
+
+  """
+  Compute how many synthetic samples are needed for each age, so that every age in "agelist"
+  reaches "target_count" samples, and which record each synthetic sample is derived from.
+  As with "ImageDataGenerator.flow", the records of each age are cycled through in random order,
+  so that every record is augmented (about) the same number of times.
+  Returns the indices of the source records and the labels of the synthetic samples.
+
+  @params:
+    labels - required: array storing the age label of each record.
+    agelist - required: list of the ages to be augmented.
+    target_count - required: number of samples each age should reach.
+
+  """
+
+  src_indx_list = list()
+  aug_labels_list = list()
+
+  for age in agelist:
+    age_indx = np.where(labels == age)[0]
+
+    n_new = max(0, target_count - len(age_indx))
+
+    if not n_new or not len(age_indx):
+      continue
+
+    n_epochs = int(np.ceil(n_new / float(len(age_indx))))
+    src_indx = np.concatenate([np.random.permutation(age_indx) for _ in range(n_epochs)])[:n_new]
+
+    src_indx_list.append(src_indx)
+    aug_labels_list.append(labels[src_indx])
+
+  if not src_indx_list:
+    return np.zeros((0, ), dtype = np.int64), labels[:0]
+
+  return np.concatenate(src_indx_list), np.concatenate(aug_labels_list)
+
+## ----------------------------------------
+
+# face store and augmentation parameters owned by each of the worker processes
+_worker_faces = None
+_worker_datagen = None
+
+def _init_augmentation_worker(store_path, datagen):
+
+  """
+  Initialise an augmentation worker process, memory-mapping the output face store
+  (source records are read from, and synthetic samples written to, the same store).
+
+  @params:
+    store_path - required: path to the face store.
+    datagen - required: the "ImageDataGenerator" object storing the augmentation parameters.
+
+  """
+
+  global _worker_faces, _worker_datagen
+
+  _worker_faces, _ = load_faces(store_path, mmap_mode = 'r+', allow_incomplete = True)
+  _worker_datagen = datagen
+
+def _augment_chunk(args):
+
+  src_pos, dst_pos, seeds = args
+
+  for src, dst, seed in zip(src_pos, dst_pos, seeds):
+    x = _worker_datagen.random_transform(np.asarray(_worker_faces[src], dtype = np.float32), seed = int(seed))
+    _worker_faces[dst] = np.clip(np.rint(x), 0, 255)
+
+  _worker_faces.flush()
+
+  return len(src_pos)
+
+## ----------------------------------------
+
+def augment_to_store(store_path, src_pos, dst_pos, datagen, workers = 1, chunksize = 256):
+
+  """
+  Generate the synthetic samples, applying a random transformation (see "ImageDataGenerator")
+  to the given source records, and write them straight to the (preallocated) face store.
+
+  Every sample is drawn with its own seed, taken from the global numpy random generator, so that
+  the output does not depend on the number of workers nor on the order the chunks are processed in.
+
+  @params:
+    store_path - required: path to the face store (see "create_face_store"), storing the source
+      records already.
+    src_pos - required: position in the store of the record each synthetic sample is derived from.
+    dst_pos - required: position in the store each synthetic sample is written to.
+    datagen - required: the "ImageDataGenerator" object storing the augmentation parameters.
+    workers - optional: number of worker processes.
+    chunksize - optional: number of samples sent to a worker process at once.
+
+  """
+
+  if not len(src_pos):
+    return
+
+  seeds = np.random.randint(0, 2**31 - 1, size = len(src_pos))
+
+  task_list = [(src_pos[i:i + chunksize], dst_pos[i:i + chunksize], seeds[i:i + chunksize])
+               for i in range(0, len(src_pos), chunksize)]
+
+  n_done = 0
+
+  if workers <= 1:
+
+    # "random_transform" reseeds the global random generator - restore it afterwards
+    random_state = np.random.get_state()
+
+    _init_augmentation_worker(store_path, datagen)
+
+    try:
+      for task in task_list:
+        n_done += _augment_chunk(task)
+        print('Processing augmentation: %d of %d samples' % (n_done, len(src_pos)), end = '\r')
+    finally:
+      np.random.set_state(random_state)
+
+    print('')
+    return
+
+  # keras (and TF) are not fork-safe - start the workers from a fresh interpreter
+  ctx = multiprocessing.get_context('spawn')
+
+  pool = ctx.Pool(processes = workers,
+                  initializer = _init_augmentation_worker,
+                  initargs = (store_path, datagen))
+
+  try:
+    for n in pool.imap_unordered(_augment_chunk, task_list):
+      n_done += n
+      print('Processing augmentation: %d of %d samples' % (n_done, len(src_pos)), end = '\r')
+  finally:
+    pool.terminate()
+    pool.join()
+
+  print('')
@@ -0,0 +1,143 @@
+# -----------------
+# Durable checkpoint of the face localization and age estimation results,
+# used to resume interrupted FaceAge runs
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import os
+import json
+
+import numpy as np
+
+from utils.detection_cache import serialize_detections
+
+## ----------------------------------------
+
+class RunCheckpoint(object):
+
+  """
+  Append-only checkpoint (JSON lines) of the results of a FaceAge run.
+
+  Two kinds of records are written to the file: the MTCNN output for every subject whose face
+  was localised, and the FaceAge estimate for every subject processed by the model (None if the
+  face localization failed, so that the subject is not processed again when resuming).
+  The records are buffered and made durable (flushed and synced to disk) every time "flush"
+  is called - i.e., after every batch processed by the FaceAge model.
+
+  @params:
+    checkpoint_path - required: path to the checkpoint file.
+    resume - optional: if True, the records written by a previous (interrupted) run are kept
+      and new records are appended; otherwise, the file is overwritten.
+
+  """
+
+  def __init__(self, checkpoint_path, resume = False):
+
+    self.checkpoint_path = checkpoint_path
+
+    self.mtcnn_output_dict = dict()
+    self.faceage_dict = dict()
+
+    resume = resume and os.path.exists(checkpoint_path)
+
+    if resume:
+      self._load()
+
+    self.f = open(checkpoint_path, 'a' if resume else 'w')
+
+    # make sure new records do not get appended to an incomplete line (blank lines are ignored)
+    if resume:
+      self.f.write("\n")
+
+  ## ----------------------------------------
+
+  def _load(self):
+
+    """
+    Read the records written by a previous run. Incomplete records (e.g., the last line
+    written before the run was interrupted) are ignored.
+
+    """
+
+    with open(self.checkpoint_path) as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          continue
+
+        subj_id = record["subj_id"]
+
+        if "mtcnn_output_dict" in record:
+          self.mtcnn_output_dict[subj_id] = record["mtcnn_output_dict"]
+        elif "faceage" in record:
+          faceage = record["faceage"]
+          self.faceage_dict[subj_id] = np.float32(faceage) if faceage is not None else None
+
+  ## ----------------------------------------
+
+  def add_detection(self, subj_id, mtcnn_output_dict):
+
+    """
+    Record the MTCNN output associated with the given subject.
+
+    @params:
+      subj_id - required: the subject identifier.
+      mtcnn_output_dict - required: the MTCNN output associated with the subject's face.
+
+    """
+
+    record = {"subj_id": subj_id,
+              "mtcnn_output_dict": json.loads(serialize_detections([mtcnn_output_dict]))[0]}
+
+    self.f.write(json.dumps(record) + "\n")
+
+  ## ----------------------------------------
+
+  def add_prediction(self, subj_id, faceage):
+
+    """
+    Record the FaceAge estimate associated with the given subject.
+
+    @params:
+      subj_id - required: the subject identifier.
+      faceage - required: the FaceAge estimate (None if the face localization failed).
+
+    """
+
+    record = {"subj_id": subj_id,
+              "faceage": float(faceage) if faceage is not None else None}
+
+    self.f.write(json.dumps(record) + "\n")
+
+  ## ----------------------------------------
+
+  def flush(self):
+
+    """
+    Make all the records written so far durable.
+
+    """
+
+    self.f.flush()
+    os.fsync(self.f.fileno())
+
+  ## ----------------------------------------
+
+  def close(self):
+
+    self.flush()
+    self.f.close()
@@ -0,0 +1,100 @@
+# -----------------
+# Train/validation splits of the FaceAge development dataset (hold-out, k-fold and
+# age-stratified k-fold), expressed as positions in the shared face store
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import numpy as np
+
+SPLIT_MODES = ("holdout", "kfold", "stratified_kfold")
+
+## ----------------------------------------
+
+def get_fold_assignment(labels, n_folds, stratified = False):
+
+  """
+  Assign each record to one of "n_folds" folds. The records are expected to be stored in random
+  order already (as is the case for the rebalanced development dataset), so that no shuffling
+  is needed and the assignment is reproducible.
+  Returns an array storing the fold of each record.
+
+  @params:
+    labels - required: array storing the age label of each record.
+    n_folds - required: number of folds.
+    stratified - optional: if True, the records of each age are dealt out across the folds in
+      turn, so that every fold has (about) the same age distribution; otherwise, each fold is a
+      contiguous block of records.
+
+  """
+
+  labels = np.asarray(labels)
+  n_records = len(labels)
+
+  if n_folds < 2 or n_folds > n_records:
+    raise ValueError("The number of folds must be between 2 and %d, got %d."%(n_records, n_folds))
+
+  if not stratified:
+    return np.repeat(np.arange(n_folds), [len(fold) for fold in np.array_split(np.arange(n_records), n_folds)])
+
+  fold_assignment = np.zeros((n_records, ), dtype = np.int64)
+
+  # the dealing of each age starts where the previous one stopped, so that the leftover records
+  # do not all end up in the first folds
+  offset = 0
+
+  for age in np.unique(labels):
+    age_indx = np.where(labels == age)[0]
+
+    fold_assignment[age_indx] = (offset + np.arange(len(age_indx))) % n_folds
+    offset = (offset + len(age_indx)) % n_folds
+
+  return fold_assignment
+
+## ----------------------------------------
+
+def split_indices(labels, mode = "holdout", val_frac = 0.1, n_folds = 10, fold_index = 0):
+
+  """
+  Split the records into a training and a validation set. No data is copied: the positions
+  returned are meant to index the (memory-mapped) face store, e.g., through "make_dataset".
+  Returns the positions of the training and of the validation records.
+
+  @params:
+    labels - required: array storing the age label of each record.
+    mode - optional: "holdout" (the last "val_frac" of the records are used for validation),
+      "kfold" or "stratified_kfold" (fold "fold_index" of "n_folds" is used for validation,
+      see "get_fold_assignment").
+    val_frac - optional: fraction of the records used for validation (hold-out mode).
+    n_folds - optional: number of folds (k-fold modes).
+    fold_index - optional: index of the fold used for validation (k-fold modes).
+
+  """
+
+  n_records = len(labels)
+
+  if mode == "holdout":
+    n_train = int((1 - val_frac) * n_records)
+    return np.arange(n_train), np.arange(n_train, n_records)
+
+  if mode not in SPLIT_MODES:
+    raise ValueError("Unknown split mode: %s (expected one of %s)."%(mode, ", ".join(SPLIT_MODES)))
+
+  if not 0 <= fold_index < n_folds:
+    raise ValueError("The fold index must be between 0 and %d, got %d."%(n_folds - 1, fold_index))
+
+  fold_assignment = get_fold_assignment(labels, n_folds, stratified = mode == "stratified_kfold")
+
+  return np.where(fold_assignment != fold_index)[0], np.where(fold_assignment == fold_index)[0]
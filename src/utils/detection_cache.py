@@ -0,0 +1,200 @@
+# -----------------
+# Persistent, content-addressed cache of the MTCNN face detections
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+## ----------------------------------------
+
+def get_image_hash(image_bytes):
+
+  """
+  Returns the hash identifying the content of an image file (SHA-1 of the raw bytes).
+
+  @params:
+    image_bytes - required: the raw content of the image file.
+
+  """
+
+  return hashlib.sha1(image_bytes).hexdigest()
+
+## ----------------------------------------
+
+def serialize_detections(detections):
+
+  """
+  Convert the output of the MTCNN detector (list of dictionaries storing the bounding box,
+  the keypoints and the confidence for each face) to a JSON string.
+
+  @params:
+    detections - required: the list returned by "FaceDetector.detect_faces".
+
+  """
+
+  detection_list = list()
+
+  for detection in detections:
+    detection_list.append({"box": [int(x) for x in detection["box"]],
+                           "confidence": float(detection["confidence"]),
+                           "keypoints": {k: [int(x) for x in v] for k, v in detection["keypoints"].items()}})
+
+  return json.dumps(detection_list)
+
+## ----------------------------------------
+
+class DetectionCache(object):
+
+  """
+  On-disk (SQLite) cache of the MTCNN face detections.
+
+  Each entry is keyed by the hash of the image bytes and by the signature of the detector
+  (MTCNN version and parameters), and stores the full MTCNN output for the image. In this way,
+  the face localization step can be skipped for all the images already processed by a previous
+  run - even if the files were renamed or moved - and changing the detector parameters
+  invalidates the cache automatically.
+
+  The database is opened in WAL mode, so that the face localization worker processes can share
+  the same cache file. The cache is bounded in size: when "evict" is called, the least recently
+  used entries exceeding "max_entries" are removed.
+
+  @params:
+    cache_path - required: path to the SQLite database file (created if it does not exist).
+    max_entries - optional: maximum number of entries kept in the cache.
+
+  """
+
+  def __init__(self, cache_path, max_entries = 1000000):
+
+    self.cache_path = cache_path
+    self.max_entries = max_entries
+
+    cache_dir = os.path.dirname(os.path.abspath(cache_path))
+
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+
+    # autocommit mode; the timeout allows concurrent writers (i.e., the worker processes) to wait
+    self.conn = sqlite3.connect(cache_path, timeout = 60, isolation_level = None, check_same_thread = False)
+
+    self.conn.execute("PRAGMA journal_mode = WAL")
+    self.conn.execute("PRAGMA synchronous = NORMAL")
+
+    self.conn.execute("CREATE TABLE IF NOT EXISTS detections ("
+                      "image_hash TEXT NOT NULL, "
+                      "detector_signature TEXT NOT NULL, "
+                      "detections TEXT NOT NULL, "
+                      "last_access REAL NOT NULL, "
+                      "PRIMARY KEY (image_hash, detector_signature))")
+
+    self.conn.execute("CREATE INDEX IF NOT EXISTS detections_last_access ON detections (last_access)")
+
+    self.n_hits = 0
+    self.n_misses = 0
+    self.n_evicted = 0
+
+  ## ----------------------------------------
+
+  def get(self, image_hash, detector_signature):
+
+    """
+    Returns the cached MTCNN output (list of dictionaries, one per face) for the given image
+    and detector, or None if the image was never processed with the same detector.
+
+    @params:
+      image_hash - required: the hash of the image bytes (see "get_image_hash").
+      detector_signature - required: the signature of the detector (see "FaceDetector.get_signature").
+
+    """
+
+    row = self.conn.execute("SELECT detections FROM detections "
+                            "WHERE image_hash = ? AND detector_signature = ?",
+                            (image_hash, detector_signature)).fetchone()
+
+    if row is None:
+      self.n_misses += 1
+      return None
+
+    self.n_hits += 1
+
+    self.conn.execute("UPDATE detections SET last_access = ? "
+                      "WHERE image_hash = ? AND detector_signature = ?",
+                      (time.time(), image_hash, detector_signature))
+
+    return json.loads(row[0])
+
+  ## ----------------------------------------
+
+  def put(self, image_hash, detector_signature, detections):
+
+    """
+    Store the MTCNN output for the given image and detector.
+
+    @params:
+      image_hash - required: the hash of the image bytes (see "get_image_hash").
+      detector_signature - required: the signature of the detector (see "FaceDetector.get_signature").
+      detections - required: the list returned by "FaceDetector.detect_faces".
+
+    """
+
+    self.conn.execute("INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?)",
+                      (image_hash, detector_signature, serialize_detections(detections), time.time()))
+
+  ## ----------------------------------------
+
+  def evict(self):
+
+    """
+    Remove the least recently used entries, so that at most "max_entries" entries are kept.
+    Returns the number of entries removed.
+
+    """
+
+    n_entries = self.get_size()
+
+    if n_entries <= self.max_entries:
+      return 0
+
+    n_evicted = n_entries - self.max_entries
+
+    self.conn.execute("DELETE FROM detections WHERE rowid IN "
+                      "(SELECT rowid FROM detections ORDER BY last_access ASC LIMIT ?)",
+                      (n_evicted, ))
+
+    self.n_evicted += n_evicted
+
+    return n_evicted
+
+  ## ----------------------------------------
+
+  def get_size(self):
+
+    """
+    Returns the number of entries stored in the cache.
+
+    """
+
+    return self.conn.execute("SELECT COUNT(*) FROM detections").fetchone()[0]
+
+  ## ----------------------------------------
+
+  def close(self):
+
+    self.conn.close()
@@ -0,0 +1,542 @@
+# -----------------
+# Face localization engine, shared by the FaceAge face extraction and prediction scripts
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import io
+import os
+import json
+import time
+import multiprocessing
+
+import PIL.Image
+import mtcnn
+import numpy as np
+import tensorflow as tf
+
+from utils.detection_cache import DetectionCache, get_image_hash, serialize_detections
+
+## ----------------------------------------
+
+class FaceDetector(object):
+
+  """
+  Long-lived wrapper around the MTCNN face detector (Zhang et al. 2015).
+
+  The P-net, R-net and O-net weights are loaded only once, when the object is created,
+  and the same networks are reused for every image processed afterwards. Instantiating
+  a new "mtcnn.mtcnn.MTCNN" object for every image keeps adding nodes to the TF graph,
+  which is what forced the pipeline to tear down the Keras session every few images.
+
+  The object also keeps track of the time spent in the detection step, so that the
+  per-image latency can be reported at the end of a run.
+
+  @params:
+    min_face_size - optional: minimum size (in pixels) of the faces to be detected.
+    scale_factor - optional: scale factor used to build the MTCNN image pyramid.
+    steps_threshold - optional: confidence thresholds for the P-net, R-net and O-net stages.
+    decode_max_side - optional: if non-zero, JPEG images are decoded at reduced resolution (so that
+      their largest side is as close as possible to, but not smaller than, this value) before being
+      processed by the detector - see "detect_faces_in_bytes". 0 to always use the full resolution.
+
+  """
+
+  def __init__(self, min_face_size = 20, scale_factor = 0.709, steps_threshold = None, decode_max_side = 0):
+
+    self.min_face_size = min_face_size
+    self.scale_factor = scale_factor
+    self.steps_threshold = steps_threshold if steps_threshold is not None else [0.6, 0.7, 0.7]
+    self.decode_max_side = decode_max_side
+
+    t = time.time()
+
+    self.detector = mtcnn.mtcnn.MTCNN(min_face_size = self.min_face_size,
+                                      steps_threshold = self.steps_threshold,
+                                      scale_factor = self.scale_factor)
+
+    self.init_time = time.time() - t
+
+    self.n_images = 0
+    self.first_image_time = 0.
+    self.total_time = 0.
+
+  ## ----------------------------------------
+
+  def detect_faces(self, pat_img):
+
+    """
+    Run the MTCNN face detector on an image.
+    Returns the full MTCNN output, i.e., a list storing - for every face found in the image -
+    a dictionary with the bounding box, the keypoints and the detection confidence.
+
+    @params:
+      pat_img - required: RGB image to be processed (numpy array, HxWx3).
+
+    """
+
+    t = time.time()
+
+    try:
+      return self.detector.detect_faces(pat_img)
+    finally:
+      elapsed = time.time() - t
+
+      # the first call includes the building of the Keras predict functions,
+      # and is therefore reported separately from the steady state
+      if not self.n_images:
+        self.first_image_time = elapsed
+
+      self.n_images += 1
+      self.total_time += elapsed
+
+  ## ----------------------------------------
+
+  def get_signature(self):
+
+    """
+    Returns a string identifying the detector (MTCNN version and parameters), used to make sure
+    cached detections are reused only if they were obtained with the very same detector.
+
+    """
+
+    signature = "mtcnn-%s|min_face_size=%s|scale_factor=%s|steps_threshold=%s"%(mtcnn.__version__,
+                                                                               self.min_face_size,
+                                                                               self.scale_factor,
+                                                                               list(self.steps_threshold))
+
+    # detections obtained on reduced-resolution images are (slightly) different
+    if self.decode_max_side:
+      signature += "|decode_max_side=%s"%(self.decode_max_side)
+
+    return signature
+
+  ## ----------------------------------------
+
+  def get_latency_summary(self):
+
+    """
+    Returns a string summarising the time spent by the detector, i.e., the time needed to load
+    the weights, the latency for the first image and the mean per-image latency afterwards.
+
+    """
+
+    if self.n_images > 1:
+      steady_state_time = (self.total_time - self.first_image_time) / (self.n_images - 1)
+    else:
+      steady_state_time = self.first_image_time
+
+    return ("MTCNN weights loaded in %g seconds; first image in %g seconds; "
+            "%g seconds per image afterwards (%g images)."%(self.init_time,
+                                                            self.first_image_time,
+                                                            steady_state_time,
+                                                            self.n_images))
+
+## ----------------------------------------
+
+def read_image_bytes(path_to_image):
+
+  """
+  Read the raw content of the given image file.
+
+  @params:
+    path_to_image - required: absolute path to the image file to be processed.
+
+  """
+
+  # sanity check
+  assert os.path.exists(path_to_image)
+
+  with open(path_to_image, 'rb') as f:
+    return f.read()
+
+## ----------------------------------------
+
+def decode_image(image_bytes):
+
+  """
+  Decode the given (raw) image file content into an RGB array. Every image is decoded only once
+  by the pipeline, and the resulting array is used both for the face localization and the cropping.
+
+  @params:
+    image_bytes - required: the raw content of the image file (e.g., obtained by running "read_image_bytes").
+
+  """
+
+  pat_img_pil = PIL.Image.open(io.BytesIO(image_bytes))
+
+  # grayscale, palette and RGBA images are converted, as the MTCNN detector expects RGB inputs
+  if pat_img_pil.mode != 'RGB':
+    pat_img_pil = pat_img_pil.convert('RGB')
+
+  return np.asarray(pat_img_pil)
+
+## ----------------------------------------
+
+def decode_image_draft(image_bytes, max_side):
+
+  """
+  Decode the given (raw) image file content into an RGB array, at reduced resolution if possible.
+  For JPEG files, the downscaling happens in the DCT domain while decoding (by a factor of 2, 4
+  or 8 - see "PIL.Image.draft"), which is much faster than decoding the full image and resizing it:
+  the largest side of the decoded image is as close as possible to, but not smaller than, "max_side".
+  Other formats are decoded at full resolution.
+  Returns the decoded image and the scale factors (along x and y) mapping its coordinates
+  to the full-resolution image.
+
+  @params:
+    image_bytes - required: the raw content of the image file (e.g., obtained by running "read_image_bytes").
+    max_side - required: target size of the largest side of the decoded image.
+
+  """
+
+  pat_img_pil = PIL.Image.open(io.BytesIO(image_bytes))
+
+  width, height = pat_img_pil.size
+
+  if pat_img_pil.format == 'JPEG' and max(width, height) > max_side:
+    ratio = max_side / float(max(width, height))
+    pat_img_pil.draft('RGB', (int(np.ceil(width * ratio)), int(np.ceil(height * ratio))))
+
+  scale = (width / float(pat_img_pil.size[0]), height / float(pat_img_pil.size[1]))
+
+  if pat_img_pil.mode != 'RGB':
+    pat_img_pil = pat_img_pil.convert('RGB')
+
+  return np.asarray(pat_img_pil), scale
+
+## ----------------------------------------
+
+def scale_detections(detections, scale):
+
+  """
+  Map the MTCNN output obtained on a resized image (bounding boxes and keypoints) to the
+  coordinates of the original image.
+  Returns the list of the rescaled detections.
+
+  @params:
+    detections - required: the MTCNN output (see "FaceDetector.detect_faces").
+    scale - required: the scale factors (along x and y) mapping the coordinates of the resized
+      image to the original image (e.g., obtained by running "decode_image_draft").
+
+  """
+
+  scale_x, scale_y = scale
+
+  scaled_detections = list()
+
+  for detection in detections:
+    x1, y1, width, height = detection['box']
+
+    scaled_detection = dict(detection)
+    scaled_detection['box'] = [int(round(x1 * scale_x)), int(round(y1 * scale_y)),
+                               int(round(width * scale_x)), int(round(height * scale_y))]
+    scaled_detection['keypoints'] = {name: (int(round(x * scale_x)), int(round(y * scale_y)))
+                                     for name, (x, y) in detection.get('keypoints', dict()).items()}
+
+    scaled_detections.append(scaled_detection)
+
+  return scaled_detections
+
+## ----------------------------------------
+
+def detect_faces_in_bytes(detector, image_bytes, lock = None):
+
+  """
+  Decode the given image and run the MTCNN face detector on it. If the detector was set up with a
+  "decode_max_side", JPEG images are decoded at reduced resolution (see "decode_image_draft"),
+  cutting both the decoding and the image pyramid cost, and the detections are mapped back to the
+  full-resolution coordinates.
+  Returns the MTCNN output (in full-resolution coordinates) and the decoded image if it is at full
+  resolution (None otherwise).
+
+  @params:
+    detector - required: the "FaceDetector" object.
+    image_bytes - required: the raw content of the image file (e.g., obtained by running "read_image_bytes").
+    lock - optional: lock held while the detector runs (e.g., when the detector is shared by several
+      threads) - the image is decoded outside of it.
+
+  """
+
+  def detect_faces(pat_img):
+    if lock is None:
+      return detector.detect_faces(pat_img)
+
+    with lock:
+      return detector.detect_faces(pat_img)
+
+  if not detector.decode_max_side:
+    pat_img = decode_image(image_bytes)
+    return detect_faces(pat_img), pat_img
+
+  pat_img, scale = decode_image_draft(image_bytes, detector.decode_max_side)
+
+  if scale == (1., 1.):
+    return detect_faces(pat_img), pat_img
+
+  return scale_detections(detect_faces(pat_img), scale), None
+
+## ----------------------------------------
+
+def get_face_crop_from_bytes(image_bytes, mtcnn_output_dict, required_size = (160, 160), reduced = True):
+
+  """
+  Decode the given image and crop the face, as "get_face_crop". If "reduced" is True, JPEG images
+  are decoded at the lowest resolution (among the DCT-domain scales, see "decode_image_draft") at
+  which the face is still at least as large as the output crop - so that the crop is equivalent to
+  the one obtained from the full-resolution image.
+
+  @params:
+    image_bytes - required: the raw content of the image file (e.g., obtained by running "read_image_bytes").
+    mtcnn_output_dict - required: dictionary storing the bounding box (full-resolution coordinates).
+    required_size - optional: size of the output crop (i.e., the model input size).
+    reduced - optional: if False, the image is decoded at full resolution.
+
+  """
+
+  _, _, width, height = mtcnn_output_dict['box']
+
+  # largest downscaling factor keeping the face at least as large as the output crop
+  factor = min(width / float(required_size[0]), height / float(required_size[1]))
+
+  if not reduced or factor < 2:
+    return get_face_crop(decode_image(image_bytes), mtcnn_output_dict, required_size)
+
+  pat_img_pil = PIL.Image.open(io.BytesIO(image_bytes))
+  max_side = int(np.ceil(max(pat_img_pil.size) / factor))
+
+  pat_img, scale = decode_image_draft(image_bytes, max_side)
+
+  return get_face_crop(pat_img, scale_detections([mtcnn_output_dict], (1. / scale[0], 1. / scale[1]))[0],
+                       required_size)
+
+## ----------------------------------------
+
+def read_image(path_to_image):
+
+  """
+  Read and decode the given image file into an RGB array.
+
+  @params:
+    path_to_image - required: absolute path to the image file to be processed.
+
+  """
+
+  return decode_image(read_image_bytes(path_to_image))
+
+## ----------------------------------------
+
+def get_face_crop(pat_img, mtcnn_output_dict, required_size = (160, 160)):
+
+  """
+  Crop the face from the given image and resize it to the FaceAge model input size.
+  Requires a bounding box (around the face) to be computed prior to this step.
+
+  @params:
+    pat_img - required: the decoded image to be processed (e.g., obtained by running "read_image").
+    mtcnn_output_dict - required: dictionary storing the aforementioned bounding box
+      (e.g., the first element of the list returned by "FaceDetector.detect_faces")
+    required_size - optional: size of the output crop (i.e., the model input size).
+
+  """
+
+  # extract the bounding box from the first face
+  x1, y1, width, height = mtcnn_output_dict['box']
+  x1, y1 = abs(x1), abs(y1)
+  x2, y2 = x1 + width, y1 + height
+
+  # crop the face
+  pat_face = pat_img[y1:y2, x1:x2]
+
+  # resize cropped image to the model input size
+  pat_face_pil = PIL.Image.fromarray(np.uint8(pat_face)).convert('RGB')
+
+  return np.asarray(pat_face_pil.resize(required_size))
+
+## ----------------------------------------
+
+def localize_face(detector, path_to_image, cache = None, mtcnn_output_dict = None):
+
+  """
+  Decode the given image, localise the subject's face using the MTCNN face detector and crop it.
+  Returns the MTCNN output associated with the first face found in the image (bounding box,
+  keypoints and confidence) and the cropped face - or an empty dictionary and None if the
+  processing failed - together with a flag indicating whether the detection was found in the
+  cache (None if no cache is used).
+
+  If a cache is provided, it is consulted before running the detector, and updated afterwards.
+  Errors reading or writing the cache (e.g., a locked database) are not caught.
+  If the MTCNN output is already known (e.g., from the checkpoint of an interrupted run), the
+  image is only decoded and cropped.
+
+  If the detector was set up with a "decode_max_side", the detector runs on a reduced-resolution
+  version of the image (see "detect_faces_in_bytes"), and the face is cropped from the lowest
+  resolution at which it is still at least as large as the crop (see "get_face_crop_from_bytes").
+  The MTCNN output is always expressed in full-resolution coordinates.
+
+  Make sure the image contains only one subject for the pipeline to work as intended.
+
+  @params:
+    detector - required: the "FaceDetector" object (shared across all the images to be processed)
+    path_to_image - required: absolute path to the image file to be processed.
+    cache - optional: the "DetectionCache" object storing the detections from previous runs.
+    mtcnn_output_dict - optional: the MTCNN output associated with the subject's face, if known.
+
+  """
+
+  cache_hit = None
+
+  # only the decoding and detection failures are caught (the image is reported as having no
+  # face) - errors reading or writing the cache are raised, so that the image can be retried
+  try:
+    image_bytes = read_image_bytes(path_to_image)
+  except:
+    print('\nERROR: Processing error for file "%s"'%(path_to_image))
+    return dict(), None, cache_hit
+
+  # decoded along with the detection, if at full resolution
+  pat_img = None
+
+  if mtcnn_output_dict:
+    detections = [mtcnn_output_dict]
+  else:
+    if cache is not None:
+      image_hash = get_image_hash(image_bytes)
+      detector_signature = detector.get_signature()
+
+      detections = cache.get(image_hash, detector_signature)
+      cache_hit = detections is not None
+
+    if not cache_hit:
+      try:
+        detections, pat_img = detect_faces_in_bytes(detector, image_bytes)
+      except:
+        print('\nERROR: Processing error for file "%s"'%(path_to_image))
+        return dict(), None, cache_hit
+
+      if cache is not None:
+        cache.put(image_hash, detector_signature, detections)
+
+        # make sure the output does not depend on whether the detections were cached or not
+        detections = json.loads(serialize_detections(detections))
+
+  try:
+    mtcnn_output_dict = detections[0]
+
+    if pat_img is not None:
+      pat_face = get_face_crop(pat_img, mtcnn_output_dict)
+    else:
+      pat_face = get_face_crop_from_bytes(image_bytes, mtcnn_output_dict, reduced = bool(detector.decode_max_side))
+
+    return mtcnn_output_dict, pat_face, cache_hit
+  except:
+    print('\nERROR: Processing error for file "%s"'%(path_to_image))
+    return dict(), None, cache_hit
+
+## ----------------------------------------
+
+# detector and detection cache owned by each of the worker processes (see "localize_face_list")
+_worker_detector = None
+_worker_cache = None
+
+def _init_localization_worker(n_threads, cache_path, decode_max_side):
+
+  """
+  Initialise a face localization worker process: restrict the number of threads TF is allowed
+  to use (so that the workers do not compete for the same cores), load the MTCNN weights and
+  open the detection cache (if any).
+
+  @params:
+    n_threads - required: number of intra-op threads assigned to the worker.
+    cache_path - required: path to the detection cache database (or None, if no cache is used).
+    decode_max_side - required: see "FaceDetector".
+
+  """
+
+  global _worker_detector, _worker_cache
+
+  tf.compat.v1.disable_eager_execution()
+
+  tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+  tf.config.threading.set_inter_op_parallelism_threads(1)
+
+  _worker_detector = FaceDetector(decode_max_side = decode_max_side)
+
+  if cache_path is not None:
+    _worker_cache = DetectionCache(cache_path)
+
+def _localize_face_worker(args):
+
+  path_to_image, mtcnn_output_dict = args
+
+  return localize_face(_worker_detector, path_to_image, _worker_cache, mtcnn_output_dict)
+
+## ----------------------------------------
+
+def localize_face_list(path_list, detector = None, workers = 1, chunksize = 4, cache = None,
+                       mtcnn_output_list = None, decode_max_side = 0):
+
+  """
+  Localise and crop the faces for all the images in the given list.
+  Yields a tuple "(path_to_image, mtcnn_output_dict, pat_face, cache_hit)" for each image
+  (see "localize_face"), in the same order as the input list.
+
+  If more than one worker is requested, the list is sharded (in chunks of "chunksize" images)
+  across a pool of processes, each holding its own MTCNN detector and an equal share of the
+  CPU cores. The results are merged back in input order, so that the output is deterministic.
+
+  @params:
+    path_list - required: list of absolute paths to the image files to be processed.
+    detector - optional: the "FaceDetector" object to be used if "workers" is 1.
+    workers - optional: number of worker processes.
+    chunksize - optional: number of images sent to a worker process at once.
+    cache - optional: the "DetectionCache" object storing the detections from previous runs
+      (the worker processes open their own connection to the same database).
+    mtcnn_output_list - optional: list of the MTCNN outputs already known for the images in
+      "path_list" (None for the images to be processed by the detector).
+    decode_max_side - optional: reduced decoding resolution of the detectors built by this function,
+      i.e., if no detector is given or by the worker processes (see "FaceDetector").
+
+  """
+
+  if mtcnn_output_list is None:
+    mtcnn_output_list = [None] * len(path_list)
+
+  if workers <= 1:
+
+    detector = detector if detector is not None else FaceDetector(decode_max_side = decode_max_side)
+
+    for path_to_image, mtcnn_output_dict in zip(path_list, mtcnn_output_list):
+      yield (path_to_image, ) + localize_face(detector, path_to_image, cache, mtcnn_output_dict)
+
+    return
+
+  # TF is not fork-safe - start the workers from a fresh interpreter
+  ctx = multiprocessing.get_context('spawn')
+
+  n_threads = max(1, multiprocessing.cpu_count() // workers)
+
+  pool = ctx.Pool(processes = workers,
+                  initializer = _init_localization_worker,
+                  initargs = (n_threads, cache.cache_path if cache is not None else None, decode_max_side))
+
+  try:
+    for path_to_image, res in zip(path_list, pool.imap(_localize_face_worker,
+                                                       zip(path_list, mtcnn_output_list),
+                                                       chunksize)):
+      yield (path_to_image, ) + res
+  finally:
+    pool.terminate()
+    pool.join()
@@ -0,0 +1,287 @@
+# -----------------
+# Memory-mapped store of the extracted face crops, shared by the FaceAge data curation,
+# training and inference scripts (replaces the monolithic compressed ".npz" files)
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+# A face store is a folder holding three files:
+#   - "faces.bin": the face crops, stored back to back as raw (uncompressed) C-ordered arrays;
+#   - "index.csv": one row per face crop (position "face_idx" in the data file, plus any record
+#     information such as the record/photo identifiers or the age label);
+#   - "meta.json": number of crops, shape and dtype of each crop, and whether all the crops have
+#     been written.
+# The data file can be memory-mapped, so that the scripts read only the slices they need instead
+# of decompressing the whole dataset into memory.
+
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+DATA_FILE_NAME = "faces.bin"
+INDEX_FILE_NAME = "index.csv"
+META_FILE_NAME = "meta.json"
+
+STORE_VERSION = 1
+
+## ----------------------------------------
+
+def _write_meta(store_path, n_faces, face_shape, dtype, complete = True):
+
+  meta = {"version": STORE_VERSION,
+          "n_faces": int(n_faces),
+          "face_shape": [int(s) for s in face_shape],
+          "dtype": np.dtype(dtype).name,
+          "complete": bool(complete)}
+
+  with open(os.path.join(store_path, META_FILE_NAME), 'w') as f:
+    json.dump(meta, f, indent = 2)
+
+## ----------------------------------------
+
+def _write_index(store_path, index_df):
+
+  index_df = index_df.copy()
+  index_df.insert(0, "face_idx", np.arange(len(index_df)))
+
+  index_df.to_csv(os.path.join(store_path, INDEX_FILE_NAME), index = False)
+
+## ----------------------------------------
+
+class FaceStoreWriter(object):
+
+  """
+  Write a face store one crop at a time (e.g., while the faces are being extracted), so that
+  the whole dataset never needs to be held in memory. The number of crops does not need to be
+  known in advance.
+
+  The index and metadata files are written when the writer is closed - until then, the store
+  cannot be opened for reading.
+
+  @params:
+    store_path - required: path to the folder storing the face store (created if it does not exist).
+    face_shape - optional: shape of each face crop.
+    dtype - optional: data type of the face crops.
+
+  """
+
+  def __init__(self, store_path, face_shape = (160, 160, 3), dtype = np.uint8):
+
+    self.store_path = store_path
+    self.face_shape = tuple(face_shape)
+    self.dtype = np.dtype(dtype)
+
+    if not os.path.exists(store_path):
+      os.makedirs(store_path)
+
+    # an interrupted write must not leave a store that looks valid behind
+    meta_path = os.path.join(store_path, META_FILE_NAME)
+
+    if os.path.exists(meta_path):
+      os.remove(meta_path)
+
+    self.f = open(os.path.join(store_path, DATA_FILE_NAME), 'wb')
+
+    self.record_list = list()
+
+  ## ----------------------------------------
+
+  def append(self, face, **record):
+
+    """
+    Append a face crop to the store. Returns the position of the crop in the store.
+
+    @params:
+      face - required: the face crop (array of shape "face_shape").
+      record - optional: keyword arguments storing the record information associated
+        with the crop (written to the index file, one column per keyword).
+
+    """
+
+    face = np.asarray(face)
+
+    if face.shape != self.face_shape:
+      raise ValueError("Expected a face crop of shape %s, got %s."%(self.face_shape, face.shape))
+
+    self.f.write(np.ascontiguousarray(face, dtype = self.dtype).tobytes())
+    self.record_list.append(record)
+
+    return len(self.record_list) - 1
+
+  ## ----------------------------------------
+
+  def close(self):
+
+    self.f.close()
+
+    _write_index(self.store_path, pd.DataFrame(self.record_list, index = range(len(self.record_list))))
+    _write_meta(self.store_path, len(self.record_list), self.face_shape, self.dtype)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+
+    # the index and metadata files are only written if the store is complete
+    if exc_type is None:
+      self.close()
+    else:
+      self.f.close()
+
+## ----------------------------------------
+
+def create_face_store(store_path, n_faces, index_df = None, face_shape = (160, 160, 3), dtype = np.uint8):
+
+  """
+  Create a face store of the given size, preallocating the data file on disk.
+  Returns a writable memory-mapped array, so that the crops can be written at any position
+  (e.g., by several workers, or directly at their final shuffled position).
+
+  The store is marked as incomplete - until "finalize_face_store" is called once all the crops
+  have been written, it can only be opened by passing "allow_incomplete" to "load_faces" (so that
+  an interrupted write does not leave a store that looks valid behind).
+
+  @params:
+    store_path - required: path to the folder storing the face store (created if it does not exist).
+    n_faces - required: number of face crops in the store.
+    index_df - optional: dataframe storing the record information (one row per crop).
+    face_shape - optional: shape of each face crop.
+    dtype - optional: data type of the face crops.
+
+  """
+
+  if index_df is None:
+    index_df = pd.DataFrame(index = range(n_faces))
+
+  assert len(index_df) == n_faces
+
+  if not os.path.exists(store_path):
+    os.makedirs(store_path)
+
+  dtype = np.dtype(dtype)
+
+  with open(os.path.join(store_path, DATA_FILE_NAME), 'wb') as f:
+    f.truncate(int(n_faces * np.prod(face_shape)) * dtype.itemsize)
+
+  _write_index(store_path, index_df.reset_index(drop = True))
+  _write_meta(store_path, n_faces, face_shape, dtype, complete = False)
+
+  if not n_faces:
+    return np.zeros((0, ) + tuple(face_shape), dtype = dtype)
+
+  return np.memmap(os.path.join(store_path, DATA_FILE_NAME), dtype = dtype, mode = 'r+',
+                   shape = (n_faces, ) + tuple(face_shape))
+
+## ----------------------------------------
+
+def save_faces(store_path, faces, index_df = None, chunk_size = 1024):
+
+  """
+  Write an array of face crops (already in memory) to a new face store.
+
+  @params:
+    store_path - required: path to the folder storing the face store (created if it does not exist).
+    faces - required: array storing the face crops (N x 160 x 160 x 3).
+    index_df - optional: dataframe storing the record information (one row per crop).
+    chunk_size - optional: number of crops copied to the store at once.
+
+  """
+
+  store_faces = create_face_store(store_path, len(faces), index_df, faces.shape[1:], faces.dtype)
+
+  for start in range(0, len(faces), chunk_size):
+    store_faces[start:start + chunk_size] = faces[start:start + chunk_size]
+
+  if len(faces):
+    store_faces.flush()
+
+  finalize_face_store(store_path)
+
+## ----------------------------------------
+
+def finalize_face_store(store_path):
+
+  """
+  Mark a face store created by "create_face_store" as complete, once all the crops have been
+  written - from then on, it can be opened by "load_faces".
+
+  @params:
+    store_path - required: path to the face store folder.
+
+  """
+
+  with open(os.path.join(store_path, META_FILE_NAME)) as f:
+    meta = json.load(f)
+
+  _write_meta(store_path, meta["n_faces"], meta["face_shape"], meta["dtype"])
+
+## ----------------------------------------
+
+def load_faces(store_path, mmap_mode = 'r', allow_incomplete = False):
+
+  """
+  Load the face crops and the associated index from the given face store. By default the crops
+  are memory-mapped, i.e., read from disk only when (and if) they are accessed.
+  Returns the array storing the crops and the index dataframe.
+
+  For backward compatibility, legacy ".npz" files (face crops in "arr_0" and, optionally, the
+  age labels in "arr_1") are also supported - such files are always loaded in memory, and the
+  labels are returned in the "label" column of the index.
+
+  @params:
+    store_path - required: path to the face store folder (or to the legacy ".npz" file,
+      with or without the extension).
+    mmap_mode - optional: memory-map mode ('r' for read-only access, 'r+' to modify the crops
+      in place, or None to load the whole array in memory).
+    allow_incomplete - optional: if True, a store whose crops are still being written (see
+      "create_face_store") can be opened as well.
+
+  """
+
+  if not os.path.isdir(store_path):
+    npz_path = store_path if store_path.endswith(".npz") else store_path + ".npz"
+
+    rawdata = np.load(npz_path)
+    faces = rawdata['arr_0']
+
+    index_df = pd.DataFrame({"face_idx": np.arange(len(faces))})
+
+    if 'arr_1' in rawdata.files:
+      index_df["label"] = rawdata['arr_1']
+
+    return faces, index_df
+
+  with open(os.path.join(store_path, META_FILE_NAME)) as f:
+    meta = json.load(f)
+
+  if not meta.get("complete", True) and not allow_incomplete:
+    raise ValueError("The face store at '%s' is incomplete (e.g., its creation was interrupted)."%(store_path))
+
+  n_faces = meta["n_faces"]
+  shape = (n_faces, ) + tuple(meta["face_shape"])
+  data_path = os.path.join(store_path, DATA_FILE_NAME)
+
+  if mmap_mode is None:
+    faces = np.fromfile(data_path, dtype = meta["dtype"], count = int(np.prod(shape))).reshape(shape)
+  elif not n_faces:
+    faces = np.zeros(shape, dtype = meta["dtype"])
+  else:
+    faces = np.memmap(data_path, dtype = meta["dtype"], mode = mmap_mode, shape = shape)
+
+  index_df = pd.read_csv(os.path.join(store_path, INDEX_FILE_NAME))
+
+  return faces, index_df
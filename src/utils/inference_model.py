@@ -0,0 +1,269 @@
+# -----------------
+# Frozen inference artifact of the FaceAge model: export of the Keras (".h5") model to a
+# constant-folded graph, and loader preferring such artifact over the Keras model
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+# The frozen artifact is stored next to the Keras model, as "<model name>_frozen.pb" (serialized
+# GraphDef, with all the weights stored as constants) and "<model name>_frozen.json" (names of the
+# input and output tensors, and identifier of the ".h5" file the artifact was exported from - so
+# that a stale artifact is never used in place of an updated model).
+
+import os
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+import keras
+
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+
+from utils.run_manifest import get_model_id
+
+## ----------------------------------------
+
+def get_frozen_model_path(model_path):
+
+  """
+  Returns the paths to the frozen artifact (graph and metadata files) of the given Keras model.
+
+  @params:
+    model_path - required: absolute path to the Keras (".h5") model file.
+
+  """
+
+  stem = os.path.splitext(model_path)[0]
+
+  return stem + "_frozen.pb", stem + "_frozen.json"
+
+## ----------------------------------------
+
+def fold_batchnorm(model):
+
+  """
+  Fold every batch normalization layer of a sequential model into the dense layer following it.
+
+  In the FaceAge head, the batch normalization comes after the ReLU of the first dense layer, so
+  it can not be folded into the preceding layer; in inference mode, however, it is an affine
+  transformation (x - mean) * gamma / sqrt(var + eps) + beta, which can be absorbed by the weights
+  and bias of the following (linear) dense layer. The other layers are shared with the input model.
+  Returns the folded sequential model.
+
+  @params:
+    model - required: the (sequential) Keras model to be folded.
+
+  """
+
+  folded = keras.Sequential(name = model.name + "_folded")
+  folded.add(keras.Input(shape = model.input_shape[1:]))
+
+  pending_bn = None
+
+  for layer in model.layers:
+    if isinstance(layer, keras.layers.BatchNormalization) and pending_bn is None:
+      pending_bn = layer
+      continue
+
+    if pending_bn is None:
+      folded.add(layer)
+      continue
+
+    if not isinstance(layer, keras.layers.Dense):
+      raise ValueError("Batch normalization layer '%s' is not followed by a dense layer."%(pending_bn.name))
+
+    bn_config = pending_bn.get_config()
+    bn_weights = list(pending_bn.get_weights())
+
+    gamma = bn_weights.pop(0) if bn_config["scale"] else 1.
+    beta = bn_weights.pop(0) if bn_config["center"] else 0.
+    moving_mean, moving_variance = bn_weights
+
+    bn_scale = gamma / np.sqrt(moving_variance + bn_config["epsilon"])
+    bn_shift = beta - moving_mean * bn_scale
+
+    kernel, bias = layer.get_weights()
+
+    folded_layer = keras.layers.Dense.from_config(layer.get_config())
+    folded.add(folded_layer)
+    folded_layer.set_weights([bn_scale[:, None] * kernel, bias + np.dot(bn_shift, kernel)])
+
+    pending_bn = None
+
+  if pending_bn is not None:
+    raise ValueError("Batch normalization layer '%s' is not followed by a dense layer."%(pending_bn.name))
+
+  return folded
+
+## ----------------------------------------
+
+def export_frozen_model(model_path):
+
+  """
+  Export the given Keras model to a frozen inference artifact: the batch normalization of the
+  head is folded (see "fold_batchnorm"), the variables are converted to constants and only the
+  inference graph is kept (no optimizer or training state). The remaining constant subgraphs
+  (e.g., the batch normalizations of the CNN) are folded by the TF graph optimizer when the
+  artifact is loaded. Must be run with eager execution enabled.
+  Returns the paths to the graph and metadata files.
+
+  @params:
+    model_path - required: absolute path to the Keras (".h5") model file.
+
+  """
+
+  graph_path, meta_path = get_frozen_model_path(model_path)
+
+  model = keras.models.load_model(model_path, compile = False)
+  folded = fold_batchnorm(model)
+
+  input_spec = tf.TensorSpec((None, ) + tuple(folded.input_shape[1:]), tf.float32, name = "faces")
+
+  concrete_fn = tf.function(lambda faces: folded(faces, training = False)).get_concrete_function(input_spec)
+  frozen_fn = convert_variables_to_constants_v2(concrete_fn)
+
+  tf.io.write_graph(frozen_fn.graph.as_graph_def(), os.path.dirname(graph_path) or ".",
+                    os.path.basename(graph_path), as_text = False)
+
+  # the size and modification time of the Keras model file let "load_faceage_model" check that the
+  # artifact is up to date without hashing the file
+  model_stat = os.stat(model_path)
+
+  meta = {"model_id": get_model_id(model_path),
+          "model_size": model_stat.st_size,
+          "model_mtime_ns": model_stat.st_mtime_ns,
+          "input": frozen_fn.inputs[0].name,
+          "output": frozen_fn.outputs[0].name,
+          "tf_version": tf.__version__}
+
+  with open(meta_path, 'w') as f:
+    json.dump(meta, f, indent = 2)
+
+  return graph_path, meta_path
+
+## ----------------------------------------
+
+class FrozenModel(object):
+
+  """
+  FaceAge model loaded from the frozen inference artifact (see "export_frozen_model").
+
+  The graph lives in its own TF graph and session, so that it can be used regardless of the
+  execution mode (eager or graph) of the calling script, and alongside other Keras models
+  (e.g., the MTCNN detector). Mimics the "predict" method of a Keras model.
+
+  @params:
+    graph_path - required: absolute path to the frozen graph file.
+    meta_path - required: absolute path to the metadata file.
+
+  """
+
+  def __init__(self, graph_path, meta_path):
+
+    t = time.time()
+
+    with open(meta_path) as f:
+      self.meta = json.load(f)
+
+    graph_def = tf.compat.v1.GraphDef()
+
+    with open(graph_path, 'rb') as f:
+      graph_def.ParseFromString(f.read())
+
+    self.graph = tf.Graph()
+
+    with self.graph.as_default():
+      tf.compat.v1.import_graph_def(graph_def, name = "")
+
+    self.session = tf.compat.v1.Session(graph = self.graph)
+
+    self.input = self.graph.get_tensor_by_name(self.meta["input"])
+    self.output = self.graph.get_tensor_by_name(self.meta["output"])
+
+    self.load_time = time.time() - t
+
+  ## ----------------------------------------
+
+  def predict(self, x, batch_size = None):
+
+    """
+    Returns the model output for the given (standardized) faces.
+
+    @params:
+      x - required: array storing the standardized faces (N x 160 x 160 x 3).
+      batch_size - optional: number of faces processed at once (by default, all of them).
+
+    """
+
+    x = np.asarray(x, dtype = np.float32)
+    batch_size = batch_size if batch_size else max(1, len(x))
+
+    return np.concatenate([self.session.run(self.output, {self.input: x[start:start + batch_size]})
+                           for start in range(0, max(1, len(x)), batch_size)])
+
+  ## ----------------------------------------
+
+  def close(self):
+
+    self.session.close()
+
+## ----------------------------------------
+
+def _is_model_unchanged(model_path, meta):
+
+  """
+  Returns True if the size and modification time of the given Keras model file match the ones
+  stored in the metadata of the frozen artifact (see "export_frozen_model").
+
+  @params:
+    model_path - required: absolute path to the Keras (".h5") model file.
+    meta - required: dictionary storing the metadata of the frozen artifact.
+
+  """
+
+  model_stat = os.stat(model_path)
+
+  return meta.get("model_size") == model_stat.st_size and meta.get("model_mtime_ns") == model_stat.st_mtime_ns
+
+## ----------------------------------------
+
+def load_faceage_model(model_path, prefer_frozen = True):
+
+  """
+  Load the FaceAge model, preferring the frozen inference artifact (see "export_frozen_model")
+  if it exists and was exported from the given Keras model file. Otherwise, the Keras model is
+  loaded. Returns an object exposing the "predict" method.
+
+  @params:
+    model_path - required: absolute path to the Keras (".h5") model file.
+    prefer_frozen - optional: if False, the Keras model is always loaded.
+
+  """
+
+  graph_path, meta_path = get_frozen_model_path(model_path)
+
+  if prefer_frozen and os.path.exists(graph_path) and os.path.exists(meta_path):
+    with open(meta_path) as f:
+      meta = json.load(f)
+
+    # the artifact can be shipped without the Keras model it was exported from; otherwise, the
+    # (slower) hash of the Keras model is only computed if its size or modification time changed
+    if not os.path.exists(model_path) or _is_model_unchanged(model_path, meta) or meta["model_id"] == get_model_id(model_path):
+      return FrozenModel(graph_path, meta_path)
+
+    print("WARNING: the frozen model at '%s' is outdated, loading the Keras model instead."%(graph_path))
+
+  return keras.models.load_model(model_path)
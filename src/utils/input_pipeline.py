@@ -0,0 +1,246 @@
+# -----------------
+# tf.data input pipeline for the FaceAge training: lazy reading of the face crops from the face
+# store, on-the-fly augmentation and in-graph standardization
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import numpy as np
+import tensorflow as tf
+
+# same augmentation parameters as the offline augmentation (see "Augmentation_and_Rebalancing.py");
+# angles in degrees, shifts as a fraction of the image size
+AUGMENTATION_PARAMS = {"rotation_range": 20,
+                       "width_shift_range": 0.1,
+                       "height_shift_range": 0.1,
+                       "shear_range": 0.2,
+                       "zoom_range": 0.2,
+                       "horizontal_flip": True}
+
+## ----------------------------------------
+
+def _stack_matrix(rows):
+
+  # 3x3 nested list of [N] tensors -> [N, 3, 3] tensor
+  return tf.stack([tf.stack(row, axis = -1) for row in rows], axis = -2)
+
+## ----------------------------------------
+
+def get_random_transforms(n_images, height, width, augmentation_params = None):
+
+  """
+  Draw a random affine transformation for each image of a batch, following the same
+  conventions as "ImageDataGenerator.random_transform" (rotation, shift, shear and zoom
+  around the image center, followed by a random horizontal flip).
+  Returns the transformations in the format expected by "ImageProjectiveTransformV2",
+  i.e., an [N, 8] tensor mapping each output pixel to the input pixel it is sampled from.
+
+  @params:
+    n_images - required: number of images in the batch (scalar tensor).
+    height - required: height of the images.
+    width - required: width of the images.
+    augmentation_params - optional: dictionary storing the augmentation parameters
+      (see "AUGMENTATION_PARAMS", used by default).
+
+  """
+
+  params = dict(AUGMENTATION_PARAMS, **(augmentation_params or dict()))
+
+  shape = tf.reshape(n_images, [1])
+  deg2rad = np.pi / 180.
+
+  def uniform(max_value):
+    return tf.random.uniform(shape, -max_value, max_value)
+
+  theta = uniform(params["rotation_range"]) * deg2rad
+  tx = uniform(params["height_shift_range"]) * height
+  ty = uniform(params["width_shift_range"]) * width
+  shear = uniform(params["shear_range"]) * deg2rad
+  zx = 1. + uniform(params["zoom_range"])
+  zy = 1. + uniform(params["zoom_range"])
+
+  one = tf.ones(shape)
+  zero = tf.zeros(shape)
+
+  if params["horizontal_flip"]:
+    flip = tf.cast(tf.random.uniform(shape) < 0.5, tf.float32)
+  else:
+    flip = zero
+
+  # (row, col) coordinates, as in keras
+  rotation = _stack_matrix([[tf.cos(theta), -tf.sin(theta), zero],
+                            [tf.sin(theta), tf.cos(theta), zero],
+                            [zero, zero, one]])
+
+  shift = _stack_matrix([[one, zero, tx],
+                         [zero, one, ty],
+                         [zero, zero, one]])
+
+  shear = _stack_matrix([[one, -tf.sin(shear), zero],
+                         [zero, tf.cos(shear), zero],
+                         [zero, zero, one]])
+
+  zoom = _stack_matrix([[zx, zero, zero],
+                        [zero, zy, zero],
+                        [zero, zero, one]])
+
+  o_x = height / 2. - 0.5
+  o_y = width / 2. - 0.5
+
+  offset = tf.constant([[1., 0., o_x], [0., 1., o_y], [0., 0., 1.]])
+  reset = tf.constant([[1., 0., -o_x], [0., 1., -o_y], [0., 0., 1.]])
+
+  transform = tf.matmul(rotation, tf.matmul(shift, tf.matmul(shear, zoom)))
+  transform = tf.matmul(offset, tf.matmul(transform, reset))
+
+  # (row, col) -> (x, y) = (col, row) coordinates, as in "ImageProjectiveTransformV2"
+  swap = tf.constant([[0., 1., 0.], [1., 0., 0.], [0., 0., 1.]])
+  transform = tf.matmul(swap, tf.matmul(transform, swap))
+
+  # the horizontal flip is applied to the output of the affine transformation
+  flip_matrix = _stack_matrix([[one - 2. * flip, zero, flip * (width - 1.)],
+                               [zero, one, zero],
+                               [zero, zero, one]])
+
+  transform = tf.matmul(transform, flip_matrix)
+
+  return tf.reshape(transform, [-1, 9])[:, :8]
+
+## ----------------------------------------
+
+def augment_images(images, augmentation_params = None):
+
+  """
+  Apply a random affine transformation to each image of a batch (bilinear interpolation,
+  pixels outside of the image filled with zeros, as in the offline augmentation).
+
+  @params:
+    images - required: [N, H, W, C] float32 tensor storing the batch of images.
+    augmentation_params - optional: dictionary storing the augmentation parameters
+      (see "AUGMENTATION_PARAMS", used by default).
+
+  """
+
+  image_shape = images.shape
+
+  transforms = get_random_transforms(tf.shape(images)[0], image_shape[1], image_shape[2],
+                                     augmentation_params)
+
+  return tf.raw_ops.ImageProjectiveTransformV2(images = images,
+                                               transforms = transforms,
+                                               output_shape = tf.shape(images)[1:3],
+                                               interpolation = "BILINEAR",
+                                               fill_mode = "CONSTANT")
+
+## ----------------------------------------
+
+def standardize_images(images):
+
+  """
+  In-graph version of "utils.preprocessing.standardize": standardize each image of a batch
+  to zero mean and unit standard deviation (computed across all the pixels and channels).
+
+  @params:
+    images - required: [N, H, W, C] float32 tensor storing the batch of images.
+
+  """
+
+  mean = tf.reduce_mean(images, axis = [1, 2, 3], keepdims = True)
+  std = tf.math.reduce_std(images, axis = [1, 2, 3], keepdims = True)
+
+  return (images - mean) / std
+
+## ----------------------------------------
+
+def make_dataset(faces, labels, indx, batch_size, augment = False, shuffle = False, cache = False,
+                 augmentation_params = None, read_size = 256, shuffle_buffer = 4096, standardize = True,
+                 seed = None):
+
+  """
+  Build the tf.data pipeline feeding the FaceAge model: the face crops are read lazily from the
+  (memory-mapped) face store, one batch at a time, then augmented (if requested) and standardized
+  in the graph. Each epoch sees freshly drawn augmentations.
+  Returns a dataset of (standardized faces, labels) batches.
+
+  @params:
+    faces - required: array storing the face crops (e.g., obtained by running "load_faces").
+    labels - required: array storing the label of each face crop.
+    indx - required: positions of the crops to be used (may contain repeated positions, e.g.,
+      to oversample the rarer ages).
+    batch_size - required: number of samples per batch.
+    augment - optional: if True, a random transformation is applied to each sample.
+    shuffle - optional: if True, the samples are reshuffled at every epoch.
+    cache - optional: if True, the (raw) face crops are kept in memory after the first epoch;
+      a path can be passed instead, to cache them in a file.
+    augmentation_params - optional: dictionary storing the augmentation parameters
+      (see "AUGMENTATION_PARAMS", used by default).
+    read_size - optional: number of crops read from the store at once when caching.
+    shuffle_buffer - optional: size of the shuffle buffer when caching.
+    standardize - optional: if False, the samples are fed to the model as they are read (e.g.,
+      when training from cached activations rather than from the face crops).
+    seed - optional: seed of the shuffling. When training across hosts, every worker must use
+      the same seed (and the same "indx"), as the dataset is sharded by sample position.
+
+  """
+
+  face_shape = tuple(faces.shape[1:])
+  face_dtype = tf.as_dtype(faces.dtype)
+
+  indx = np.asarray(indx, dtype = np.int64)
+  label_list = np.asarray(labels, dtype = np.float32)[indx]
+
+  def load(batch_indx, batch_labels):
+    batch_faces = tf.numpy_function(lambda i: np.asarray(faces[i]), [batch_indx], face_dtype)
+    batch_faces.set_shape((None, ) + face_shape)
+
+    return batch_faces, batch_labels
+
+  def preprocess(batch_faces, batch_labels):
+    batch_faces = tf.cast(batch_faces, tf.float32)
+
+    if augment:
+      batch_faces = augment_images(batch_faces, augmentation_params)
+
+    if standardize:
+      batch_faces = standardize_images(batch_faces)
+
+    return batch_faces, batch_labels
+
+  dataset = tf.data.Dataset.from_tensor_slices((indx, label_list))
+
+  if cache:
+    # the raw crops are read in order and cached; the shuffling happens downstream
+    dataset = dataset.batch(read_size).map(load, num_parallel_calls = tf.data.experimental.AUTOTUNE)
+    dataset = dataset.unbatch().cache(cache if isinstance(cache, str) else "")
+
+    if shuffle:
+      dataset = dataset.shuffle(shuffle_buffer, seed = seed, reshuffle_each_iteration = True)
+
+    dataset = dataset.batch(batch_size)
+  else:
+    # only the positions are shuffled - the crops are read once the batch is formed
+    if shuffle:
+      dataset = dataset.shuffle(len(indx), seed = seed, reshuffle_each_iteration = True)
+
+    dataset = dataset.batch(batch_size).map(load, num_parallel_calls = tf.data.experimental.AUTOTUNE)
+
+  dataset = dataset.map(preprocess, num_parallel_calls = tf.data.experimental.AUTOTUNE)
+
+  # the dataset is not read from files - when training across hosts, shard it by sample (the
+  # workers see the samples in the same order, as long as they share the shuffling seed)
+  options = tf.data.Options()
+  options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+
+  return dataset.with_options(options).prefetch(tf.data.experimental.AUTOTUNE)
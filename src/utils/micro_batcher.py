@@ -0,0 +1,139 @@
+# -----------------
+# Dynamic micro-batching of the FaceAge model calls: concurrent requests are coalesced into
+# batches, bounded by a maximum batch size and a maximum waiting time
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import time
+import queue
+import threading
+
+from concurrent.futures import Future
+
+## ----------------------------------------
+
+class MicroBatcher(object):
+
+  """
+  Run a batched function (e.g., the FaceAge model) on the items submitted by several threads,
+  coalescing them into batches. A batch is run as soon as it holds "max_batch_size" items, or
+  "max_wait" seconds after its first item was submitted - so that a lone request never waits
+  longer than "max_wait", while concurrent requests share the cost of a model call.
+
+  All the calls to the batched function are made from a single background thread.
+
+  @params:
+    batch_fn - required: function mapping a list of items to the list of the respective results.
+    max_batch_size - optional: maximum number of items per batch.
+    max_wait - optional: maximum time (in seconds) the first item of a batch waits for more items.
+
+  """
+
+  def __init__(self, batch_fn, max_batch_size = 32, max_wait = 0.01):
+
+    self.batch_fn = batch_fn
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait
+
+    self.item_queue = queue.Queue()
+
+    self.n_items = 0
+    self.n_batches = 0
+
+    self.thread = threading.Thread(target = self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  ## ----------------------------------------
+
+  def _run(self):
+
+    stopped = False
+
+    while not stopped:
+      item = self.item_queue.get()
+
+      if item is None:
+        break
+
+      batch = [item]
+      deadline = time.time() + self.max_wait
+
+      while len(batch) < self.max_batch_size:
+        try:
+          item = self.item_queue.get(timeout = max(0., deadline - time.time()))
+        except queue.Empty:
+          break
+
+        if item is None:
+          stopped = True
+          break
+
+        batch.append(item)
+
+      future_list = [future for _, future in batch]
+
+      try:
+        result_list = list(self.batch_fn([x for x, _ in batch]))
+      except Exception as e:
+        for future in future_list:
+          future.set_exception(e)
+        continue
+
+      for future, result in zip(future_list, result_list):
+        future.set_result(result)
+
+      self.n_items += len(batch)
+      self.n_batches += 1
+
+  ## ----------------------------------------
+
+  def submit(self, x):
+
+    """
+    Submit an item to be processed. Returns a "concurrent.futures.Future" object, storing the
+    respective result once the batch the item belongs to has been processed.
+
+    @params:
+      x - required: the item to be processed.
+
+    """
+
+    future = Future()
+    self.item_queue.put((x, future))
+
+    return future
+
+  ## ----------------------------------------
+
+  def get_stats(self):
+
+    """
+    Returns a dictionary storing the number of items and batches processed so far.
+
+    """
+
+    return {"n_items": self.n_items,
+            "n_batches": self.n_batches,
+            "mean_batch_size": self.n_items / float(self.n_batches) if self.n_batches else 0.}
+
+  ## ----------------------------------------
+
+  def close(self):
+
+    # the items already submitted are processed before the thread exits
+    self.item_queue.put(None)
+    self.thread.join()
@@ -0,0 +1,63 @@
+# -----------------
+# Preprocessing of the face crops, shared by the FaceAge training and inference scripts
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import numpy as np
+
+## ----------------------------------------
+
+def standardize(face_pixels, in_place = False, chunk_size = 1024):
+
+  """
+  Standardize each face crop to zero mean and unit standard deviation (computed across all the
+  pixels and channels of the crop), as expected by the FaceAge model.
+  Returns a float32 array with the same shape as the input.
+
+  The mean and the standard deviation are computed for a whole chunk of crops at once (reducing
+  over all the axes but the first), instead of looping over the crops in Python.
+
+  @params:
+    face_pixels - required: array storing the face crops (N x 160 x 160 x 3).
+    in_place - optional: if True and the input is a float32 array, the input is overwritten
+      instead of being copied (other dtypes always require a float32 copy).
+    chunk_size - optional: number of crops standardized at once, bounding the size of the
+      temporary arrays for very large inputs (None to process the whole array at once).
+
+  """
+
+  face_pixels = np.asarray(face_pixels)
+
+  if in_place and face_pixels.dtype == np.float32:
+    out = face_pixels
+  else:
+    out = face_pixels.astype(np.float32)
+
+  n_faces = out.shape[0]
+  chunk_size = chunk_size if chunk_size else max(1, n_faces)
+
+  axis = tuple(range(1, out.ndim))
+
+  for start in range(0, n_faces, chunk_size):
+    chunk = out[start:start + chunk_size]
+
+    mean = chunk.mean(axis = axis, keepdims = True)
+    std = chunk.std(axis = axis, keepdims = True)
+
+    chunk -= mean
+    chunk /= std
+
+  return out
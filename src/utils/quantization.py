@@ -0,0 +1,158 @@
+# -----------------
+# Post-training quantization of the FaceAge model (TFLite dynamic-range, float16 and full-int8
+# variants), and loader mimicking the Keras "predict" method
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import os
+
+import numpy as np
+import tensorflow as tf
+import keras
+
+from utils.inference_model import fold_batchnorm
+
+# "float32": no quantization (reference TFLite model);
+# "dynamic": weights stored as int8, activations computed in floating point;
+# "float16": weights stored as float16;
+# "int8": weights and activations quantized to int8 (requires calibration data) - the model input
+#         and output are kept in floating point, so that the preprocessing does not change
+QUANTIZATION_MODES = ("float32", "dynamic", "float16", "int8")
+
+## ----------------------------------------
+
+def get_quantized_model_path(model_path, mode):
+
+  """
+  Returns the path to the quantized (TFLite) variant of the given Keras model.
+
+  @params:
+    model_path - required: absolute path to the Keras (".h5") model file.
+    mode - required: quantization mode (see "QUANTIZATION_MODES").
+
+  """
+
+  return "%s_%s.tflite"%(os.path.splitext(model_path)[0], mode)
+
+## ----------------------------------------
+
+def export_quantized_model(model_path, mode, calibration_faces = None, calibration_batch_size = 8):
+
+  """
+  Convert the given Keras model to a (quantized) TFLite model, after folding the batch
+  normalization of the head (see "fold_batchnorm"). Must be run with eager execution enabled.
+  Returns the path to the TFLite model file.
+
+  @params:
+    model_path - required: absolute path to the Keras (".h5") model file.
+    mode - required: quantization mode (see "QUANTIZATION_MODES").
+    calibration_faces - optional: array storing the (standardized) faces the ranges of the
+      activations are calibrated on - required by the "int8" mode. Should be a representative
+      subset of the faces the model will process (a few hundreds are usually enough).
+    calibration_batch_size - optional: number of calibration faces fed to the model at once.
+
+  """
+
+  if mode not in QUANTIZATION_MODES:
+    raise ValueError("Unknown quantization mode: %s (expected one of %s)."%(mode, ", ".join(QUANTIZATION_MODES)))
+
+  model = keras.models.load_model(model_path, compile = False)
+
+  converter = tf.lite.TFLiteConverter.from_keras_model(fold_batchnorm(model))
+
+  if mode != "float32":
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+  if mode == "float16":
+    converter.target_spec.supported_types = [tf.float16]
+
+  elif mode == "int8":
+    if calibration_faces is None or not len(calibration_faces):
+      raise ValueError("The int8 quantization requires calibration faces.")
+
+    def representative_dataset():
+      for start in range(0, len(calibration_faces), calibration_batch_size):
+        yield [np.asarray(calibration_faces[start:start + calibration_batch_size], dtype = np.float32)]
+
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+  tflite_path = get_quantized_model_path(model_path, mode)
+
+  with open(tflite_path, 'wb') as f:
+    f.write(converter.convert())
+
+  return tflite_path
+
+## ----------------------------------------
+
+class TFLiteModel(object):
+
+  """
+  FaceAge model loaded from a TFLite file (see "export_quantized_model").
+  Mimics the "predict" method of a Keras model.
+
+  The interpreter is not thread-safe: each thread should hold its own "TFLiteModel" object.
+
+  @params:
+    tflite_path - required: absolute path to the TFLite model file.
+    num_threads - optional: number of threads used by the interpreter (by default, chosen by TFLite).
+
+  """
+
+  def __init__(self, tflite_path, num_threads = None):
+
+    self.interpreter = tf.lite.Interpreter(model_path = tflite_path, num_threads = num_threads)
+    self.interpreter.allocate_tensors()
+
+    self.input_index = self.interpreter.get_input_details()[0]["index"]
+    self.output_index = self.interpreter.get_output_details()[0]["index"]
+
+    self.input_shape = tuple(self.interpreter.get_input_details()[0]["shape"])
+
+  ## ----------------------------------------
+
+  def _run(self, batch):
+
+    # the tensors are only reallocated when the batch size changes
+    if batch.shape != self.input_shape:
+      self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+      self.interpreter.allocate_tensors()
+      self.input_shape = batch.shape
+
+    self.interpreter.set_tensor(self.input_index, batch)
+    self.interpreter.invoke()
+
+    return self.interpreter.get_tensor(self.output_index).copy()
+
+  ## ----------------------------------------
+
+  def predict(self, x, batch_size = None):
+
+    """
+    Returns the model output for the given (standardized) faces.
+
+    @params:
+      x - required: array storing the standardized faces (N x 160 x 160 x 3).
+      batch_size - optional: number of faces processed at once (by default, all of them).
+
+    """
+
+    x = np.asarray(x, dtype = np.float32)
+    batch_size = batch_size if batch_size else max(1, len(x))
+
+    return np.concatenate([self._run(x[start:start + batch_size])
+                           for start in range(0, max(1, len(x)), batch_size)])
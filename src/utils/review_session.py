@@ -0,0 +1,271 @@
+# -----------------
+# Review engine for the manual photo QA: background prefetching/rendering of the faces
+# and persistent journal of the cull/restore decisions
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import os
+import json
+import time
+import threading
+
+import numpy as np
+
+## ----------------------------------------
+
+class FacePrefetcher(object):
+
+  """
+  Render the faces around the one currently under review in a background thread, so that
+  the next (and previous) faces are ready to be displayed as soon as a key is pressed.
+
+  Only the rendered frames within "window" positions of the current one are kept in memory.
+
+  @params:
+    render_fn - required: function returning the frame to be displayed for a given position.
+    n_faces - required: number of faces under review.
+    window - optional: number of faces rendered ahead of (and behind) the current one.
+
+  """
+
+  def __init__(self, render_fn, n_faces, window = 8):
+
+    self.render_fn = render_fn
+    self.n_faces = n_faces
+    self.window = window
+
+    self.frame_dict = dict()
+    self.position = 0
+    self.stopped = False
+
+    self.cond = threading.Condition()
+
+    self.thread = threading.Thread(target = self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  ## ----------------------------------------
+
+  def _get_window(self):
+
+    # the faces ahead of the current one are rendered first, as reviewers mostly move forward
+    ahead = range(self.position, min(self.n_faces, self.position + self.window + 1))
+    behind = range(self.position - 1, max(-1, self.position - self.window - 1), -1)
+
+    return list(ahead) + list(behind)
+
+  ## ----------------------------------------
+
+  def _run(self):
+
+    while True:
+      with self.cond:
+        while not self.stopped:
+          todo_list = [idx for idx in self._get_window() if idx not in self.frame_dict]
+
+          if todo_list:
+            break
+
+          self.cond.wait()
+
+        if self.stopped:
+          return
+
+        idx = todo_list[0]
+
+      # render outside of the lock, so that the review loop is never blocked
+      frame = self.render_fn(idx)
+
+      with self.cond:
+        self.frame_dict[idx] = frame
+        self.cond.notify_all()
+
+  ## ----------------------------------------
+
+  def get(self, idx):
+
+    """
+    Returns the frame to be displayed for the given position, and moves the prefetching
+    window around it. The frame is rendered in the calling thread if it is not ready yet.
+
+    @params:
+      idx - required: the position of the face under review.
+
+    """
+
+    with self.cond:
+      self.position = idx
+
+      # drop the frames that fell out of the window
+      window_set = set(self._get_window())
+
+      for key in list(self.frame_dict.keys()):
+        if key not in window_set:
+          del self.frame_dict[key]
+
+      frame = self.frame_dict.get(idx)
+      self.cond.notify_all()
+
+    if frame is None:
+      frame = self.render_fn(idx)
+
+      with self.cond:
+        self.frame_dict[idx] = frame
+
+    return frame
+
+  ## ----------------------------------------
+
+  def close(self):
+
+    with self.cond:
+      self.stopped = True
+      self.cond.notify_all()
+
+    self.thread.join()
+
+## ----------------------------------------
+
+class ReviewJournal(object):
+
+  """
+  Append-only journal (JSON lines) of a manual QA review session.
+
+  Every cull/restore decision, and every move to a new face, is written to disk (flushed and
+  synced) as it happens, so that no work is lost if the session is interrupted. When a journal
+  already exists, the decisions are replayed and the session resumes at the last reviewed face.
+
+  Each entry stores the record number of the face it refers to: entries that no longer match
+  the dataset under review (e.g., if the curated database was regenerated) are ignored.
+
+  @params:
+    journal_path - required: path to the journal file.
+    record_list - required: list of the record numbers (pmrn) of the faces under review.
+    resume - optional: if True, the decisions stored in an existing journal are replayed;
+      otherwise, the journal is overwritten.
+
+  """
+
+  def __init__(self, journal_path, record_list, resume = True):
+
+    self.journal_path = journal_path
+    self.record_list = [str(record) for record in record_list]
+
+    self.cullindx = np.ones((len(self.record_list), ))
+    self.position = 0
+
+    self.n_replayed = 0
+    self.n_ignored = 0
+
+    resume = resume and os.path.exists(journal_path)
+
+    if resume:
+      self._load()
+
+    self.f = open(journal_path, 'a' if resume else 'w')
+
+    # make sure new entries do not get appended to an incomplete line (blank lines are ignored)
+    if resume:
+      self.f.write("\n")
+
+  ## ----------------------------------------
+
+  def _load(self):
+
+    with open(self.journal_path) as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          continue
+
+        idx = entry["idx"]
+
+        if idx >= len(self.record_list) or self.record_list[idx] != entry["record"]:
+          self.n_ignored += 1
+          continue
+
+        if entry["event"] == "cull":
+          self.cullindx[idx] = 0
+        elif entry["event"] == "restore":
+          self.cullindx[idx] = 1
+
+        self.position = idx
+        self.n_replayed += 1
+
+  ## ----------------------------------------
+
+  def _write(self, event, idx):
+
+    entry = {"event": event,
+             "idx": int(idx),
+             "record": self.record_list[idx],
+             "time": time.time()}
+
+    self.f.write(json.dumps(entry) + "\n")
+    self.f.flush()
+    os.fsync(self.f.fileno())
+
+  ## ----------------------------------------
+
+  def view(self, idx):
+
+    """
+    Record that the face at the given position is under review.
+
+    @params:
+      idx - required: the position of the face under review.
+
+    """
+
+    self.position = idx
+    self._write("view", idx)
+
+  ## ----------------------------------------
+
+  def cull(self, idx):
+
+    """
+    Cull (i.e., remove from the dataset) the face at the given position.
+
+    @params:
+      idx - required: the position of the face to be culled.
+
+    """
+
+    self.cullindx[idx] = 0
+    self._write("cull", idx)
+
+  ## ----------------------------------------
+
+  def restore(self, idx):
+
+    """
+    Undo the cull of the face at the given position.
+
+    @params:
+      idx - required: the position of the face to be restored.
+
+    """
+
+    self.cullindx[idx] = 1
+    self._write("restore", idx)
+
+  ## ----------------------------------------
+
+  def close(self):
+
+    self.f.close()
@@ -0,0 +1,189 @@
+# -----------------
+# Manifest of the files already scored by the FaceAge pipeline, used to run the
+# pipeline incrementally (i.e., only on the files added or modified since the last run)
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import os
+import hashlib
+
+import pandas as pd
+
+MANIFEST_COLUMNS = ["file_name", "size", "mtime_ns", "sha1", "model_id"]
+
+## ----------------------------------------
+
+def get_file_hash(path_to_file, chunk_size = 1 << 20):
+
+  """
+  Returns the SHA-1 hash of the content of the given file (read in chunks).
+
+  @params:
+    path_to_file - required: absolute path to the file to be hashed.
+    chunk_size - optional: number of bytes read at once.
+
+  """
+
+  sha1 = hashlib.sha1()
+
+  with open(path_to_file, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      sha1.update(chunk)
+
+  return sha1.hexdigest()
+
+## ----------------------------------------
+
+def get_model_id(model_path):
+
+  """
+  Returns a string identifying the FaceAge model (file name and hash of the content),
+  so that changing the model triggers the re-processing of all the files.
+
+  @params:
+    model_path - required: absolute path to the model file.
+
+  """
+
+  return "%s-%s"%(os.path.basename(model_path), get_file_hash(model_path)[:16])
+
+## ----------------------------------------
+
+def load_manifest(manifest_path):
+
+  """
+  Load the manifest of the files scored by previous runs (an empty manifest is returned
+  if the file does not exist yet).
+
+  @params:
+    manifest_path - required: absolute path to the manifest ".csv" file.
+
+  """
+
+  if not os.path.exists(manifest_path):
+    return pd.DataFrame(columns = MANIFEST_COLUMNS)
+
+  return pd.read_csv(manifest_path, dtype = {"file_name": str, "sha1": str, "model_id": str})
+
+## ----------------------------------------
+
+def select_modified_files(input_folder_path, input_file_list, manifest_df, model_id):
+
+  """
+  Compare the files in the input folder with the manifest of the previous runs.
+  Returns the list of the files to be processed (i.e., files that were added or modified since
+  the last run, or scored with a different model) and the manifest restricted to the files
+  that do not need to be processed again.
+
+  The size and modification time of each file are checked first; the content of the file is
+  hashed only if these differ from the manifest, so that files that were just copied or touched
+  are not processed again.
+
+  @params:
+    input_folder_path - required: absolute path to the folder storing the files to be processed.
+    input_file_list - required: list of the names of the files to be processed.
+    manifest_df - required: the manifest of the previous runs (see "load_manifest").
+    model_id - required: the string identifying the FaceAge model (see "get_model_id").
+
+  """
+
+  manifest_dict = manifest_df[manifest_df["model_id"] == model_id].set_index("file_name").to_dict(orient = "index")
+
+  file_list = list()
+  unchanged_row_list = list()
+
+  for input_file in input_file_list:
+
+    path_to_file = os.path.join(input_folder_path, input_file)
+    file_stat = os.stat(path_to_file)
+
+    entry = manifest_dict.get(input_file)
+
+    if entry is None:
+      file_list.append(input_file)
+      continue
+
+    if entry["size"] == file_stat.st_size and entry["mtime_ns"] == file_stat.st_mtime_ns:
+      unchanged_row_list.append(dict(entry, file_name = input_file))
+      continue
+
+    file_hash = get_file_hash(path_to_file)
+
+    if entry["size"] == file_stat.st_size and entry["sha1"] == file_hash:
+      unchanged_row_list.append(dict(entry, file_name = input_file, mtime_ns = file_stat.st_mtime_ns))
+    else:
+      file_list.append(input_file)
+
+  return file_list, pd.DataFrame(unchanged_row_list, columns = MANIFEST_COLUMNS)
+
+## ----------------------------------------
+
+def update_manifest(manifest_df, input_folder_path, processed_file_list, model_id):
+
+  """
+  Add the files processed by the current run to the manifest.
+
+  @params:
+    manifest_df - required: the manifest of the files that were not processed again
+      (e.g., obtained by running "select_modified_files").
+    input_folder_path - required: absolute path to the folder storing the processed files.
+    processed_file_list - required: list of the names of the files processed by the current run.
+    model_id - required: the string identifying the FaceAge model (see "get_model_id").
+
+  """
+
+  row_list = list()
+
+  for input_file in processed_file_list:
+
+    path_to_file = os.path.join(input_folder_path, input_file)
+    file_stat = os.stat(path_to_file)
+
+    row_list.append({"file_name": input_file,
+                     "size": file_stat.st_size,
+                     "mtime_ns": file_stat.st_mtime_ns,
+                     "sha1": get_file_hash(path_to_file),
+                     "model_id": model_id})
+
+  new_manifest_df = pd.DataFrame(row_list, columns = MANIFEST_COLUMNS)
+
+  return pd.concat([manifest_df, new_manifest_df], ignore_index = True)
+
+## ----------------------------------------
+
+def merge_results(results_path, age_pred_df, processed_subj_list, kept_subj_list):
+
+  """
+  Merge the predictions of the current run with the results file written by the previous runs.
+  Rows for subjects processed again (i.e., modified files) are replaced, and rows for subjects
+  that are no longer part of the input folder are dropped.
+
+  @params:
+    results_path - required: absolute path to the results ".csv" file of the previous runs.
+    age_pred_df - required: dataframe storing the predictions of the current run.
+    processed_subj_list - required: list of the subjects processed by the current run.
+    kept_subj_list - required: list of the subjects whose results from previous runs are still valid.
+
+  """
+
+  if not os.path.exists(results_path):
+    return age_pred_df
+
+  prev_age_pred_df = pd.read_csv(results_path, dtype = {"subj_id": str})
+
+  keep_mask = prev_age_pred_df["subj_id"].isin(kept_subj_list) & ~prev_age_pred_df["subj_id"].isin(processed_subj_list)
+
+  return pd.concat([prev_age_pred_df[keep_mask], age_pred_df], ignore_index = True)
@@ -0,0 +1,239 @@
+# -----------------
+# Frozen-trunk feature cache for the FaceAge training: split the Inception-ResNet CNN at the
+# frozen/trainable boundary, precompute the activations of the frozen trunk once, and train
+# only the tail of the CNN (and the regression head) on the cached activations
+# -----------------
+
+# The code and data of this repository are intended to promote transparent and reproducible research
+# of the paper "Decoding biological age from face photographs using deep learning"
+
+# All the details about the project can be found at the following webpage:
+# aim.hms.harvard.edu/FaceAge
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AIM 2022
+
+import os
+import json
+import hashlib
+
+import numpy as np
+from keras import models
+
+from utils.preprocessing import standardize
+
+## ----------------------------------------
+
+def _get_inbound_layer_names(layer_config):
+
+  # names of the layers feeding the given layer (functional model config)
+  name_list = list()
+
+  for node in layer_config["inbound_nodes"]:
+    for inbound in node:
+      name_list.append(inbound[0])
+
+  return name_list
+
+## ----------------------------------------
+
+def find_cut_index(model, max_index):
+
+  """
+  Find the deepest layer (at or before "max_index") the model can be cleanly split at, i.e.,
+  such that every layer after it only depends on its output (and not on the output of earlier
+  layers, as is the case inside the residual blocks of the Inception-ResNet architecture).
+  Returns the index of such layer.
+
+  @params:
+    model - required: the (functional) Keras model to be split.
+    max_index - required: index of the last layer that can belong to the trunk (e.g., the last
+      frozen layer).
+
+  """
+
+  layer_config_list = model.get_config()["layers"]
+  layer_index_dict = {layer_config["name"]: idx for idx, layer_config in enumerate(layer_config_list)}
+
+  # for every layer, the earliest layer feeding any of the following layers
+  n_layers = len(layer_config_list)
+  suffix_min = [n_layers] * (n_layers + 1)
+
+  for idx in range(n_layers - 1, -1, -1):
+    inbound_list = [layer_index_dict[name] for name in _get_inbound_layer_names(layer_config_list[idx])]
+    suffix_min[idx] = min([suffix_min[idx + 1]] + inbound_list)
+
+  for cut_index in range(min(max_index, n_layers - 2), 0, -1):
+    if suffix_min[cut_index + 1] >= cut_index:
+      return cut_index
+
+  raise ValueError("The model can not be split at or before layer %d."%(max_index))
+
+## ----------------------------------------
+
+def copy_weights(src_model, dst_model):
+
+  """
+  Copy the weights (and the trainable flag) of every layer of "dst_model" from the layer
+  with the same name in "src_model". Returns the number of layers copied.
+
+  @params:
+    src_model - required: the Keras model the weights are copied from.
+    dst_model - required: the Keras model the weights are copied to.
+
+  """
+
+  src_layer_dict = {layer.name: layer for layer in src_model.layers}
+
+  n_copied = 0
+
+  for layer in dst_model.layers:
+    src_layer = src_layer_dict.get(layer.name)
+
+    # (the input layer replacing the cut layer in the tail is skipped)
+    if src_layer is None or src_layer is layer or type(src_layer) is not type(layer):
+      continue
+
+    layer.trainable = src_layer.trainable
+
+    if src_layer.weights:
+      layer.set_weights(src_layer.get_weights())
+      n_copied += 1
+
+  return n_copied
+
+## ----------------------------------------
+
+def split_model(model, cut_index):
+
+  """
+  Split the given (functional) Keras model at the given layer (see "find_cut_index").
+  Returns the trunk (from the model input to the output of the cut layer) and the tail (from the
+  output of the cut layer to the model output) - such that "tail(trunk(x))" equals "model(x)".
+
+  The tail is rebuilt from the model configuration, replacing the cut layer with an input layer
+  with the same name (so that the connections of the following layers are preserved), and the
+  weights are copied layer by layer.
+
+  @params:
+    model - required: the (functional) Keras model to be split.
+    cut_index - required: index of the last layer of the trunk.
+
+  """
+
+  cut_layer = model.layers[cut_index]
+
+  trunk = models.Model(model.inputs, cut_layer.output, name = model.name + "_trunk")
+
+  config = model.get_config()
+
+  input_layer_config = {"class_name": "InputLayer",
+                        "name": cut_layer.name,
+                        "config": {"batch_input_shape": tuple(cut_layer.output_shape),
+                                   "dtype": cut_layer.dtype,
+                                   "sparse": False,
+                                   "ragged": False,
+                                   "name": cut_layer.name},
+                        "inbound_nodes": []}
+
+  tail_config = {"name": model.name + "_tail",
+                 "layers": [input_layer_config] + config["layers"][cut_index + 1:],
+                 "input_layers": [[cut_layer.name, 0, 0]],
+                 "output_layers": config["output_layers"]}
+
+  tail = models.Model.from_config(tail_config)
+
+  copy_weights(model, tail)
+
+  return trunk, tail
+
+## ----------------------------------------
+
+def get_dataset_fingerprint(store_path, labels):
+
+  """
+  Returns a dictionary identifying the content of the given face store (size and modification
+  time of its files) and the order of the labels, so that the cached activations are not paired
+  with a regenerated dataset (e.g., re-shuffled by "Augmentation_and_Rebalancing.py").
+
+  @params:
+    store_path - required: path to the face store folder (or to the legacy ".npz" file,
+      with or without the extension).
+    labels - required: array storing the age labels, in the same order as the face crops.
+
+  """
+
+  if os.path.isdir(store_path):
+    path_list = [os.path.join(store_path, f) for f in sorted(os.listdir(store_path))]
+  else:
+    path_list = [store_path if store_path.endswith(".npz") else store_path + ".npz"]
+
+  fingerprint = dict()
+
+  for path_to_file in path_list:
+    stat = os.stat(path_to_file)
+    fingerprint[os.path.basename(path_to_file)] = [stat.st_size, stat.st_mtime_ns]
+
+  fingerprint["labels_sha1"] = hashlib.sha1(np.ascontiguousarray(labels).tobytes()).hexdigest()
+
+  return fingerprint
+
+## ----------------------------------------
+
+def cache_features(trunk, faces, cache_path, batch_size = 256, fingerprint = None):
+
+  """
+  Compute the trunk activations for all the face crops (standardized as expected by the model)
+  and store them in a memory-mapped ".npy" file. The cache is reused if it was computed for the
+  same trunk and dataset already - i.e., if the trunk output, the shape of the activations and
+  the given fingerprint all match the ones stored alongside the cache.
+  Returns the (read-only, memory-mapped) array storing the activations.
+
+  @params:
+    trunk - required: the frozen trunk of the model (see "split_model").
+    faces - required: array storing the face crops (e.g., obtained by running "load_faces").
+    cache_path - required: path to the ".npy" file storing the cached activations.
+    batch_size - optional: number of crops processed at once.
+    fingerprint - optional: JSON-serializable dictionary identifying the trunk weights and the
+      dataset (e.g., the model ID, the cutoff layer and the output of "get_dataset_fingerprint").
+
+  """
+
+  feature_shape = (len(faces), ) + tuple(trunk.output_shape[1:])
+
+  meta = {"trunk_output": trunk.layers[-1].name,
+          "shape": list(feature_shape),
+          "fingerprint": fingerprint}
+
+  meta_path = os.path.splitext(cache_path)[0] + ".json"
+
+  if os.path.exists(cache_path) and os.path.exists(meta_path):
+    with open(meta_path) as f:
+      if json.load(f) == meta:
+        print('Using the cached trunk activations at: %s' % cache_path)
+        return np.load(cache_path, mmap_mode = 'r')
+
+  # an interrupted run must not leave a cache that looks valid behind
+  if os.path.exists(meta_path):
+    os.remove(meta_path)
+
+  features = np.lib.format.open_memmap(cache_path, mode = 'w+', dtype = np.float32, shape = feature_shape)
+
+  for start in range(0, len(faces), batch_size):
+    features[start:start + batch_size] = trunk.predict_on_batch(standardize(faces[start:start + batch_size]))
+    print('Caching trunk activations: %d of %d' % (min(start + batch_size, len(faces)), len(faces)), end = '\r')
+
+  print('')
+
+  features.flush()
+  del features
+
+  with open(meta_path, 'w') as f:
+    json.dump(meta, f)
+
+  return np.load(cache_path, mmap_mode = 'r')